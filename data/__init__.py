@@ -1,5 +1,7 @@
 from .config import *
 from .coco import *
+from .shards import *
+from .batching import *
 
 import torch
 import cv2
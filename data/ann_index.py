@@ -0,0 +1,301 @@
+"""
+A compact, array backed index of every annotation in a COCO annotation file, grouped by image.
+
+Going through pycocotools for each sample means getAnnIds, loadAnns and a few list comprehensions
+over python dicts for every image, every time. This flattens all of that once into a handful of
+numpy arrays, so looking up an image's annotations is just slicing, and the whole thing pickles
+into dataloader workers as a few big buffers instead of a million little dicts.
+
+Since building this (and the COCO object it's built from) takes a while for big annotation files,
+load_or_build saves it next to the annotation file in a <info_file>.index folder and memory maps it
+from there next time. That sidecar is checked against the annotation file's mtime and size, and if
+those changed, against its hash, so editing the annotations rebuilds it.
+
+Layout:
+    - image_ids    [N]:     Sorted image ids (so rows can be found with searchsorted).
+    - image_order  [N]:     The rows of every image, in the order they're in the annotation file.
+    - annotated    [K]:     The rows of the images that have annotations, in the order of their first annotation.
+    - image_sizes  [N, 2]:  (height, width) of each image.
+    - file_names   [N]:     The file name of each image.
+    - num_crowds   [N]:     The number of crowd annotations at the end of each image's annotations.
+    - ann_offsets  [N+1]:   Image i owns annotations ann_offsets[i]:ann_offsets[i+1] (crowds last).
+    - boxes        [M, 4]:  COCO [x, y, w, h] box of each annotation.
+    - category_ids [M]:     The original COCO category id of each annotation.
+    - iscrowd      [M]:     Whether each annotation is a crowd.
+    - seg_offsets  [M+1]:   Annotation j's polygons are polys seg_offsets[j]:seg_offsets[j+1].
+    - poly_offsets [P+1]:   Polygon p is poly_coords[poly_offsets[p]:poly_offsets[p+1]] (x, y, x, y, ...).
+    - poly_coords  [C]:     Every polygon's points, concatenated (as float64, like the json parses to).
+    - rle_offsets  [M+1]:   Annotation j's compressed RLE counts are rle_counts[rle_offsets[j]:rle_offsets[j+1]].
+    - rle_counts   [B]:     The RLE counts of every annotation that isn't a polygon, concatenated.
+"""
+
+import os
+import os.path as osp
+import json
+import shutil
+import hashlib
+import time
+from array import array
+
+import numpy as np
+from pycocotools import mask as maskUtils
+
+# Bump this if the layout changes so old sidecars get rebuilt
+INDEX_VERSION = 3
+
+
+def sha1_file(path:str, chunk_size:int=1 << 20) -> str:
+    """ Returns the sha1 of the contents of the file at path. INDEX_VERSION is checked separately. """
+    sha = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+class AnnotationIndex:
+    """ See the top of this file. Use AnnotationIndex.from_coco to make one. """
+
+    array_names = ('image_ids', 'image_order', 'annotated', 'image_sizes', 'file_names', 'num_crowds', 'ann_offsets',
+                   'boxes', 'category_ids', 'iscrowd', 'seg_offsets', 'poly_offsets', 'poly_coords', 'rle_offsets', 'rle_counts')
+
+    def __init__(self, arrays:dict, index_dir:str=None):
+        self.index_dir = index_dir
+
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+
+    def __getstate__(self):
+        # If we're memory mapped, don't pickle the maps into every dataloader worker, just open them again
+        if self.index_dir is not None:
+            return {'index_dir': self.index_dir}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'image_ids' in state:
+            self.__dict__.update(state)
+        else:
+            self.__init__(AnnotationIndex._load_arrays(state['index_dir']), state['index_dir'])
+
+    @staticmethod
+    def from_coco(coco) -> 'AnnotationIndex':
+        """ Builds the index out of a pycocotools COCO object. """
+        image_ids = sorted(coco.imgs.keys())
+        num_images = len(image_ids)
+        rows = {img_id: idx for idx, img_id in enumerate(image_ids)}
+
+        image_sizes = np.zeros((num_images, 2), dtype=np.int32)
+        num_crowds  = np.zeros(num_images, dtype=np.int32)
+        ann_offsets = np.zeros(num_images + 1, dtype=np.int64)
+        file_names  = []
+
+        boxes = array('d')
+        category_ids = array('i')
+        iscrowd = array('b')
+        seg_offsets  = array('q', [0])
+        poly_offsets = array('q', [0])
+        poly_coords  = array('d')
+        rle_offsets  = array('q', [0])
+        rle_counts   = bytearray()
+        num_no_bbox  = 0
+
+        for idx, img_id in enumerate(image_ids):
+            info = coco.imgs[img_id]
+            height, width = info['height'], info['width']
+
+            # imgToAnns is in the same order getAnnIds gives, so this matches what load_target used to do
+            anns = coco.imgToAnns.get(img_id, [])
+
+            # The target transform used to skip these, so leave them (and their masks) out altogether
+            num_no_bbox += sum(1 for x in anns if 'bbox' not in x)
+            anns = [x for x in anns if 'bbox' in x]
+
+            crowd = [x for x in anns if     ('iscrowd' in x and x['iscrowd'])]
+            anns  = [x for x in anns if not ('iscrowd' in x and x['iscrowd'])] + crowd
+
+            for obj in anns:
+                boxes.extend(obj['bbox'])
+                category_ids.append(obj['category_id'])
+                iscrowd.append(1 if ('iscrowd' in obj and obj['iscrowd']) else 0)
+
+                segm = obj['segmentation']
+                if isinstance(segm, list):
+                    for poly in segm:
+                        poly_coords.extend(poly)
+                        poly_offsets.append(len(poly_coords))
+                else:
+                    if isinstance(segm['counts'], list):
+                        # Uncompressed RLE, so compress it
+                        segm = maskUtils.frPyObjects(segm, height, width)
+                    counts = segm['counts']
+                    rle_counts += counts.encode('ascii') if isinstance(counts, str) else counts
+
+                seg_offsets.append(len(poly_offsets) - 1)
+                rle_offsets.append(len(rle_counts))
+
+            image_sizes[idx] = (height, width)
+            num_crowds[idx]  = len(crowd)
+            ann_offsets[idx+1] = ann_offsets[idx] + len(anns)
+            file_names.append(info['file_name'])
+
+        if num_no_bbox > 0:
+            print('Warning: Skipped %d annotations with no bbox.' % num_no_bbox)
+
+        return AnnotationIndex({
+            'image_ids':    np.array(image_ids, dtype=np.int64),
+            'image_order':  np.array([rows[img_id] for img_id in coco.imgs.keys()], dtype=np.int64),
+            'annotated':    np.array([rows[img_id] for img_id in coco.imgToAnns.keys()], dtype=np.int64),
+            'image_sizes':  image_sizes,
+            'file_names':   np.array(file_names, dtype=str),
+            'num_crowds':   num_crowds,
+            'ann_offsets':  ann_offsets,
+            'boxes':        np.frombuffer(boxes, dtype=np.float64).reshape(-1, 4),
+            'category_ids': np.frombuffer(category_ids, dtype=np.int32),
+            'iscrowd':      np.frombuffer(iscrowd, dtype=np.int8).astype(bool),
+            'seg_offsets':  np.frombuffer(seg_offsets, dtype=np.int64),
+            'poly_offsets': np.frombuffer(poly_offsets, dtype=np.int64),
+            'poly_coords':  np.frombuffer(poly_coords, dtype=np.float64),
+            'rle_offsets':  np.frombuffer(rle_offsets, dtype=np.int64),
+            'rle_counts':   np.frombuffer(bytes(rle_counts), dtype=np.uint8),
+        })
+
+    @staticmethod
+    def _load_arrays(index_dir:str) -> dict:
+        arrays = {}
+
+        for name in AnnotationIndex.array_names:
+            path = osp.join(index_dir, name + '.npy')
+            try:
+                arrays[name] = np.load(path, mmap_mode='r')
+            except ValueError:
+                # Some versions of numpy can't map an empty array (e.g., rle_counts when everything is polygons)
+                arrays[name] = np.load(path)
+
+        return arrays
+
+    @staticmethod
+    def load(index_dir:str) -> 'AnnotationIndex':
+        """ Memory maps an index that was saved with save. """
+        return AnnotationIndex(AnnotationIndex._load_arrays(index_dir), index_dir)
+
+    def save(self, index_dir:str, meta:dict):
+        """ Saves every array plus meta (which says what annotation file this is for) to index_dir. """
+        # Write to a temporary folder first so an interrupted save never looks like a finished index
+        tmp_dir = index_dir + '.tmp%d' % os.getpid()
+        if osp.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        for name in self.array_names:
+            np.save(osp.join(tmp_dir, name + '.npy'), getattr(self, name))
+
+        with open(osp.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        if osp.exists(index_dir):
+            shutil.rmtree(index_dir, ignore_errors=True)
+
+        try:
+            os.replace(tmp_dir, index_dir)
+        except OSError:
+            # Someone else finished saving the same index first, so just use theirs
+            shutil.rmtree(tmp_dir)
+            if not osp.exists(index_dir):
+                raise
+
+    @staticmethod
+    def load_or_build(info_file:str, coco=None):
+        """
+        Returns (index, coco) for this annotation file. If the sidecar next to info_file is up to date,
+        index is memory mapped from there and coco is None (build it yourself if you need it). Otherwise,
+        this builds the COCO object and the index, saves the index to the sidecar, and returns both.
+        """
+        index_dir = info_file + '.index'
+        meta_path = osp.join(index_dir, 'meta.json')
+        stat = os.stat(info_file)
+
+        meta = None
+        if osp.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+
+            if meta.get('version') != INDEX_VERSION or meta.get('size') != stat.st_size:
+                meta = None
+            elif meta.get('mtime_ns') != stat.st_mtime_ns:
+                # The file's been touched, but it might not have changed, so check the hash before rebuilding
+                if meta.get('sha1') != sha1_file(info_file):
+                    meta = None
+                else:
+                    meta['mtime_ns'] = stat.st_mtime_ns
+                    try:
+                        with open(meta_path, 'w') as f:
+                            json.dump(meta, f, indent=2)
+                    except OSError:
+                        pass
+
+        if meta is not None:
+            start = time.time()
+            index = AnnotationIndex.load(index_dir)
+            print('Loaded annotation index from %s (t=%.2fs)' % (index_dir, time.time() - start))
+            return index, coco
+
+        if coco is None:
+            # Do this here because we have too many things named COCO
+            from pycocotools.coco import COCO
+            coco = COCO(info_file)
+
+        index = AnnotationIndex.from_coco(coco)
+
+        try:
+            index.save(index_dir, {'version': INDEX_VERSION, 'info_file': osp.abspath(info_file),
+                                   'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1_file(info_file)})
+            print('Saved annotation index to %s' % index_dir)
+
+            # Map the saved copy instead so dataloader workers don't each get their own
+            index = AnnotationIndex.load(index_dir)
+        except OSError as e:
+            print('Warning: Couldn\'t save the annotation index to %s (%s), so it\'ll be rebuilt next time.' % (index_dir, e))
+
+        return index, coco
+
+    def __len__(self):
+        return self.image_ids.shape[0]
+
+    def row(self, img_id) -> int:
+        """ Returns the row of this image id in the index. """
+        row = int(np.searchsorted(self.image_ids, img_id))
+        if row >= len(self) or self.image_ids[row] != img_id:
+            raise KeyError('Image id %s is not in the annotation file.' % img_id)
+        return row
+
+    def rows(self, img_ids) -> np.ndarray:
+        """ Same as row, but for a whole list of image ids at once. """
+        return np.array([self.row(img_id) for img_id in img_ids], dtype=np.int64)
+
+    def ann_range(self, row:int) -> tuple:
+        """ Returns the (start, end) of the annotations of the image at row. """
+        return int(self.ann_offsets[row]), int(self.ann_offsets[row+1])
+
+    def segmentation(self, ann:int):
+        """ Returns annotation ann's segmentation like it was in the annotation file, but with polygons as arrays and RLEs compressed. """
+        rle_start, rle_end = int(self.rle_offsets[ann]), int(self.rle_offsets[ann+1])
+
+        if rle_end > rle_start:
+            height, width = [int(x) for x in self.image_sizes[self._ann_row(ann)]]
+            return {'size': [height, width], 'counts': self.rle_counts[rle_start:rle_end].tobytes()}
+
+        seg_start, seg_end = int(self.seg_offsets[ann]), int(self.seg_offsets[ann+1])
+        return [self.poly_coords[self.poly_offsets[p]:self.poly_offsets[p+1]] for p in range(seg_start, seg_end)]
+
+    def rle(self, ann:int, height:int, width:int) -> dict:
+        """ The same thing annToRLE gives for this annotation. """
+        segm = self.segmentation(ann)
+
+        if isinstance(segm, list):
+            return maskUtils.merge(maskUtils.frPyObjects(segm, height, width))
+        return segm
+
+    def _ann_row(self, ann:int) -> int:
+        return int(np.searchsorted(self.ann_offsets, ann, side='right')) - 1
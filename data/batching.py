@@ -0,0 +1,223 @@
+"""
+Batching for preserve_aspect_ratio training.
+
+With preserve_aspect_ratio, every image comes out of the augmentations at a different size, so
+prepare_data used to pick one image's size and interpolate and pad the rest of the batch to match
+(see enforce_size). That squishes everything that doesn't have the same aspect ratio.
+
+Instead, AspectRatioBatchSampler puts images with similar aspect ratios in the same batch and
+PaddedCollate pads each batch only up to its biggest image, without resizing anything.
+
+This also has packed_collate, which packs a batch into a few big tensors (see PackedBatch) instead of
+a list of little ones per sample, so the batch is cheap to send from the workers and to the gpu.
+"""
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from .config import cfg, MEANS
+from .coco import detection_collate
+
+
+class AspectRatioBatchSampler(data.Sampler):
+    """
+    Splits the dataset into num_buckets buckets of about the same size by aspect ratio and then makes
+    batches out of each bucket. Whatever's left over in each bucket gets batched together at the end.
+    Every epoch shuffles both the images within each bucket and the order of the batches.
+
+    Note that RandomSampleCrop can still change the aspect ratio a bit (between 1:2 and 2:1), so this
+    only gets batches close to the same shape. PaddedCollate takes care of the rest.
+    """
+
+    def __init__(self, dataset, batch_size:int, num_buckets:int=8, drop_last:bool=True):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.num_samples = len(dataset)
+
+        sizes = np.array([dataset.image_size(idx) for idx in range(len(dataset))], dtype=np.float64).reshape(-1, 2)
+        log_ars = np.log(sizes[:, 1] / sizes[:, 0])
+
+        # Quantiles so that each bucket has about the same number of images
+        edges = np.quantile(log_ars, np.linspace(0, 1, num_buckets + 1)[1:-1]) if len(log_ars) > 0 else []
+        self.buckets = np.searchsorted(edges, log_ars, side='right')
+        self.num_buckets = num_buckets
+
+    def __iter__(self):
+        batches = []
+        leftovers = []
+
+        for bucket in range(self.num_buckets):
+            idx = np.random.permutation(np.nonzero(self.buckets == bucket)[0])
+            num_full = len(idx) // self.batch_size * self.batch_size
+
+            batches += [idx[i:i+self.batch_size] for i in range(0, num_full, self.batch_size)]
+            leftovers.append(idx[num_full:])
+
+        # These are still in bucket order, so each of these batches at least has neighboring aspect ratios
+        leftovers = np.concatenate(leftovers)
+        batches += [leftovers[i:i+self.batch_size] for i in range(0, len(leftovers), self.batch_size)]
+
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+
+        for batch_idx in np.random.permutation(len(batches)):
+            yield batches[batch_idx].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+def _new_tensor(shape:tuple, dtype) -> torch.Tensor:
+    """
+    torch.empty, except in a dataloader worker this moves it to shared memory before it's filled in.
+    Otherwise, sending the filled in batch to the main process would copy it into shared memory then.
+    """
+    out = torch.empty(shape, dtype=dtype)
+    if data.get_worker_info() is not None:
+        out.share_memory_()
+    return out
+
+
+class PackedBatch:
+    """
+    A batch packed into a few contiguous tensors by packed_collate:
+        - images     [batch_size, 3, h, w]
+        - targets    [num_objs, 5]:    Every sample's targets, one after the other.
+        - masks      [num_objs, h, w]: Every sample's masks (uint8), one after the other.
+        - offsets    [batch_size + 1]: Sample i owns targets[offsets[i]:offsets[i+1]] (and the same masks).
+        - num_crowds [batch_size]
+    
+    The dataloader pins all of these (see pin_memory), and to_devices moves them with one non blocking
+    copy per tensor per device instead of one per sample.
+    """
+
+    def __init__(self, images, targets, masks, offsets, num_crowds):
+        self.images = images
+        self.targets = targets
+        self.masks = masks
+        self.offsets = offsets
+        self.num_crowds = num_crowds
+
+    def __len__(self):
+        return self.images.size(0)
+
+    def pin_memory(self):
+        """ The dataloader calls this on its pin memory thread if pin_memory=True. """
+        self.images = self.images.pin_memory()
+        self.targets = self.targets.pin_memory()
+        self.masks = self.masks.pin_memory()
+        self.offsets = self.offsets.pin_memory()
+        self.num_crowds = self.num_crowds.pin_memory()
+        return self
+
+    def to_devices(self, devices:list, allocation:list):
+        """
+        Sends allocation[i] samples to devices[i] and unpacks the batch into the (images, (targets, masks, num_crowds))
+        lists that detection_collate would have made, except each list element is already on its device and masks are float.
+        """
+        images, targets, masks = [], [], []
+        start = 0
+
+        for device, alloc in zip(devices, allocation):
+            end = start + alloc
+            obj_start, obj_end = int(self.offsets[start]), int(self.offsets[end])
+            counts = (self.offsets[start+1:end+1] - self.offsets[start:end]).tolist()
+
+            images  += list(self.images[start:end].to(device, non_blocking=True))
+            targets += list(self.targets[obj_start:obj_end].to(device, non_blocking=True).split(counts))
+            masks   += list(self.masks[obj_start:obj_end].to(device, non_blocking=True).float().split(counts))
+
+            start = end
+
+        return images, (targets, masks, self.num_crowds.tolist())
+
+
+def packed_collate(batch) -> PackedBatch:
+    """ Like detection_collate, but packs the batch into a PackedBatch. Every image in the batch has to be the same size. """
+    num_objs = [np.asarray(sample[1][0]).shape[0] for sample in batch]
+    offsets = torch.zeros(len(batch) + 1, dtype=torch.int64)
+    offsets[1:] = torch.tensor(num_objs, dtype=torch.int64).cumsum(0)
+
+    first_img = batch[0][0]
+    first_masks = np.asarray(batch[0][1][1])
+
+    images  = _new_tensor((len(batch),) + tuple(first_img.size()), first_img.dtype)
+    targets = _new_tensor((int(offsets[-1]), 5), torch.float32)
+    masks   = _new_tensor((int(offsets[-1]),) + first_masks.shape[1:], torch.from_numpy(first_masks[:0]).dtype)
+
+    for idx, (img, (target, sample_masks, _)) in enumerate(batch):
+        start, end = int(offsets[idx]), int(offsets[idx+1])
+
+        images[idx] = img
+        targets[start:end] = torch.from_numpy(np.asarray(target, dtype=np.float32))
+        masks[start:end] = torch.from_numpy(np.ascontiguousarray(sample_masks))
+
+    num_crowds = torch.tensor([sample[1][2] for sample in batch], dtype=torch.int64)
+    return PackedBatch(images, targets, masks, offsets, num_crowds)
+
+
+class PaddedCollate:
+    """
+    Same as detection_collate, but first pads every image (and its masks) in the batch with zeros on the
+    bottom and right up to the biggest height and width in the batch. Boxes are rescaled to match.
+
+    If stats (a LoaderStats) is given, this adds how many of the batch's pixels were padding to it.
+    After padding, the batch goes through collate (e.g., packed_collate).
+    """
+
+    def __init__(self, stats=None, collate=detection_collate):
+        self.stats = stats
+        self.collate = collate
+
+    @staticmethod
+    def pad_value() -> torch.Tensor:
+        """ What Pad fills images with (the mean), after it's gone through BackboneTransform. One value per channel. """
+        transform = cfg.backbone.transform
+        mean = torch.tensor(MEANS, dtype=torch.float32)
+
+        if transform.normalize or transform.subtract_means:
+            value = torch.zeros(3)
+        elif transform.to_float:
+            value = mean / 255
+        else:
+            value = mean
+
+        return value[['BGR'.index(c) for c in transform.channel_order]]
+
+    def __call__(self, batch):
+        max_h = max([sample[0].size(1) for sample in batch])
+        max_w = max([sample[0].size(2) for sample in batch])
+        pad_value = self.pad_value()
+        padded_pixels = 0
+        out = []
+
+        for img, (target, masks, num_crowds) in batch:
+            _, h, w = img.size()
+
+            if h != max_h or w != max_w:
+                # Fill with the same thing Pad would have
+                padded = pad_value.to(img.dtype)[:, None, None].repeat(1, max_h, max_w)
+                padded[:, :h, :w] = img
+                img = padded
+
+                # If use_gt_bboxes is on, the masks have already been cropped to their boxes, so leave them be
+                if masks is not None and masks.ndim == 3:
+                    masks = np.pad(masks, ((0, 0), (0, max_h - h), (0, max_w - w)), mode='constant')
+
+                # The boxes are relative to the image, so make them relative to the padded image
+                target = np.array(target, dtype=np.float64)
+                target[:, [0, 2]] *= w / max_w
+                target[:, [1, 3]] *= h / max_h
+
+                padded_pixels += max_h * max_w - h * w
+
+            out.append((img, (target, masks, num_crowds)))
+
+        if self.stats is not None:
+            self.stats.add('padded_pixels', padded_pixels)
+            self.stats.add('batch_pixels', len(batch) * max_h * max_w)
+
+        return self.collate(out)
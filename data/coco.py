@@ -1,15 +1,29 @@
 import os
 import os.path as osp
 import sys
+import time
 import torch
 import torch.utils.data as data
 import torch.nn.functional as F
 import cv2
 import numpy as np
 from .config import cfg
+from .gt_cache import GTCache
+from .lazy_masks import LazyMasks
+from .ann_index import AnnotationIndex
+from .loader_stats import LoaderStats
+from .ram_cache import RAMCache
 from pycocotools import mask as maskUtils
 import random
 
+# The cv2.imread flag to use for each decode reduction
+_reduced_modes = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
 def get_label_map():
     if cfg.dataset.label_map is None:
         return {x+1: x+1 for x in range(len(cfg.dataset.class_names))}
@@ -23,6 +37,11 @@ class COCOAnnotationTransform(object):
     def __init__(self):
         self.label_map = get_label_map()
 
+        # So that from_arrays can look up every label at once. Anything not in the label map is -2.
+        self.label_lut = np.full(max(self.label_map.keys()) + 1, -2, dtype=np.int64)
+        for k, v in self.label_map.items():
+            self.label_lut[k] = v - 1
+
     def __call__(self, target, width, height):
         """
         Args:
@@ -48,6 +67,26 @@ class COCOAnnotationTransform(object):
 
         return res
 
+    def from_arrays(self, boxes, category_ids, iscrowd, width, height):
+        """
+        Same as __call__, but for the [num_objs, 4] COCO boxes, category ids and crowd flags from an AnnotationIndex.
+        Returns a [num_objs, 5] array of [xmin, ymin, xmax, ymax, label_idx] where crowds have label -1.
+        """
+        scale = np.array([width, height, width, height], dtype=np.float64)
+        res = np.empty((boxes.shape[0], 5), dtype=np.float64)
+
+        res[:, :2] = boxes[:, :2]
+        res[:, 2:4] = boxes[:, :2] + boxes[:, 2:]
+        res[:, :4] /= scale
+
+        labels = self.label_lut[np.clip(category_ids, 0, self.label_lut.shape[0] - 1)]
+        labels[category_ids >= self.label_lut.shape[0]] = -2
+        if (labels[~iscrowd] == -2).any():
+            raise KeyError('Category id %s is not in the label map.' % category_ids[~iscrowd][labels[~iscrowd] == -2][0])
+
+        res[:, 4] = np.where(iscrowd, -1, labels)
+        return res
+
 
 class COCODetection(data.Dataset):
     """`MS Coco Detection <http://mscoco.org/dataset/#detections-challenge2016>`_ Dataset.
@@ -59,30 +98,101 @@ class COCODetection(data.Dataset):
         target_transform (callable, optional): A function/transform that takes
         in the target (bbox) and transforms it.
         prep_crowds (bool): Whether or not to prepare crowds for the evaluation step.
+        gt_cache_dir (string, optional): If set, build and read the ground truth from an
+                                         on-disk cache in this folder (see data/gt_cache.py).
+        skip_unusable (bool): Leave out images that augmentation could never make a training example
+                              out of (see usable_images). Use this for training, not evaluation.
+        ram_cache_size (int, optional): If set, keep up to this many bytes of decoded images and their
+                                        rasterized ground truth in memory, shared between dataloader
+                                        workers (see data/ram_cache.py). Good for small datasets.
     """
 
+    # If augmentation leaves an image with no ground truth, try augmenting it again this many times
+    # before giving up on it, and give up on this many images before erroring out.
+    max_augment_retries = 10
+    max_resamples = 10
+
     def __init__(self, image_path, info_file, transform=None,
                  target_transform=None,
-                 dataset_name='MS COCO', has_gt=True):
-        # Do this here because we have too many things named COCO
-        from pycocotools.coco import COCO
-        
+                 dataset_name='MS COCO', has_gt=True, gt_cache_dir=None, skip_unusable=False, ram_cache_size=None):
         if target_transform is None:
             target_transform = COCOAnnotationTransform()
 
         self.root = image_path
-        self.coco = COCO(info_file)
+        self.info_file = info_file
+
+        # If the sidecar index is up to date, this doesn't need to load the annotation file at all.
+        # In that case, self.coco gets built the first time something asks for it.
+        self.index, self._coco = AnnotationIndex.load_or_build(info_file)
         
-        self.ids = list(self.coco.imgToAnns.keys())
+        self.ids = self.index.image_ids[self.index.annotated].tolist()
         if len(self.ids) == 0 or not has_gt:
-            self.ids = list(self.coco.imgs.keys())
+            self.ids = self.index.image_ids[self.index.image_order].tolist()
+
+        # The row in self.index of each entry in self.ids
+        self.rows = self.index.rows(self.ids)
         
+        self._init_state(transform, dataset_name, has_gt)
+
+        if gt_cache_dir is not None and has_gt:
+            self.gt_cache = GTCache.load_or_build(self, info_file, gt_cache_dir)
+
+        if skip_unusable and has_gt:
+            self.skip_unusable()
+
+        # Keyed by row in self.index, so this doesn't care what skip_unusable did to self.ids
+        if ram_cache_size:
+            # The fields are (img, target, masks, num_crowds), see load_sample
+            self.ram_cache = RAMCache(len(self.index), ram_cache_size, [np.uint8, np.float64, np.uint8, np.int64])
+
+    def _init_state(self, transform, dataset_name, has_gt):
+        """
+        Sets up everything that doesn't depend on where the samples come from. Subclasses that don't call
+        __init__ (e.g., COCOShardDataset) call this instead, so new attributes should go here.
+        """
         self.transform = transform
         self.target_transform = COCOAnnotationTransform()
         
         self.name = dataset_name
         self.has_gt = has_gt
 
+        self.gt_cache = None
+        self.ram_cache = None
+        self.stats = LoaderStats()
+
+    def usable_images(self):
+        """
+        Returns whether each image in self.ids has at least one annotation that isn't a crowd and has a nonzero box.
+        If not, augmentation can never make a training example out of it, so it'd just get resampled every time.
+        """
+        valid = ~self.index.iscrowd & (self.index.boxes[:, 2] > 0) & (self.index.boxes[:, 3] > 0)
+        valid_before = np.concatenate([[0], np.cumsum(valid)])
+
+        num_valid = valid_before[self.index.ann_offsets[1:]] - valid_before[self.index.ann_offsets[:-1]]
+        return num_valid[self.rows] > 0
+
+    def skip_unusable(self):
+        """ Drops every image that usable_images says is no good. """
+        usable = self.usable_images()
+
+        if not usable.all():
+            print('Skipping %d of %d images with no usable annotations.' % ((~usable).sum(), len(self.ids)))
+            self.ids  = [img_id for img_id, keep in zip(self.ids, usable) if keep]
+            self.rows = self.rows[usable]
+
+    @property
+    def coco(self):
+        """ The pycocotools COCO object for the annotation file, which is only loaded if something needs it. """
+        if self._coco is None and self.info_file is not None:
+            # Do this here because we have too many things named COCO
+            from pycocotools.coco import COCO
+            self._coco = COCO(self.info_file)
+        return self._coco
+
+    @coco.setter
+    def coco(self, coco):
+        self._coco = coco
+
     def __getitem__(self, index):
         """
         Args:
@@ -106,33 +216,119 @@ class COCODetection(data.Dataset):
                    target is the object returned by ``coco.loadAnns``.
             Note that if no crowd annotations exist, crowd will be None
         """
-        img_id = self.ids[index]
+        start_time = time.perf_counter()
 
-        if self.has_gt:
-            ann_ids = self.coco.getAnnIds(imgIds=img_id)
+        for _ in range(self.max_resamples + 1):
+            sample_start = time.perf_counter()
+            img, target, masks, num_crowds = self.load_sample(index)
+            height, width, _ = img.shape
 
-            # Target has {'segmentation', 'area', iscrowd', 'image_id', 'bbox', 'category_id'}
-            target = [x for x in self.coco.loadAnns(ann_ids) if x['image_id'] == img_id]
-        else:
-            target = []
+            if self.transform is None:
+                return torch.from_numpy(img).permute(2, 0, 1), target, masks, height, width, num_crowds
 
-        # Separate out crowd annotations. These are annotations that signify a large crowd of
-        # objects of said class, where there is no annotation for each individual object. Both
-        # during testing and training, consider these crowds as neutral.
-        crowd  = [x for x in target if     ('iscrowd' in x and x['iscrowd'])]
-        target = [x for x in target if not ('iscrowd' in x and x['iscrowd'])]
-        num_crowds = len(crowd)
+            if len(target) == 0:
+                img, _, _, _ = self.transform(img, np.zeros((1, height, width), dtype=np.uint8), np.array([[0, 0, 1, 1]]),
+                    {'num_crowds': 0, 'labels': np.array([0])})
+                return torch.from_numpy(img).permute(2, 0, 1), None, None, height, width, num_crowds
 
-        for x in crowd:
-            x['category_id'] = -1
+            target = np.array(target)
+            decode_time = time.perf_counter()
 
-        # This is so we ensure that all crowd annotations are at the end of the array
-        target += crowd
-        
+            # Only redo the augmentation (and not the decode) if it leaves us with no ground truth
+            for _ in range(self.max_augment_retries + 1):
+                attempt_time = time.perf_counter()
+
+                # The transforms modify boxes and labels in place, so give them a fresh copy each time
+                out_img, out_masks, boxes, labels = self.transform(img, masks, target[:, :4].copy(),
+                    {'num_crowds': num_crowds, 'labels': target[:, 4].copy()})
+
+                if boxes.shape[0] > 0:
+                    self.stats.add('samples')
+                    self.stats.add('total_time', time.perf_counter() - start_time)
+
+                    # I stored num_crowds in labels so I didn't have to modify the entirety of augmentations
+                    out_target = np.hstack((boxes, np.expand_dims(labels['labels'], axis=1)))
+                    return torch.from_numpy(out_img).permute(2, 0, 1), out_target, out_masks, height, width, labels['num_crowds']
+
+                self.stats.add('augment_retries')
+                self.stats.add('wasted_time', time.perf_counter() - attempt_time)
+
+            # Augmentation can't seem to do anything with this image, so give up on it and try another one
+            self.stats.add('resamples')
+            self.stats.add('wasted_time', decode_time - sample_start)
+            index = random.randint(0, len(self.ids)-1)
+
+        raise RuntimeError('Augmentation output examples with no ground truth for %d images in a row. '
+                           'Check the annotations (or use skip_unusable).' % (self.max_resamples + 1))
+
+    def load_sample(self, index):
+        """
+        Decodes the image at index and gets its ground truth, or gets both from self.ram_cache if they're there.
+        Returns (img, target, masks, num_crowds), where the last 3 are what pull_gt returns.
+        """
+        if self.ram_cache is not None:
+            sample = self.ram_cache.get(int(self.rows[index]))
+
+            if sample is not None:
+                self.stats.add('cache_hits')
+                img, target, masks, num_crowds = sample
+                return img, target, masks, int(num_crowds)
+            self.stats.add('cache_misses')
+
+        reduce = self.decode_reduction(index)
+        img = self.load_image(index, reduce=reduce)
+        height, width, _ = img.shape
+
+        # If we decoded at a smaller size, the annotations need to be scaled down to match
+        orig_size = self.image_size(index) if reduce > 1 else None
+        orig_size = orig_size if orig_size != (height, width) else None
+
+        # If the transform can deal with LazyMasks, let it rasterize the masks once they're at their final size.
+        # That's not worth it if they're getting cached though, since then they only get rasterized once anyway.
+        lazy = getattr(self.transform, 'lazy_masks', False) and self.ram_cache is None
+        target, masks, num_crowds = self.pull_gt(self.ids[index], height, width, lazy=lazy, orig_size=orig_size)
+
+        if self.ram_cache is not None:
+            cached_target = target if len(target) > 0 else np.zeros((0, 5))
+            self.ram_cache.put(int(self.rows[index]), (img, cached_target, masks, np.array(num_crowds)))
+
+        return img, target, masks, num_crowds
+
+    def decode_reduction(self, index):
+        """
+        Returns how much smaller (1, 2, 4 or 8) we can decode the image at index without the transform noticing.
+        This only does anything if the transform has min_decode_side (i.e., SSDAugmentation), there's no gt cache, and the image is a jpeg.
+        """
+        if not cfg.reduced_decode or not hasattr(self.transform, 'min_decode_side'):
+            return 1
+
+        # The gt cache only has full size masks, and pull_gt returns those as is
+        if self.gt_cache is not None:
+            return 1
+
+        if not str(self.index.file_names[self.rows[index]]).lower().endswith(('.jpg', '.jpeg')):
+            return 1
+
+        height, width = self.image_size(index)
+        min_side = self.transform.min_decode_side(width, height)
+
+        for reduce in (8, 4, 2):
+            if min(height, width) / reduce >= min_side:
+                return reduce
+        return 1
+
+    def load_image(self, index, reduce=1):
+        """
+        Args:
+            index (int): Index
+            reduce (int): 1, 2, 4 or 8. Decode the image this many times smaller (jpegs can do this for cheap).
+        Returns:
+            The image at index as a [height, width, 3] BGR uint8 array.
+        """
         # The split here is to have compatibility with both COCO2014 and 2017 annotations.
         # In 2014, images have the pattern COCO_{train/val}2014_%012d.jpg, while in 2017 it's %012d.jpg.
         # Our script downloads the images as %012d.jpg so convert accordingly.
-        file_name = self.coco.loadImgs(img_id)[0]['file_name']
+        file_name = str(self.index.file_names[self.rows[index]])
         
         if file_name.startswith('COCO'):
             file_name = file_name.split('_')[-1]
@@ -140,40 +336,87 @@ class COCODetection(data.Dataset):
         path = osp.join(self.root, file_name)
         assert osp.exists(path), 'Image path does not exist: {}'.format(path)
         
-        img = cv2.imread(path)
-        height, width, _ = img.shape
-        
-        if len(target) > 0:
-            # Pool all the masks for this image into one [num_objects,height,width] matrix
-            masks = [self.coco.annToMask(obj).reshape(-1) for obj in target]
-            masks = np.vstack(masks)
-            masks = masks.reshape(-1, height, width)
-
-        if self.target_transform is not None and len(target) > 0:
-            target = self.target_transform(target, width, height)
-
-        if self.transform is not None:
-            if len(target) > 0:
-                target = np.array(target)
-                img, masks, boxes, labels = self.transform(img, masks, target[:, :4],
-                    {'num_crowds': num_crowds, 'labels': target[:, 4]})
-            
-                # I stored num_crowds in labels so I didn't have to modify the entirety of augmentations
-                num_crowds = labels['num_crowds']
-                labels     = labels['labels']
-                
-                target = np.hstack((boxes, np.expand_dims(labels, axis=1)))
-            else:
-                img, _, _, _ = self.transform(img, np.zeros((1, height, width), dtype=np.float), np.array([[0, 0, 1, 1]]),
-                    {'num_crowds': 0, 'labels': np.array([0])})
-                masks = None
-                target = None
+        return cv2.imread(path, _reduced_modes[reduce])
+
+    def image_size(self, index):
+        """ Returns the (height, width) of the image at index without loading it. """
+        height, width = self.index.image_sizes[self.rows[index]]
+        return int(height), int(width)
+
+    def load_target(self, img_id):
+        """
+        Args:
+            img_id (int): The COCO id of the image
+        Returns:
+            tuple: Tuple (target, num_crowds).
+                   target is the list of annotations for this image with crowds at the end.
+        """
+        ann_ids = self.coco.getAnnIds(imgIds=img_id)
+
+        # Target has {'segmentation', 'area', iscrowd', 'image_id', 'bbox', 'category_id'}
+        target = [x for x in self.coco.loadAnns(ann_ids) if x['image_id'] == img_id]
 
-        if target.shape[0] == 0:
-            print('Warning: Augmentation output an example with no ground truth. Resampling...')
-            return self.pull_item(random.randint(0, len(self.ids)-1))
+        # Separate out crowd annotations. These are annotations that signify a large crowd of
+        # objects of said class, where there is no annotation for each individual object. Both
+        # during testing and training, consider these crowds as neutral.
+        crowd  = [x for x in target if     ('iscrowd' in x and x['iscrowd'])]
+        target = [x for x in target if not ('iscrowd' in x and x['iscrowd'])]
+        num_crowds = len(crowd)
 
-        return torch.from_numpy(img).permute(2, 0, 1), target, masks, height, width, num_crowds
+        # Copy these so we don't change the annotations in self.coco
+        crowd = [dict(x, category_id=-1) for x in crowd]
+
+        # This is so we ensure that all crowd annotations are at the end of the array
+        target += crowd
+
+        return target, num_crowds
+
+    def pull_gt(self, img_id, height, width, lazy=False, orig_size=None):
+        """
+        Args:
+            img_id (int): The COCO id of the image
+            height (int): The height of the image
+            width (int): The width of the image
+            lazy (bool): If True, return the masks as LazyMasks instead of rasterizing them here.
+            orig_size (tuple): If the image was decoded smaller than it is in the annotation file,
+                               its (height, width) in the annotation file. The masks get scaled to match.
+        Returns:
+            tuple: Tuple (target, masks, num_crowds).
+                   target is a list of [xmin, ymin, xmax, ymax, label_idx] in relative coordinates
+                   and masks is a [num_objs, height, width] array (or None if there are no objects).
+        """
+        if not self.has_gt:
+            return [], None, 0
+
+        if self.gt_cache is not None:
+            return self.gt_cache.get(img_id)
+
+        row = self.index.row(img_id)
+        start, end = self.index.ann_range(row)
+        num_crowds = int(self.index.num_crowds[row])
+
+        if end == start:
+            return [], None, 0
+
+        if orig_size is not None:
+            # Draw the masks straight at the decoded size instead of rasterizing at full size and resizing
+            masks = LazyMasks([self.index.segmentation(j) for j in range(start, end)], *orig_size).resize(width, height)
+            masks = masks if lazy else masks.rasterize()
+
+            # The boxes are in the annotation file's coordinates
+            height, width = orig_size
+        elif lazy:
+            masks = LazyMasks([self.index.segmentation(j) for j in range(start, end)], height, width)
+        else:
+            # Pool all the masks for this image into one [num_objects,height,width] matrix.
+            # decode gives us [h, w, num_objs] in fortran order.
+            masks = maskUtils.decode([self.index.rle(j, height, width) for j in range(start, end)])
+            masks = np.ascontiguousarray(masks.transpose(2, 0, 1))
+
+        target = self.target_transform.from_arrays(self.index.boxes[start:end], self.index.category_ids[start:end],
+                                                   self.index.iscrowd[start:end], width, height)
+
+        return target, masks, num_crowds
 
     def pull_image(self, index):
         '''Returns the original image object at index in PIL form
@@ -186,8 +429,7 @@ class COCODetection(data.Dataset):
         Return:
             cv2 img
         '''
-        img_id = self.ids[index]
-        path = self.coco.loadImgs(img_id)[0]['file_name']
+        path = str(self.index.file_names[self.rows[index]])
         return cv2.imread(osp.join(self.root, path), cv2.IMREAD_COLOR)
 
     def pull_anno(self, index):
@@ -269,6 +511,10 @@ def detection_collate(batch):
             1) (tensor) batch of images stacked on their 0 dim
             2) (list<tensor>, list<tensor>, list<int>) annotations for a given image are stacked
                 on 0 dim. The output gt is a tuple of annotations and masks.
+
+    Note that the masks keep whatever dtype the dataset gave them (uint8 usually). Full size masks are
+    the biggest thing going from the workers to the main process, so prepare_data converts them to
+    float once they're on the gpu instead.
     """
     targets = []
     imgs = []
@@ -278,7 +524,7 @@ def detection_collate(batch):
     for sample in batch:
         imgs.append(sample[0])
         targets.append(torch.FloatTensor(sample[1][0]))
-        masks.append(torch.FloatTensor(sample[1][1]))
+        masks.append(torch.from_numpy(np.ascontiguousarray(sample[1][1])))
         num_crowds.append(sample[1][2])
 
     return imgs, (targets, masks, num_crowds)
@@ -513,6 +513,9 @@ coco_base_config = Config({
     # SSD data augmentation parameters
     # Randomize hue, vibrance, etc.
     'augment_photometric_distort': True,
+    # Do the photometric distortion on the uint8 image with lookup tables. This is much faster, but it's only an approximation
+    # of PhotometricDistort: it clips to [0, 255] along the way and quantizes hue to cv2's 2 degree steps.
+    'augment_photometric_lut': False,
     # Have a chance to scale down the image and pad (to emulate smaller detections)
     'augment_expand': True,
     # Potentialy sample a random crop from the image and put it in a random place
@@ -523,6 +526,9 @@ coco_base_config = Config({
     'augment_random_flip': False,
     # With uniform probability, rotate the image [0,90,180,270] degrees
     'augment_random_rot90': False,
+    # When training, decode jpegs at 1/2, 1/4 or 1/8 size if the augmentations would never use the extra resolution.
+    # This only kicks in for images that are a lot bigger than max_size (i.e., not COCO).
+    'reduced_decode': True,
 
     # Discard detections with width and height smaller than this (in absolute width and height)
     'discard_box_width': 4 / 550,
@@ -0,0 +1,172 @@
+"""
+An on-disk cache for the ground truth COCODetection builds out of an annotation file.
+
+Building ground truth means looking up every annotation, splitting out the crowds and
+rasterizing every polygon with annToMask, which is most of the time spent loading data
+during evaluation. This stores the result of all that (boxes and classes already run
+through the target transform, crowds at the end) with the masks as compressed RLE.
+
+Each array is its own .npy file so the whole cache can be memory mapped. The cache lives
+in a folder named after the hash of the annotation file, so it's rebuilt automatically
+whenever the annotations change.
+"""
+
+import os
+import os.path as osp
+import hashlib
+import shutil
+
+import numpy as np
+from pycocotools import mask as maskUtils
+
+# Bump this if the layout of the cache changes so old caches get rebuilt
+GT_CACHE_VERSION = 1
+
+
+def hash_file(path:str, extra:str='', chunk_size:int=1 << 20) -> str:
+    """ Returns the sha1 of the contents of the file at path (plus whatever's in extra). """
+    sha = hashlib.sha1()
+    sha.update(('v%d|%s|' % (GT_CACHE_VERSION, extra)).encode('utf-8'))
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+class GTCache:
+    """
+    Ground truth for every image in an annotation file, indexed by image id.
+    Use GTCache.load_or_build to get one for a dataset.
+
+    Layout (all arrays are memory mapped):
+        - image_ids   [num_images]:      Sorted image ids.
+        - image_sizes [num_images, 2]:   (height, width) that the masks were rasterized at.
+        - num_crowds  [num_images]:      The number of crowd annotations at the end of each image's targets.
+        - ann_offsets [num_images + 1]:  Image i owns targets[ann_offsets[i]:ann_offsets[i+1]].
+        - targets     [num_anns, 5]:     [xmin, ymin, xmax, ymax, label_idx] in relative coordinates.
+        - rle_offsets [num_anns + 1]:    Annotation j's RLE counts are rle_counts[rle_offsets[j]:rle_offsets[j+1]].
+        - rle_counts  [num_bytes]:       The compressed RLE counts strings of every mask, concatenated.
+    """
+
+    array_names = ('image_ids', 'image_sizes', 'num_crowds', 'ann_offsets', 'targets', 'rle_offsets', 'rle_counts')
+
+    def __init__(self, cache_dir:str):
+        self.cache_dir = cache_dir
+
+        for name in self.array_names:
+            setattr(self, name, np.load(osp.join(cache_dir, name + '.npy'), mmap_mode='r'))
+
+    def __getstate__(self):
+        # Don't pickle the mapped arrays into every dataloader worker, just open them again
+        return {'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+    def __len__(self):
+        return self.image_ids.shape[0]
+
+    def __contains__(self, img_id) -> bool:
+        idx = np.searchsorted(self.image_ids, img_id)
+        return idx < len(self) and self.image_ids[idx] == img_id
+
+    def get(self, img_id):
+        """
+        Returns the same (target, masks, num_crowds) that COCODetection.pull_gt would for this image.
+        Target is a [num_objs, 5] array and masks is a [num_objs, h, w] uint8 array (or None if empty).
+        """
+        idx = np.searchsorted(self.image_ids, img_id)
+        if idx >= len(self) or self.image_ids[idx] != img_id:
+            raise KeyError('Image id %s is not in the ground truth cache %s.' % (img_id, self.cache_dir))
+
+        start, end = int(self.ann_offsets[idx]), int(self.ann_offsets[idx+1])
+        num_crowds = int(self.num_crowds[idx])
+
+        # Copy out of the map since the transforms modify targets in place
+        target = np.array(self.targets[start:end])
+
+        if end == start:
+            return target, None, 0
+
+        height, width = [int(x) for x in self.image_sizes[idx]]
+        rles = [{'size': [height, width], 'counts': self.rle_counts[self.rle_offsets[j]:self.rle_offsets[j+1]].tobytes()}
+                for j in range(start, end)]
+
+        # decode gives us [h, w, num_objs] in fortran order
+        masks = np.ascontiguousarray(maskUtils.decode(rles).transpose(2, 0, 1))
+
+        return target, masks, num_crowds
+
+    @staticmethod
+    def build(dataset, cache_dir:str):
+        """ Builds the cache for every image in dataset.coco and saves it to cache_dir. """
+        coco = dataset.coco
+        image_ids = sorted(coco.imgs.keys())
+
+        image_sizes = np.zeros((len(image_ids), 2), dtype=np.int32)
+        num_crowds  = np.zeros(len(image_ids), dtype=np.int32)
+        ann_offsets = np.zeros(len(image_ids) + 1, dtype=np.int64)
+        targets = []
+        rle_counts = []
+
+        for idx, img_id in enumerate(image_ids):
+            info = coco.imgs[img_id]
+            height, width = info['height'], info['width']
+            target, num_crowd = dataset.load_target(img_id)
+
+            if len(target) > 0:
+                for obj in target:
+                    # Unlike annToMask, this doesn't rasterize anything
+                    counts = coco.annToRLE(obj)['counts']
+                    rle_counts.append(counts.encode('ascii') if isinstance(counts, str) else counts)
+
+                targets += dataset.target_transform(target, width, height)
+
+            image_sizes[idx] = (height, width)
+            num_crowds[idx]  = num_crowd
+            ann_offsets[idx+1] = ann_offsets[idx] + len(target)
+
+        rle_offsets = np.zeros(len(rle_counts) + 1, dtype=np.int64)
+        rle_offsets[1:] = np.cumsum([len(x) for x in rle_counts])
+
+        arrays = {
+            'image_ids':   np.array(image_ids, dtype=np.int64),
+            'image_sizes': image_sizes,
+            'num_crowds':  num_crowds,
+            'ann_offsets': ann_offsets,
+            'targets':     np.array(targets, dtype=np.float64).reshape(-1, 5),
+            'rle_offsets': rle_offsets,
+            'rle_counts':  np.frombuffer(b''.join(rle_counts), dtype=np.uint8),
+        }
+
+        # Write to a temporary folder first so an interrupted build never looks like a finished cache
+        tmp_dir = cache_dir + '.tmp%d' % os.getpid()
+        if osp.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        for name, arr in arrays.items():
+            np.save(osp.join(tmp_dir, name + '.npy'), arr)
+
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # Someone else finished building the same cache first, so just use theirs
+            shutil.rmtree(tmp_dir)
+            if not osp.exists(cache_dir):
+                raise
+
+    @staticmethod
+    def load_or_build(dataset, info_file:str, cache_root:str):
+        """ Returns the cache for this dataset's annotation file, building it under cache_root if it doesn't exist. """
+        label_map = sorted(dataset.target_transform.label_map.items())
+        cache_dir = osp.join(cache_root, hash_file(info_file, extra=repr(label_map)))
+
+        if not osp.exists(cache_dir):
+            print('Building ground truth cache in %s...' % cache_dir)
+            os.makedirs(cache_root, exist_ok=True)
+            GTCache.build(dataset, cache_dir)
+
+        return GTCache(cache_dir)
@@ -0,0 +1,118 @@
+"""
+GT masks that stay as polygons / RLE through the augmentations and get rasterized once at the end.
+
+annToMask rasterizes every object at the full size of the original image, and then the
+augmentations crop, flip, expand and finally resize all of those full size masks down to
+cfg.max_size. Instead, LazyMasks keeps the COCO segmentations around along with the 2d affine
+transform the augmentations have done to them so far and the size of the current canvas.
+rasterize then draws each object straight onto the final canvas.
+
+Polygons are drawn directly with the transform applied to their points. RLEs (mostly crowds) can't
+be moved around without decoding them, so those are decoded at the original size and warped once.
+"""
+
+import cv2
+import numpy as np
+from pycocotools import mask as maskUtils
+
+
+class LazyMasks:
+    """
+    A stand in for the [num_objs, height, width] mask array the augmentations usually work on.
+
+    Args:
+        segms (list): The COCO 'segmentation' of each object (polygons or RLE).
+        height (int): The height of the image the segmentations are for.
+        width (int):  The width of the image the segmentations are for.
+    """
+
+    def __init__(self, segms:list, height:int, width:int):
+        self.segms = segms
+        self.orig_height = height
+        self.orig_width = width
+
+        self.height = height
+        self.width = width
+
+        # Maps (x, y) in the original image to (x, y) in the current canvas
+        self.matrix = np.eye(3)
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.segms), self.height, self.width)
+
+    def __len__(self) -> int:
+        return len(self.segms)
+
+    def _copy(self, segms:list=None) -> 'LazyMasks':
+        out = LazyMasks(self.segms if segms is None else segms, self.orig_height, self.orig_width)
+        out.height, out.width = self.height, self.width
+        out.matrix = self.matrix.copy()
+        return out
+
+    def _transform(self, matrix:np.ndarray, height:int, width:int) -> 'LazyMasks':
+        out = self._copy()
+        out.matrix = matrix @ self.matrix
+        out.height, out.width = height, width
+        return out
+
+    def __getitem__(self, keep) -> 'LazyMasks':
+        """ Selects objects with a boolean or index array, like masks[keep] would. """
+        idx = np.arange(len(self.segms))[keep]
+        return self._copy([self.segms[i] for i in idx])
+
+    def crop(self, x1:int, y1:int, x2:int, y2:int) -> 'LazyMasks':
+        return self._transform(np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]], dtype=np.float64), y2 - y1, x2 - x1)
+
+    def expand(self, left:int, top:int, width:int, height:int) -> 'LazyMasks':
+        """ Puts the current canvas at (left, top) in a new [height, width] canvas. """
+        return self._transform(np.array([[1, 0, left], [0, 1, top], [0, 0, 1]], dtype=np.float64), height, width)
+
+    def pad(self, width:int, height:int) -> 'LazyMasks':
+        return self.expand(0, 0, width, height)
+
+    def mirror(self) -> 'LazyMasks':
+        return self._transform(np.array([[-1, 0, self.width], [0, 1, 0], [0, 0, 1]], dtype=np.float64), self.height, self.width)
+
+    def flip(self) -> 'LazyMasks':
+        return self._transform(np.array([[1, 0, 0], [0, -1, self.height], [0, 0, 1]], dtype=np.float64), self.height, self.width)
+
+    def rot90(self, k:int) -> 'LazyMasks':
+        """ Same as np.rot90(mask, k) on each mask. """
+        out = self
+        for _ in range(k % 4):
+            out = out._transform(np.array([[0, 1, 0], [-1, 0, out.width], [0, 0, 1]], dtype=np.float64), out.width, out.height)
+        return out
+
+    def resize(self, width:int, height:int) -> 'LazyMasks':
+        scale = np.array([[width / self.width, 0, 0], [0, height / self.height, 0], [0, 0, 1]], dtype=np.float64)
+        return self._transform(scale, height, width)
+
+    def _decode_rle(self, segm) -> np.ndarray:
+        """ Same as annToMask for an RLE segmentation. """
+        if isinstance(segm['counts'], list):
+            segm = maskUtils.frPyObjects(segm, self.orig_height, self.orig_width)
+        return maskUtils.decode(segm)
+
+    def rasterize(self) -> np.ndarray:
+        """ Draws every object onto the current canvas. Returns a [num_objs, height, width] uint8 array of 0s and 1s. """
+        masks = np.zeros((len(self.segms), self.height, self.width), dtype=np.uint8)
+
+        for idx, segm in enumerate(self.segms):
+            if isinstance(segm, list):
+                for poly in segm:
+                    pts = np.array(poly, dtype=np.float64).reshape(-1, 2)
+                    pts = pts @ self.matrix[:2, :2].T + self.matrix[:2, 2]
+
+                    # COCO points are on pixel edges while cv2 draws with pixel centers. The shift gives us 4 bits of subpixel accuracy.
+                    pts = np.round((pts - 0.5) * 16).astype(np.int32)
+                    cv2.fillPoly(masks[idx], [pts], 1, lineType=cv2.LINE_8, shift=4)
+            else:
+                # Move the transform from pixel edges to pixel centers for warpAffine
+                matrix = self.matrix[:2].copy()
+                matrix[:, 2] += matrix[:, :2].sum(axis=1) * 0.5 - 0.5
+
+                masks[idx] = cv2.warpAffine(self._decode_rle(segm), matrix, (self.width, self.height),
+                                            flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        return masks
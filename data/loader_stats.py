@@ -0,0 +1,54 @@
+"""
+Counters for how much work the data loader throws away (augmentations that come out empty, images
+that get resampled, etc.).
+
+Dataloader workers are separate processes, so the counters live in a shared memory tensor that
+every worker can write to. Each worker only ever writes its own row, so there are no races.
+"""
+
+import torch
+import torch.utils.data as data
+
+
+class LoaderStats:
+    """ See the top of this file. Use add in the dataset and totals / summary from the main process. """
+
+    names = ('samples', 'augment_retries', 'resamples', 'wasted_time', 'total_time', 'padded_pixels', 'batch_pixels',
+             'cache_hits', 'cache_misses')
+
+    def __init__(self, max_workers:int=64):
+        self.max_workers = max_workers
+        # Row 0 is for the main process, worker i gets row i+1
+        self.counts = torch.zeros(max_workers + 1, len(self.names), dtype=torch.float64).share_memory_()
+
+    def add(self, name:str, value:float=1):
+        info = data.get_worker_info()
+        row = 0 if info is None else info.id % self.max_workers + 1
+        self.counts[row, self.names.index(name)] += value
+
+    def totals(self) -> dict:
+        sums = self.counts.sum(dim=0).tolist()
+        return {name: val for name, val in zip(self.names, sums)}
+
+    def reset(self):
+        self.counts.zero_()
+
+    def summary(self) -> str:
+        totals = self.totals()
+        samples = max(totals['samples'], 1)
+        total_time = max(totals['total_time'], 1e-9)
+
+        out = ('Loader: %d samples | %.2f augmentation retries / sample | %.2f%% of samples resampled | %.1f%% of loader time wasted'
+               % (totals['samples'], totals['augment_retries'] / samples, totals['resamples'] / samples * 100,
+                  totals['wasted_time'] / total_time * 100))
+
+        # Only PaddedCollate fills these in
+        if totals['batch_pixels'] > 0:
+            out += ' | %.1f%% of batch pixels were padding' % (totals['padded_pixels'] / totals['batch_pixels'] * 100)
+
+        # And only the RAM cache fills these in
+        lookups = totals['cache_hits'] + totals['cache_misses']
+        if lookups > 0:
+            out += ' | %.1f%% RAM cache hits' % (totals['cache_hits'] / lookups * 100)
+
+        return out
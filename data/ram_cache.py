@@ -0,0 +1,197 @@
+"""
+An in-memory cache of decoded samples, shared between dataloader workers.
+
+For small datasets (e.g., crack_segmentation) everything fits in memory, but every epoch still reads
+and decodes every image and rasterizes every mask again. With this, COCODetection keeps what it decoded
+(the image plus its rasterized ground truth) in RAM, so every epoch after the first skips all of that.
+
+Dataloader workers are separate processes (and are started again every epoch), so the cache lives in
+shared memory that's allocated once in the main process:
+    - arena [capacity]:  The raw bytes of every cached entry. An entry is a fixed number of numpy arrays
+                         (the fields), each with a dtype set when the cache is made, laid out one after the other.
+    - table [num_keys]:  The offset, nbytes, last used time and pin count of each key's entry, and the shape of
+                         each of its fields. nbytes is -1 if the key isn't cached.
+    - clock [1]:         Goes up by one every time an entry is used, for the last used column.
+
+Since the fields are stored as raw arrays, a hit is just a copy out of the arena (there's nothing to unpickle).
+
+When a new entry doesn't fit anywhere in the arena, the least recently used entries get evicted until it does.
+The lock is only held to look up and update the table, not while copying. Instead, an entry's pin count says
+whether anyone's using it: readers add one while they copy out, and a writer sets it to -1 until it's done
+copying in. Pinned entries never get evicted, and entries that are still being written count as misses.
+"""
+
+import os
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+
+class RAMCache:
+    """
+    See the top of this file. Keys are ints in [0, num_keys), capacity is in bytes, and dtypes has
+    the dtype of each field. A field can be None, or an array with at most MAX_DIMS dimensions.
+    """
+
+    MAX_DIMS = 3
+
+    # The columns of the table. After these, each field gets its ndim (-1 for None) and then MAX_DIMS sizes.
+    OFFSET, NBYTES, LAST_USED, PINS = range(4)
+    NUM_HEADER_COLS = 4
+
+    def __init__(self, num_keys:int, capacity:int, dtypes:list):
+        self.capacity = int(capacity)
+        self.dtypes = [np.dtype(dtype) for dtype in dtypes]
+
+        self.check_shm(self.capacity)
+
+        num_cols = self.NUM_HEADER_COLS + len(self.dtypes) * (self.MAX_DIMS + 1)
+        self.arena = torch.empty(self.capacity, dtype=torch.uint8).share_memory_()
+        self.table = torch.full((num_keys, num_cols), -1, dtype=torch.int64).share_memory_()
+        self.clock = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.lock  = mp.Lock()
+
+    @staticmethod
+    def check_shm(nbytes:int, shm_path:str='/dev/shm'):
+        """
+        Shared tensors live in /dev/shm, and if that's too small (Docker only gives containers 64MB by
+        default) the workers die with a bus error when they touch the arena. So refuse up front instead.
+        """
+        if not os.path.isdir(shm_path):
+            return
+
+        stat = os.statvfs(shm_path)
+        free = stat.f_bavail * stat.f_frsize
+
+        if nbytes > free:
+            raise ValueError('The RAM cache needs %d MB of shared memory, but %s only has %d MB free. '
+                             'Use a smaller cache, or give it more room (e.g., docker run --shm-size).'
+                             % (nbytes >> 20, shm_path, free >> 20))
+
+    def _tick(self) -> int:
+        self.clock += 1
+        return int(self.clock)
+
+    def _layout(self, row:list) -> list:
+        """ Returns the (offset within the entry, nbytes, shape) of each field from its row in the table, with None for None. """
+        layout = []
+        pos = 0
+
+        for idx, dtype in enumerate(self.dtypes):
+            col = self.NUM_HEADER_COLS + idx * (self.MAX_DIMS + 1)
+            ndim = row[col]
+
+            if ndim < 0:
+                layout.append(None)
+                continue
+
+            shape = tuple(row[col+1:col+1+ndim])
+            nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            layout.append((pos, nbytes, shape))
+
+            # Keep every field 8 byte aligned
+            pos += (nbytes + 7) // 8 * 8
+
+        return layout
+
+    def get(self, key:int):
+        """ Returns a copy of the fields put under key, or None if it isn't cached. """
+        with self.lock:
+            row = self.table[key].tolist()
+            if row[self.NBYTES] < 0 or row[self.PINS] < 0:
+                return None
+
+            self.table[key, self.PINS] += 1
+            self.table[key, self.LAST_USED] = self._tick()
+
+        try:
+            arena = self.arena.numpy()
+            fields = []
+
+            for dtype, field in zip(self.dtypes, self._layout(row)):
+                if field is None:
+                    fields.append(None)
+                    continue
+
+                pos, nbytes, shape = field
+                start = row[self.OFFSET] + pos
+                fields.append(arena[start:start+nbytes].view(dtype).reshape(shape).copy())
+        finally:
+            with self.lock:
+                self.table[key, self.PINS] -= 1
+
+        return tuple(fields)
+
+    def put(self, key:int, fields:tuple) -> bool:
+        """ Caches fields (one array or None for each dtype) under key. Returns False if it doesn't fit. """
+        fields = [None if arr is None else np.ascontiguousarray(arr, dtype=dtype) for arr, dtype in zip(fields, self.dtypes)]
+
+        row = [-1] * self.table.size(1)
+        for idx, arr in enumerate(fields):
+            if arr is not None:
+                col = self.NUM_HEADER_COLS + idx * (self.MAX_DIMS + 1)
+                row[col] = arr.ndim
+                row[col+1:col+1+arr.ndim] = arr.shape
+
+        layout = self._layout(row)
+        nbytes = max([pos + (size + 7) // 8 * 8 for pos, size, _ in filter(None, layout)] + [0])
+
+        if nbytes > self.capacity:
+            return False
+
+        with self.lock:
+            # Another worker might have gotten to this key first
+            if self.table[key, self.NBYTES] >= 0:
+                return True
+
+            offset = self._allocate(nbytes)
+            if offset is None:
+                return False
+
+            # Reserve the space, but keep it pinned so nobody reads or evicts it until it's written
+            row[self.OFFSET], row[self.NBYTES], row[self.LAST_USED], row[self.PINS] = offset, nbytes, self._tick(), -1
+            self.table[key] = torch.tensor(row, dtype=torch.int64)
+
+        arena = self.arena.numpy()
+        for arr, field in zip(fields, layout):
+            if field is not None:
+                pos, size, _ = field
+                arena[offset+pos:offset+pos+size] = arr.reshape(-1).view(np.uint8)
+
+        with self.lock:
+            self.table[key, self.PINS] = 0
+
+        return True
+
+    def _allocate(self, nbytes:int) -> int:
+        """
+        Returns the offset of the first gap in the arena that fits nbytes, evicting unpinned entries until
+        there is one. Returns None if there's still no room once everything that can be evicted is gone.
+        """
+        while True:
+            cached = torch.nonzero(self.table[:, self.NBYTES] >= 0).flatten()
+            entries = self.table[cached][:, [self.OFFSET, self.NBYTES]]
+            entries = entries[entries[:, 0].argsort()]
+
+            # The gaps are between the end of each entry (or the start of the arena) and the start of the next one
+            gap_starts = torch.cat([torch.zeros(1, dtype=torch.int64), entries[:, 0] + entries[:, 1]])
+            gap_ends   = torch.cat([entries[:, 0], torch.tensor([self.capacity], dtype=torch.int64)])
+            fits = torch.nonzero(gap_ends - gap_starts >= nbytes).flatten()
+
+            if fits.numel() > 0:
+                return int(gap_starts[fits[0]])
+
+            evictable = cached[self.table[cached, self.PINS] == 0]
+            if evictable.numel() == 0:
+                return None
+
+            lru = evictable[self.table[evictable, self.LAST_USED].argmin()]
+            self.table[lru, self.NBYTES] = -1
+
+    def num_cached(self) -> int:
+        return int((self.table[:, self.NBYTES] >= 0).sum())
+
+    def bytes_used(self) -> int:
+        nbytes = self.table[:, self.NBYTES]
+        return int(nbytes[nbytes >= 0].sum())
@@ -0,0 +1,86 @@
+import os
+import os.path as osp
+import sys
+import argparse
+from multiprocessing import Pool
+
+# So we can import the rest of the repo when this is run as python data/scripts/make_shards.py
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..', '..'))
+
+import numpy as np
+
+usage_text = """
+This script packs a COCO style dataset into memory mappable shards that COCOShardDataset can read
+(see data/shards.py). The images are decoded and the annotations are rasterized once here instead
+of every time a sample is loaded.
+
+Usage: python data/scripts/make_shards.py --config=yolact_base_config --split=valid --out_dir=data/shards/val
+
+Pass --max_side to shrink the images (and masks) so that their longest side is at most that. For
+training at 550, something like --max_side=800 leaves room for the augmentations to crop.
+"""
+
+_dataset = None
+_max_side = None
+
+def init_worker(dataset, max_side):
+	global _dataset, _max_side
+	_dataset = dataset
+	_max_side = max_side
+
+def load_sample(index):
+	from data.shards import shrink_to_max_side
+
+	img_id = _dataset.ids[index]
+	img = _dataset.load_image(index)
+	height, width, _ = img.shape
+
+	target, masks, num_crowds = _dataset.pull_gt(img_id, height, width)
+	img, masks = shrink_to_max_side(img, masks, _max_side)
+
+	return img_id, img, np.array(target), masks, num_crowds, (height, width)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=usage_text, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--config', default=None, type=str,
+						help='The config to take the dataset (and its label map) from.')
+	parser.add_argument('--dataset', default=None, type=str,
+						help='If specified, override the dataset specified in the config with this one (example: coco2017_dataset).')
+	parser.add_argument('--split', default='train', choices=['train', 'valid'],
+						help='Which of the dataset\'s image folder / annotation file pairs to pack.')
+	parser.add_argument('--out_dir', required=True, type=str,
+						help='The folder to write the shards to.')
+	parser.add_argument('--max_side', default=None, type=int,
+						help='If set, shrink images so that their longest side is at most this.')
+	parser.add_argument('--shard_size', default=1024, type=int,
+						help='Start a new shard file after this many MB.')
+	parser.add_argument('--num_workers', default=os.cpu_count(), type=int,
+						help='The number of processes decoding images.')
+	args = parser.parse_args()
+
+	from data import cfg, set_cfg, set_dataset, COCODetection
+	from data.shards import ShardWriter
+
+	if args.config is not None:
+		set_cfg(args.config)
+	if args.dataset is not None:
+		set_dataset(args.dataset)
+
+	image_path = cfg.dataset.train_images if args.split == 'train' else cfg.dataset.valid_images
+	info_file  = cfg.dataset.train_info   if args.split == 'train' else cfg.dataset.valid_info
+
+	dataset = COCODetection(image_path, info_file, transform=None, has_gt=cfg.dataset.has_gt)
+	writer = ShardWriter(args.out_dir, shard_bytes=args.shard_size << 20, max_side=args.max_side,
+	                     meta={'dataset': cfg.dataset.name, 'split': args.split, 'info_file': info_file})
+
+	print('Packing %d images into %s...' % (len(dataset), args.out_dir))
+
+	with Pool(max(args.num_workers, 1), initializer=init_worker, initargs=(dataset, args.max_side)) as pool:
+		for idx, (img_id, img, target, masks, num_crowds, orig_size) in enumerate(pool.imap(load_sample, range(len(dataset)), chunksize=16)):
+			writer.add(img_id, img, target, masks, num_crowds, orig_size=orig_size)
+
+			if (idx + 1) % 1000 == 0:
+				print('%d / %d' % (idx + 1, len(dataset)))
+
+	writer.close()
+	print('Done.')
@@ -0,0 +1,278 @@
+"""
+A pre-decoded, memory mapped version of a COCODetection dataset (see data/scripts/make_shards.py).
+
+pull_item on a COCODetection decodes a jpeg and rasterizes every annotation, every time. Shards
+store the result of all that instead: the decoded image (optionally shrunk so its longest side is
+at most max_side), the masks packed 8 pixels to a byte, and the targets already run through the
+target transform. Reading a sample is then just slicing a memory map and unpacking the masks.
+
+Layout of a shard folder (all the .npy files are memory mapped):
+    - meta.json:         Format version, max_side, and where the shards were made from.
+    - shard_%05d.bin:    Image and mask bytes of a bunch of samples back to back.
+    - image_ids   [N]:   The COCO id of each sample.
+    - shard_idx   [N]:   Which shard file each sample is in.
+    - img_offsets [N]:   Where the [height, width, 3] image starts in its shard.
+    - mask_offsets[N]:   Where the np.packbits'd [num_objs, height, width] masks start in its shard.
+    - sizes       [N, 2]: (height, width) of the stored image.
+    - orig_sizes  [N, 2]: (height, width) of the original image.
+    - num_crowds  [N]:   The number of crowd annotations at the end of each sample's targets.
+    - ann_offsets [N+1]: Sample i owns targets[ann_offsets[i]:ann_offsets[i+1]].
+    - targets     [M, 5]: [xmin, ymin, xmax, ymax, label_idx] in relative coordinates.
+
+Decoded images take a lot more disk than jpegs (~900KB for a 640x480 COCO image), so use max_side
+when you can. Since the targets are relative, shrinking the image doesn't change them.
+"""
+
+import os
+import os.path as osp
+import json
+
+import cv2
+import numpy as np
+
+from .coco import COCODetection
+
+SHARD_VERSION = 1
+
+_index_names = ('image_ids', 'shard_idx', 'img_offsets', 'mask_offsets', 'sizes', 'orig_sizes',
+                'num_crowds', 'ann_offsets', 'targets')
+
+
+def shrink_to_max_side(img:np.ndarray, masks:np.ndarray, max_side:int=None):
+    """ Resizes img and masks so that the longest side is at most max_side (if they're not already). """
+    h, w, _ = img.shape
+
+    if max_side is None or max(h, w) <= max_side:
+        return img, masks
+
+    scale = max_side / max(h, w)
+    size = (max(int(round(w * scale)), 1), max(int(round(h * scale)), 1))
+    img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    if masks is not None:
+        masks = np.stack([cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST) for mask in masks])
+
+    return img, masks
+
+
+class ShardWriter:
+    """ Writes samples out to a shard folder. Call add for each sample and then close. """
+
+    def __init__(self, out_dir:str, shard_bytes:int=1 << 30, max_side:int=None, meta:dict=None):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.max_side = max_side
+        self.meta = meta if meta is not None else {}
+
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.index = {name: [] for name in _index_names if name not in ('ann_offsets', 'targets')}
+        self.targets = []
+        self.ann_offsets = [0]
+
+        self.cur_shard = -1
+        self.cur_file = None
+        self.cur_bytes = 0
+
+    def _next_shard(self):
+        if self.cur_file is not None:
+            self.cur_file.close()
+
+        self.cur_shard += 1
+        self.cur_file = open(osp.join(self.out_dir, 'shard_%05d.bin' % self.cur_shard), 'wb')
+        self.cur_bytes = 0
+
+    def _write(self, arr:np.ndarray) -> int:
+        offset = self.cur_bytes
+        data = np.ascontiguousarray(arr).tobytes()
+        self.cur_file.write(data)
+        self.cur_bytes += len(data)
+        return offset
+
+    def add(self, img_id:int, img:np.ndarray, target:np.ndarray, masks:np.ndarray, num_crowds:int, orig_size:tuple=None):
+        """
+        Adds one sample. img is [h, w, 3] uint8, target is [num_objs, 5] in relative coordinates,
+        and masks is [num_objs, h, w] (or None if there's no gt). Everything gets resized here if need be.
+        If you already shrank the sample with shrink_to_max_side, pass the original (height, width) as orig_size.
+        """
+        orig_h, orig_w = orig_size if orig_size is not None else img.shape[:2]
+        img, masks = shrink_to_max_side(img, masks, self.max_side)
+        h, w, _ = img.shape
+        num_objs = 0 if masks is None else masks.shape[0]
+
+        if self.cur_file is None or self.cur_bytes >= self.shard_bytes:
+            self._next_shard()
+
+        self.index['image_ids'].append(img_id)
+        self.index['shard_idx'].append(self.cur_shard)
+        self.index['img_offsets'].append(self._write(img.astype(np.uint8)))
+        self.index['mask_offsets'].append(self._write(np.packbits(masks.astype(bool))) if num_objs > 0 else self.cur_bytes)
+        self.index['sizes'].append((h, w))
+        self.index['orig_sizes'].append((orig_h, orig_w))
+        self.index['num_crowds'].append(num_crowds)
+
+        if num_objs > 0:
+            self.targets.append(np.asarray(target, dtype=np.float32).reshape(-1, 5))
+        self.ann_offsets.append(self.ann_offsets[-1] + num_objs)
+
+    def close(self):
+        """ Finishes the last shard and writes out the index. """
+        if self.cur_file is not None:
+            self.cur_file.close()
+
+        arrays = {
+            'image_ids':    np.array(self.index['image_ids'], dtype=np.int64),
+            'shard_idx':    np.array(self.index['shard_idx'], dtype=np.int32),
+            'img_offsets':  np.array(self.index['img_offsets'], dtype=np.int64),
+            'mask_offsets': np.array(self.index['mask_offsets'], dtype=np.int64),
+            'sizes':        np.array(self.index['sizes'], dtype=np.int32).reshape(-1, 2),
+            'orig_sizes':   np.array(self.index['orig_sizes'], dtype=np.int32).reshape(-1, 2),
+            'num_crowds':   np.array(self.index['num_crowds'], dtype=np.int32),
+            'ann_offsets':  np.array(self.ann_offsets, dtype=np.int64),
+            'targets':      np.concatenate(self.targets) if len(self.targets) > 0 else np.zeros((0, 5), dtype=np.float32),
+        }
+
+        for name, arr in arrays.items():
+            np.save(osp.join(self.out_dir, name + '.npy'), arr)
+
+        meta = dict(self.meta, version=SHARD_VERSION, max_side=self.max_side, num_shards=self.cur_shard + 1,
+                    num_samples=len(self.index['image_ids']))
+        with open(osp.join(self.out_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+class COCOShardDataset(COCODetection):
+    """
+    Reads a shard folder written by ShardWriter. This is a drop in replacement for COCODetection
+    (same pull_item, same transforms), except there's no self.coco, so pull_anno gives the processed targets.
+
+    Args:
+        shard_dir (string): The folder the shards are in.
+        transform (callable, optional): A function/transform that augments the raw images.
+        has_gt (bool): Set this to False to ignore the gt in the shards.
+        skip_unusable (bool): Leave out samples with no usable gt (see COCODetection.usable_images).
+        report_orig_size (bool): If the shards were shrunk with max_side, have pull_item return the original
+                                 height and width, with the gt masks scaled back up to match. Use this for
+                                 evaluation (with BaseTransform), so the detections come out at the size
+                                 the annotation file has. Don't use it for training.
+    """
+
+    def __init__(self, shard_dir, transform=None, dataset_name='MS COCO', has_gt=True, skip_unusable=False, report_orig_size=False):
+        with open(osp.join(shard_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        if self.meta['version'] != SHARD_VERSION:
+            raise ValueError('The shards in %s are version %d, but this version of the code reads version %d. Remake them with data/scripts/make_shards.py.'
+                % (shard_dir, self.meta['version'], SHARD_VERSION))
+
+        # There's no annotation file to index, so this sets up the rest of COCODetection's state itself
+        self.root = shard_dir
+        self.info_file = None
+        self.coco = None
+        self._init_state(transform, dataset_name, has_gt)
+
+        # The shards are already decoded and memory mapped, so there's no gt cache or ram cache
+        self.report_orig_size = report_orig_size
+
+        self._open()
+
+        # The sample in the shards of each entry in self.ids
+        self.ids = self.image_ids.tolist()
+        self.rows = np.arange(len(self.ids))
+
+        if skip_unusable and has_gt:
+            self.skip_unusable()
+
+    def _open(self):
+        for name in _index_names:
+            setattr(self, name, np.load(osp.join(self.root, name + '.npy'), mmap_mode='r'))
+
+        self.positions = {img_id: idx for idx, img_id in enumerate(self.image_ids.tolist())}
+        # Each worker opens these as it needs them
+        self.shards = {}
+
+    def __getstate__(self):
+        # Don't pickle the maps into every dataloader worker, just open them again
+        return {k: v for k, v in self.__dict__.items() if k not in _index_names + ('positions', 'shards')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def _shard(self, shard_idx:int) -> np.ndarray:
+        if shard_idx not in self.shards:
+            self.shards[shard_idx] = np.memmap(osp.join(self.root, 'shard_%05d.bin' % shard_idx), dtype=np.uint8, mode='r')
+        return self.shards[shard_idx]
+
+    def usable_images(self):
+        labels = np.asarray(self.targets[:, 4])
+        valid = (labels >= 0) & (self.targets[:, 2] > self.targets[:, 0]) & (self.targets[:, 3] > self.targets[:, 1])
+        valid_before = np.concatenate([[0], np.cumsum(valid)])
+
+        num_valid = valid_before[self.ann_offsets[1:]] - valid_before[self.ann_offsets[:-1]]
+        return num_valid[self.rows] > 0
+
+    def pull_item(self, index):
+        img, target, masks, height, width, num_crowds = super().pull_item(index)
+
+        if self.report_orig_size:
+            orig_h, orig_w = [int(x) for x in self.orig_sizes[self.rows[index]]]
+
+            if (orig_h, orig_w) != (height, width):
+                # The targets are relative, so only the masks need to go back up to the original size.
+                # BaseTransform leaves the masks alone, so they're still the size they were stored at.
+                if masks is not None and masks.ndim == 3 and masks.shape[1:] == (height, width):
+                    masks = np.stack([cv2.resize(mask, (orig_w, orig_h), interpolation=cv2.INTER_NEAREST) for mask in masks])
+                height, width = orig_h, orig_w
+
+        return img, target, masks, height, width, num_crowds
+
+    def decode_reduction(self, index):
+        # These were decoded (and maybe shrunk) when the shards were made
+        return 1
+
+    def load_image(self, index, reduce=1):
+        row = self.rows[index]
+        h, w = [int(x) for x in self.sizes[row]]
+        start = int(self.img_offsets[row])
+        shard = self._shard(int(self.shard_idx[row]))
+
+        # Copy out of the map since the augmentations modify the image in place
+        return np.array(shard[start:start + h*w*3]).reshape(h, w, 3)
+
+    def image_size(self, index):
+        h, w = [int(x) for x in self.sizes[self.rows[index]]]
+        return h, w
+
+    def pull_gt(self, img_id, height, width, lazy=False, orig_size=None):
+        # The masks here are already rasterized, so lazy doesn't change anything
+        if not self.has_gt:
+            return [], None, 0
+
+        index = self.positions[img_id]
+        start, end = int(self.ann_offsets[index]), int(self.ann_offsets[index+1])
+
+        if end == start:
+            return [], None, 0
+
+        num_objs = end - start
+        num_bits = num_objs * height * width
+        offset = int(self.mask_offsets[index])
+        shard = self._shard(int(self.shard_idx[index]))
+
+        packed = shard[offset:offset + (num_bits + 7) // 8]
+        masks = np.unpackbits(packed, count=num_bits).reshape(num_objs, height, width)
+
+        return np.array(self.targets[start:end], dtype=np.float64), masks, int(self.num_crowds[index])
+
+    def pull_image(self, index):
+        return self.load_image(index)
+
+    def pull_anno(self, index):
+        """
+        Shards don't keep the original annotations, so this returns the processed targets instead:
+        a [num_objs, 5] array of [xmin, ymin, xmax, ymax, label_idx] in relative coordinates, crowds last.
+        """
+        row = self.rows[index]
+        start, end = int(self.ann_offsets[row]), int(self.ann_offsets[row+1])
+        return np.array(self.targets[start:end], dtype=np.float64)
@@ -1,17 +1,23 @@
-from data import COCODetection, get_label_map, MEANS, COLORS
+from data import COCODetection, COCOShardDataset, get_label_map, MEANS, COLORS
 from yolact import Yolact
 from utils.augmentations import BaseTransform, FastBaseTransform, Resize
 from utils.functions import MovingAverage, ProgressBar
 from layers.box_utils import jaccard, center_size, mask_iou
 from utils import timer
 from utils.functions import SavePath
-from layers.output_utils import postprocess, undo_image_transformation
+from layers.output_utils import postprocess, undo_image_transformation, overlay_masks
+from layers import Detect
+from utils.pred_cache import PredictionCacheWriter, PredictionCache
+from utils.pipeline import Pipeline
+from utils.buffer_pool import HostBufferPool, DeviceBufferPool, cuda_alloc_count
+from utils.keyframes import KeyframeSelector, PropagationQuality, make_small_gray, estimate_motion, propagate
 import pycocotools
 
 from data import cfg, set_cfg, set_dataset
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 from torch.autograd import Variable
 import argparse
@@ -37,6 +43,16 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
+# The things --sweep knows how to sweep and how to parse them
+sweep_settings = OrderedDict([
+    ('nms_thresh',      float),
+    ('nms_conf_thresh', float),
+    ('top_k',           int),
+    ('score_threshold', float),
+    ('fast_nms',        str2bool),
+    ('cross_class_nms', str2bool),
+])
+
 def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description='YOLACT COCO Evaluation')
@@ -53,6 +69,9 @@ def parse_args(argv=None):
                         help='Whether compute NMS cross-class or per-class.')
     parser.add_argument('--display_masks', default=True, type=str2bool,
                         help='Whether or not to display masks over bounding boxes')
+    parser.add_argument('--render_backend', default='auto', choices=['auto', 'torch', 'uint8'],
+                        help='How to draw masks when displaying. "torch" blends in float with torch (fast on the gpu), "uint8" blends with '
+                             'integer math on the cpu only inside each mask\'s box, and "auto" uses uint8 if --cuda is off.')
     parser.add_argument('--display_bboxes', default=True, type=str2bool,
                         help='Whether or not to display bboxes around masks')
     parser.add_argument('--display_text', default=True, type=str2bool,
@@ -63,12 +82,18 @@ def parse_args(argv=None):
                         help='Display qualitative results instead of quantitative ones.')
     parser.add_argument('--shuffle', dest='shuffle', action='store_true',
                         help='Shuffles the images when displaying them. Doesn\'t have much of an effect when display is off though.')
+    parser.add_argument('--class_ap', default=False, dest='class_ap', action='store_true',
+                        help='Also print the box and mask AP of each class.')
     parser.add_argument('--ap_data_file', default='results/ap_data.pkl', type=str,
                         help='In quantitative mode, the file to save detections before calculating mAP.')
     parser.add_argument('--resume', dest='resume', action='store_true',
                         help='If display not set, this resumes mAP calculations from the ap_data_file.')
     parser.add_argument('--max_images', default=-1, type=int,
                         help='The maximum number of images from the dataset to consider. Use -1 for all.')
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help='The number of images to put through the network at once when evaluating on the dataset or a folder of --images.')
+    parser.add_argument('--io_workers', default=4, type=int,
+                        help='With --images, the number of threads reading images and the number of threads writing them out.')
     parser.add_argument('--output_coco_json', dest='output_coco_json', action='store_true',
                         help='If display is not set, instead of processing IoU values, this just dumps detections into the coco json file.')
     parser.add_argument('--bbox_det_file', default='results/bbox_detections.json', type=str,
@@ -86,7 +111,21 @@ def parse_args(argv=None):
     parser.add_argument('--display_lincomb', default=False, type=str2bool,
                         help='If the config uses lincomb masks, output a visualization of how those masks are created.')
     parser.add_argument('--benchmark', default=False, dest='benchmark', action='store_true',
-                        help='Equivalent to running display mode but without displaying an image.')
+                        help='Time the network and each stage of it on images from the dataset and report latency percentiles.')
+    parser.add_argument('--benchmark_warmup', default=10, type=int,
+                        help='With --benchmark, the number of untimed iterations to run first for each setting.')
+    parser.add_argument('--benchmark_iters', default=100, type=int,
+                        help='With --benchmark, the number of timed iterations to run for each setting.')
+    parser.add_argument('--benchmark_batch_sizes', default='1', type=str,
+                        help='With --benchmark, a comma separated list of batch sizes to time.')
+    parser.add_argument('--benchmark_resolutions', default=None, type=str,
+                        help='With --benchmark, a comma separated list of input sizes to time. Defaults to the config\'s max_size.')
+    parser.add_argument('--benchmark_json', default=None, type=str,
+                        help='With --benchmark, save the results to this json file (which can be used as a --benchmark_baseline later).')
+    parser.add_argument('--benchmark_baseline', default=None, type=str,
+                        help='With --benchmark, compare against the results in this json file and exit with an error if anything regressed.')
+    parser.add_argument('--benchmark_tolerance', default=0.1, type=float,
+                        help='With --benchmark_baseline, how much slower (as a fraction) a stage can get before it counts as a regression.')
     parser.add_argument('--no_sort', default=False, dest='no_sort', action='store_true',
                         help='Do not sort images by hashed image ID.')
     parser.add_argument('--seed', default=None, type=int,
@@ -103,6 +142,19 @@ def parse_args(argv=None):
                         help='A path to a video to evaluate on. Passing in a number will use that index webcam.')
     parser.add_argument('--video_multiframe', default=1, type=int,
                         help='The number of frames to evaluate in parallel to make videos play at higher fps.')
+    parser.add_argument('--video_policy', default='auto', choices=['auto', 'drop', 'all'],
+                        help='What to do with a video when the network can\'t keep up. "drop" throws out stale frames so the output stays real time, '
+                             '"all" processes every frame, and "auto" drops frames for webcams and processes all of them for files.')
+    parser.add_argument('--video_queue_size', default=4, type=int,
+                        help='How many batches of frames can wait between each stage of video processing.')
+    parser.add_argument('--keyframe_interval', default=1, type=int,
+                        help='For video, only run the network on every this many frames and move the detections along with the motion in between. '
+                             'Works best for fixed cameras. 1 runs the network on every frame.')
+    parser.add_argument('--keyframe_diff_thresh', default=None, type=float,
+                        help='For video, also run the network early if the mean difference (in 0-255 gray levels) from the last keyframe is over this.')
+    parser.add_argument('--keyframe_quality', default=False, dest='keyframe_quality', action='store_true',
+                        help='With keyframes, also run the network on the frames in between and report how close the propagated detections are. '
+                             'This is for measuring, so it\'s not any faster.')
     parser.add_argument('--score_threshold', default=0, type=float,
                         help='Detections with a score under this threshold will not be considered. This currently only works in display mode.')
     parser.add_argument('--dataset', default=None, type=str,
@@ -113,43 +165,101 @@ def parse_args(argv=None):
                         help='When displaying / saving video, draw the FPS on the frame')
     parser.add_argument('--emulate_playback', default=False, dest='emulate_playback', action='store_true',
                         help='When saving a video, emulate the framerate that you\'d get running in real-time mode.')
+    parser.add_argument('--coco_json_lines', default=False, dest='coco_json_lines', action='store_true',
+                        help='With --output_coco_json, write one detection per line instead of one big json list.')
+    parser.add_argument('--resume_coco_json', default=False, dest='resume_coco_json', action='store_true',
+                        help='With --output_coco_json, resume writing detections from the last image an interrupted run finished.')
+    parser.add_argument('--pred_cache_dir', default=None, type=str,
+                        help='In quantitative mode, save the raw predictions of the network to this folder so NMS settings can be swept later with --sweep.')
+    parser.add_argument('--pred_cache_min_conf', default=None, type=float,
+                        help='Only save priors with a confidence over this in the prediction cache. Defaults to the config\'s nms_conf_thresh.')
+    parser.add_argument('--sweep', default=None, type=str,
+                        help='Replay the predictions in --pred_cache_dir with every combination of these settings instead of running the network. '
+                             'Example: "nms_thresh=0.4,0.5;top_k=100,200;fast_nms=1,0". Settings you can sweep: ' + ', '.join(sweep_settings) + '.')
+    parser.add_argument('--sweep_file', default='results/sweep.json', type=str,
+                        help='Where to save the results of --sweep.')
+    parser.add_argument('--gt_cache_dir', default=None, type=str,
+                        help='If set, cache the ground truth for the validation set in this folder so repeat evaluations don\'t rebuild it.')
+    parser.add_argument('--shards', default=None, type=str,
+                        help='If set, read the validation set from shards made by data/scripts/make_shards.py in this folder. '
+                             'If the shards were shrunk with --max_side, detections are scaled back up to the original size, '
+                             'but the gt masks are upscaled from the shrunk ones, so mAP is a close approximation.')
 
     parser.set_defaults(no_bar=False, display=False, resume=False, output_coco_json=False, output_web_json=False, shuffle=False,
                         benchmark=False, no_sort=False, no_hash=False, mask_proto_debug=False, crop=True, detect=False, display_fps=False,
-                        emulate_playback=False)
+                        emulate_playback=False, coco_json_lines=False, resume_coco_json=False)
 
     global args
     args = parser.parse_args(argv)
 
     if args.output_web_json:
+        # The web json needs every detection at once, so it can't be streamed out like --output_coco_json is
+        if args.coco_json_lines or args.resume_coco_json:
+            parser.error('--coco_json_lines and --resume_coco_json don\'t work with --output_web_json.')
         args.output_coco_json = True
     
     if args.seed is not None:
         random.seed(args.seed)
 
 iou_thresholds = [x / 100 for x in range(50, 100, 5)]
+# Same area ranges (in pixels of the original image) as COCOEval
+area_ranges = OrderedDict([
+    ('small',  (0,       32 ** 2)),
+    ('medium', (32 ** 2, 96 ** 2)),
+    ('large',  (96 ** 2, 1e10)),
+])
 coco_cats = {} # Call prep_coco_cats to fill this
 coco_cats_inv = {}
 color_cache = defaultdict(lambda: {})
-
-def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, mask_alpha=0.45, fps_str=''):
+color_table_cache = {}
+
+def get_color_table(bgr:bool) -> np.ndarray:
+    """ Returns COLORS as a [num_colors, 3] uint8 array (flipped to BGR if asked), made once and then cached. """
+    if bgr not in color_table_cache:
+        table = np.array(COLORS, dtype=np.uint8)
+        color_table_cache[bgr] = np.ascontiguousarray(table[:, ::-1]) if bgr else table
+    return color_table_cache[bgr]
+
+def display_postprocess(dets_out, w, h, batch_idx=0):
+    """ Runs postprocess with the settings prep_display uses. """
+    save = cfg.rescore_bbox
+    cfg.rescore_bbox = True
+    t = postprocess(dets_out, w, h, batch_idx         = batch_idx,
+                                    visualize_lincomb = args.display_lincomb,
+                                    crop_masks        = args.crop,
+                                    score_threshold   = args.score_threshold)
+    cfg.rescore_bbox = save
+    return t
+
+def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, mask_alpha=0.45, fps_str='', batch_idx=0, postprocessed=None, out=None):
     """
     Note: If undo_transform=False then im_h and im_w are allowed to be None.
+    If you already have the output of display_postprocess for this image, pass it in as postprocessed (dets_out is ignored then).
+    If out is a [h, w, 3] uint8 array, the image is drawn into that instead of a new array.
     """
+    # Go by whether we're using the gpu at all, not by where img is (--display and --image give cpu tensors either way)
+    use_uint8 = args.render_backend == 'uint8' or (args.render_backend == 'auto' and not args.cuda)
+
     if undo_transform:
         img_numpy = undo_image_transformation(img, w, h)
-        img_gpu = torch.Tensor(img_numpy).cuda()
+        if use_uint8:
+            img_numpy = (img_numpy * 255).astype(np.uint8)
+        else:
+            img_gpu = torch.Tensor(img_numpy).cuda()
     else:
-        img_gpu = img / 255.0
         h, w, _ = img.shape
+        if use_uint8:
+            img_numpy = img.byte().cpu().numpy() if out is None else out
+            if out is not None:
+                torch.from_numpy(out).copy_(img)
+        else:
+            img_gpu = img / 255.0
     
     with timer.env('Postprocess'):
-        save = cfg.rescore_bbox
-        cfg.rescore_bbox = True
-        t = postprocess(dets_out, w, h, visualize_lincomb = args.display_lincomb,
-                                        crop_masks        = args.crop,
-                                        score_threshold   = args.score_threshold)
-        cfg.rescore_bbox = save
+        if postprocessed is not None:
+            t = postprocessed
+        else:
+            t = display_postprocess(dets_out, w, h, batch_idx=batch_idx)
 
     with timer.env('Copy'):
         idx = t[1].argsort(0, descending=True)[:args.top_k]
@@ -186,7 +296,14 @@ def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, ma
     # First, draw the masks on the GPU where we can do it really fast
     # Beware: very fast but possibly unintelligible mask-drawing code ahead
     # I wish I had access to OpenGL or Vulkan but alas, I guess Pytorch tensor operations will have to suffice
-    if args.display_masks and cfg.eval_mask_branch and num_dets_to_consider > 0:
+    if use_uint8:
+        if args.display_masks and cfg.eval_mask_branch and num_dets_to_consider > 0:
+            color_idx = ((classes[:num_dets_to_consider] if class_color else np.arange(num_dets_to_consider)) * 5) % len(COLORS)
+            colors = get_color_table(bgr=not undo_transform)[color_idx]
+            masks = masks[:num_dets_to_consider].byte().cpu().numpy()
+
+            overlay_masks(img_numpy, masks, boxes[:num_dets_to_consider], colors, mask_alpha, crop_masks=args.crop)
+    elif args.display_masks and cfg.eval_mask_branch and num_dets_to_consider > 0:
         # After this, mask is of size [num_dets, h, w, 1]
         masks = masks[:num_dets_to_consider, :, :, None]
         
@@ -216,12 +333,21 @@ def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, ma
 
         text_w, text_h = cv2.getTextSize(fps_str, font_face, font_scale, font_thickness)[0]
 
-        img_gpu[0:text_h+8, 0:text_w+8] *= 0.6 # 1 - Box alpha
+        if use_uint8:
+            # 154 / 256 is about 0.6
+            img_numpy[0:text_h+8, 0:text_w+8] = (img_numpy[0:text_h+8, 0:text_w+8].astype(np.uint16) * 154 >> 8).astype(np.uint8)
+        else:
+            img_gpu[0:text_h+8, 0:text_w+8] *= 0.6 # 1 - Box alpha
 
 
     # Then draw the stuff that needs to be done on the cpu
     # Note, make sure this is a uint8 tensor or opencv will not anti alias text for whatever reason
-    img_numpy = (img_gpu * 255).byte().cpu().numpy()
+    if not use_uint8:
+        if out is not None:
+            torch.from_numpy(out).copy_((img_gpu * 255).byte())
+            img_numpy = out
+        else:
+            img_numpy = (img_gpu * 255).byte().cpu().numpy()
 
     if args.display_fps:
         # Draw the text on the CPU
@@ -261,9 +387,9 @@ def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, ma
     
     return img_numpy
 
-def prep_benchmark(dets_out, h, w):
+def prep_benchmark(dets_out, h, w, batch_idx=0):
     with timer.env('Postprocess'):
-        t = postprocess(dets_out, w, h, crop_masks=args.crop, score_threshold=args.score_threshold)
+        t = postprocess(dets_out, w, h, batch_idx=batch_idx, crop_masks=args.crop, score_threshold=args.score_threshold)
 
     with timer.env('Copy'):
         classes, scores, boxes, masks = [x[:args.top_k] for x in t]
@@ -329,6 +455,14 @@ class Detections:
             'score': float(score)
         })
     
+    def finish_image(self, image_id:int):
+        """ Call this once all of an image's detections have been added. """
+        pass
+
+    def is_done(self, image_id:int) -> bool:
+        """ Returns whether this image's detections have already been written out. """
+        return False
+
     def dump(self):
         dump_arguments = [
             (self.bbox_data, args.bbox_det_file),
@@ -373,6 +507,93 @@ class Detections:
 
         
 
+class StreamingDetections(Detections):
+    """
+    Writes out detections to the bbox and mask files as each image finishes instead of holding
+    every detection in memory until the end. If line_delimited is True, the files have one json
+    detection per line instead of being one big json list.
+
+    After every image, the image id and the size of both files is appended to a progress file
+    next to the bbox file. If the run dies, pass resume=True to chop off anything written after
+    the last finished image and pick up from there (see is_done).
+    """
+
+    def __init__(self, bbox_path:str, mask_path:str, line_delimited:bool=False, resume:bool=False):
+        super().__init__()
+        self.line_delimited = line_delimited
+        self.progress_path = bbox_path + '.progress'
+        self.done_ids = set()
+
+        offsets = (0, 0)
+        if resume and os.path.exists(self.progress_path):
+            with open(self.progress_path, 'r') as f:
+                for line in f:
+                    vals = line.split()
+                    if len(vals) != 3:
+                        break # This line was only partially written before the crash
+                    self.done_ids.add(int(vals[0]))
+                    offsets = (int(vals[1]), int(vals[2]))
+
+            # If either output got deleted or cut short, the progress file can't be trusted, so start over
+            for path, offset in zip((bbox_path, mask_path), offsets):
+                if offset > 0 and (not os.path.exists(path) or os.path.getsize(path) < offset):
+                    print('Warning: %s is missing or shorter than %s says it should be, so starting over from scratch.'
+                          % (path, self.progress_path))
+                    self.done_ids = set()
+                    offsets = (0, 0)
+                    break
+
+        self.files = []
+        self.needs_comma = []
+        for path, offset in zip((bbox_path, mask_path), offsets):
+            f = open(path, 'r+b' if offset > 0 else 'wb')
+            f.truncate(offset)
+            f.seek(offset)
+
+            if offset == 0 and not line_delimited:
+                f.write(b'[')
+            
+            self.files.append(f)
+            self.needs_comma.append(offset > 1)
+
+        self.progress = open(self.progress_path, 'a' if len(self.done_ids) > 0 else 'w')
+
+    def finish_image(self, image_id:int):
+        """ Writes out everything added since the last call and marks this image as done. """
+        for idx, data in enumerate((self.bbox_data, self.mask_data)):
+            f = self.files[idx]
+
+            for det in data:
+                if self.line_delimited:
+                    f.write(json.dumps(det).encode('utf-8') + b'\n')
+                else:
+                    if self.needs_comma[idx]:
+                        f.write(b',')
+                    f.write(json.dumps(det).encode('utf-8'))
+                    self.needs_comma[idx] = True
+            
+            data.clear()
+            f.flush()
+
+        # Only mark the image as done once its detections have actually made it to the files
+        self.progress.write('%d %d %d\n' % (image_id, self.files[0].tell(), self.files[1].tell()))
+        self.progress.flush()
+        self.done_ids.add(image_id)
+
+    def is_done(self, image_id:int) -> bool:
+        return image_id in self.done_ids
+
+    def dump(self):
+        """ Closes out the files. Everything else has already been written by finish_image. """
+        for f in self.files:
+            if not self.line_delimited:
+                f.write(b']')
+            f.close()
+
+        self.progress.close()
+        os.remove(self.progress_path)
+
+
 def _mask_iou(mask1, mask2, iscrowd=False):
     with timer.env('Mask IoU'):
         ret = mask_iou(mask1, mask2, iscrowd)
@@ -383,8 +604,11 @@ def _bbox_iou(bbox1, bbox2, iscrowd=False):
         ret = jaccard(bbox1, bbox2, iscrowd)
     return ret.cpu()
 
-def prep_metrics(ap_data, dets, img, gt, gt_masks, h, w, num_crowd, image_id, detections:Detections=None):
+def prep_metrics(ap_data, dets, img, gt, gt_masks, h, w, num_crowd, image_id, detections:Detections=None, score_threshold:float=None, batch_idx:int=0):
     """ Returns a list of APs for this image, with each element being for a class  """
+    if score_threshold is None:
+        score_threshold = args.score_threshold
+
     if not args.output_coco_json:
         with timer.env('Prepare gt'):
             gt_boxes = torch.Tensor(gt[:, :4])
@@ -400,7 +624,7 @@ def prep_metrics(ap_data, dets, img, gt, gt_masks, h, w, num_crowd, image_id, de
                 crowd_classes, gt_classes = split(gt_classes)
 
     with timer.env('Postprocess'):
-        classes, scores, boxes, masks = postprocess(dets, w, h, crop_masks=args.crop, score_threshold=args.score_threshold)
+        classes, scores, boxes, masks = postprocess(dets, w, h, batch_idx=batch_idx, crop_masks=args.crop, score_threshold=score_threshold)
 
         if classes.size(0) == 0:
             return
@@ -430,85 +654,107 @@ def prep_metrics(ap_data, dets, img, gt, gt_masks, h, w, num_crowd, image_id, de
     
     with timer.env('Eval Setup'):
         num_pred = len(classes)
-        num_gt   = len(gt_classes)
 
-        mask_iou_cache = _mask_iou(masks, gt_masks)
-        bbox_iou_cache = _bbox_iou(boxes.float(), gt_boxes.float())
+        mask_iou_cache = _mask_iou(masks, gt_masks).numpy()
+        bbox_iou_cache = _bbox_iou(boxes.float(), gt_boxes.float()).numpy()
 
         if num_crowd > 0:
-            crowd_mask_iou_cache = _mask_iou(masks, crowd_masks, iscrowd=True)
-            crowd_bbox_iou_cache = _bbox_iou(boxes.float(), crowd_boxes.float(), iscrowd=True)
+            crowd_mask_iou_cache = _mask_iou(masks, crowd_masks, iscrowd=True).numpy()
+            crowd_bbox_iou_cache = _bbox_iou(boxes.float(), crowd_boxes.float(), iscrowd=True).numpy()
         else:
-            crowd_mask_iou_cache = None
-            crowd_bbox_iou_cache = None
+            crowd_mask_iou_cache = np.zeros((num_pred, 0))
+            crowd_bbox_iou_cache = np.zeros((num_pred, 0))
+
+        # COCOEval uses the annotation file's area for gt, which we don't have here, so approximate it with the
+        # rasterized mask area (for both iou types). For polygons, that's usually within a few pixels of it.
+        gt_areas = gt_masks.sum(dim=1).cpu().numpy()
+        box_areas = ((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])).cpu().numpy()
+        mask_areas = masks.sum(dim=1).cpu().numpy()
+
+        classes     = np.array(classes)
+        gt_classes  = np.array(gt_classes, dtype=int)
+        crowd_classes = np.array(crowd_classes, dtype=int) if num_crowd > 0 else np.zeros(0, dtype=int)
 
         box_indices = sorted(range(num_pred), key=lambda i: -box_scores[i])
         mask_indices = sorted(box_indices, key=lambda i: -mask_scores[i])
 
         iou_types = [
-            ('box',  lambda i,j: bbox_iou_cache[i, j].item(),
-                     lambda i,j: crowd_bbox_iou_cache[i,j].item(),
-                     lambda i: box_scores[i], box_indices),
-            ('mask', lambda i,j: mask_iou_cache[i, j].item(),
-                     lambda i,j: crowd_mask_iou_cache[i,j].item(),
-                     lambda i: mask_scores[i], mask_indices)
+            ('box',  bbox_iou_cache, crowd_bbox_iou_cache, box_scores,  box_indices,  box_areas),
+            ('mask', mask_iou_cache, crowd_mask_iou_cache, mask_scores, mask_indices, mask_areas),
         ]
 
     timer.start('Main loop')
-    for _class in set(classes + gt_classes):
-        ap_per_iou = []
-        num_gt_for_class = sum([1 for x in gt_classes if x == _class])
+    for _class in set(classes.tolist() + gt_classes.tolist()):
+        gt_idx    = np.where(gt_classes == _class)[0]
+        crowd_idx = np.where(crowd_classes == _class)[0]
         
-        for iouIdx in range(len(iou_thresholds)):
-            iou_threshold = iou_thresholds[iouIdx]
-
-            for iou_type, iou_func, crowd_func, score_func, indices in iou_types:
-                gt_used = [False] * len(gt_classes)
-                
-                ap_obj = ap_data[iou_type][iouIdx][_class]
-                ap_obj.add_gt_positives(num_gt_for_class)
-
-                for i in indices:
-                    if classes[i] != _class:
-                        continue
-                    
-                    max_iou_found = iou_threshold
-                    max_match_idx = -1
-                    for j in range(num_gt):
-                        if gt_used[j] or gt_classes[j] != _class:
-                            continue
-                            
-                        iou = iou_func(i, j)
-
-                        if iou > max_iou_found:
-                            max_iou_found = iou
-                            max_match_idx = j
-                    
-                    if max_match_idx >= 0:
-                        gt_used[max_match_idx] = True
-                        ap_obj.push(score_func(i), True)
-                    else:
-                        # If the detection matches a crowd, we can just ignore it
-                        matched_crowd = False
-
-                        if num_crowd > 0:
-                            for j in range(len(crowd_classes)):
-                                if crowd_classes[j] != _class:
-                                    continue
-                                
-                                iou = crowd_func(i, j)
-
-                                if iou > iou_threshold:
-                                    matched_crowd = True
-                                    break
-
-                        # All this crowd code so that we can make sure that our eval code gives the
-                        # same result as COCOEval. There aren't even that many crowd annotations to
-                        # begin with, but accuracy is of the utmost importance.
-                        if not matched_crowd:
-                            ap_obj.push(score_func(i), False)
+        for iou_type, iou_cache, crowd_iou_cache, scores, indices, det_areas in iou_types:
+            det_idx = np.array([i for i in indices if classes[i] == _class], dtype=int)
+            det_scores = [scores[i] for i in det_idx]
+            
+            ious = iou_cache[np.ix_(det_idx, gt_idx)]
+            crowd_ious = crowd_iou_cache[np.ix_(det_idx, crowd_idx)]
+
+            # 'all' is the usual ap_data[iou_type] and each area range gets its own copy of that
+            area_ap_data = [(None, ap_data[iou_type])]
+            if 'area' in ap_data:
+                area_ap_data += [(area_ranges[name], ap_data['area'][name][iou_type]) for name in area_ranges]
+
+            for area_range, ap_by_iou in area_ap_data:
+                if area_range is None:
+                    gt_ignore = np.zeros(len(gt_idx), dtype=bool)
+                    det_in_range = np.ones(len(det_idx), dtype=bool)
+                else:
+                    lo, hi = area_range
+                    gt_ignore = (gt_areas[gt_idx] < lo) | (gt_areas[gt_idx] > hi)
+                    det_in_range = (det_areas[det_idx] >= lo) & (det_areas[det_idx] <= hi)
+
+                num_gt_for_class = int((~gt_ignore).sum())
+
+                for iouIdx, iou_threshold in enumerate(iou_thresholds):
+                    ap_obj = ap_by_iou[iouIdx][_class]
+                    ap_obj.add_gt_positives(num_gt_for_class)
+                    _match_class(ap_obj, det_scores, ious, crowd_ious, gt_ignore, det_in_range, iou_threshold)
     timer.stop('Main loop')
 
+def _match_class(ap_obj, det_scores:list, ious:np.ndarray, crowd_ious:np.ndarray, gt_ignore:np.ndarray,
+                 det_in_range:np.ndarray, iou_threshold:float):
+    """
+    Greedily matches the detections of one class (sorted by score) to the gt of that class and pushes the results to ap_obj.
+
+    Each detection takes the unused gt with the highest IoU over the threshold. Only if there isn't one does it look at
+    the gt that's ignored (because it's out of the area range). Detections that match ignored gt or a crowd, or that are
+    out of the area range themselves, don't count either way. That's how COCOEval does it.
+    """
+    gt_used = np.zeros(ious.shape[1], dtype=bool)
+
+    for i in range(ious.shape[0]):
+        if ious.shape[1] > 0:
+            for candidates in (~gt_ignore, gt_ignore):
+                iou = np.where(candidates & ~gt_used, ious[i], -1)
+                max_match_idx = iou.argmax()
+
+                if iou[max_match_idx] > iou_threshold:
+                    break
+            else:
+                max_match_idx = -1
+
+            if max_match_idx >= 0:
+                gt_used[max_match_idx] = True
+                if not gt_ignore[max_match_idx]:
+                    ap_obj.push(det_scores[i], True)
+                continue
+
+        # If the detection matches a crowd, we can just ignore it
+        # All this crowd code so that we can make sure that our eval code gives the
+        # same result as COCOEval. There aren't even that many crowd annotations to
+        # begin with, but accuracy is of the utmost importance.
+        if crowd_ious.shape[1] > 0 and (crowd_ious[i] > iou_threshold).any():
+            continue
+
+        if det_in_range[i]:
+            ap_obj.push(det_scores[i], False)
+
 
 class APDataObject:
     """
@@ -580,6 +826,211 @@ class APDataObject:
         # avg([precision(x) for x in 0:0.01:1])
         return sum(y_range) / len(y_range)
 
+def benchmark_stats(samples:list) -> dict:
+    """ Summarizes a list of times in seconds as mean and percentiles in milliseconds. """
+    samples = np.array(samples) * 1000
+    return {
+        'mean': float(samples.mean()),
+        'p50':  float(np.percentile(samples, 50)),
+        'p90':  float(np.percentile(samples, 90)),
+        'p99':  float(np.percentile(samples, 99)),
+    }
+
+def benchmark(net:Yolact, dataset):
+    """
+    Times every combination of --benchmark_batch_sizes and --benchmark_resolutions on images from
+    the dataset. For each one, this reports the mean / p50 / p90 / p99 time of each stage that the
+    timer knows about (backbone, fpn, proto, pred_heads, Detect, Postprocess, Copy, ...) and of the
+    whole iteration, and the throughput in images per second.
+    """
+    batch_sizes = [int(x) for x in args.benchmark_batch_sizes.split(',')]
+    resolutions = [cfg.max_size] if args.benchmark_resolutions is None else [int(x) for x in args.benchmark_resolutions.split(',')]
+    
+    # Cycle through the first few (hash-ordered) images so every batch has real content
+    num_images = max(batch_sizes) if args.max_images < 0 else max(args.max_images, 1)
+    hashed = [badhash(x) for x in dataset.ids]
+    dataset_indices = sorted(range(len(dataset)), key=lambda x: hashed[x])[:num_images]
+
+    print('Loading %d images...' % len(dataset_indices))
+    images = []
+    for image_idx in dataset_indices:
+        img, _, _, h, w, _ = dataset.pull_item(image_idx)
+        images.append((img, h, w))
+
+    # Without this, time spent waiting on the GPU gets attributed to whatever stage happens to sync
+    if args.cuda:
+        timer.set_sync(torch.cuda.synchronize)
+
+    results = {
+        'config': cfg.name,
+        'device': torch.cuda.get_device_name() if args.cuda else 'cpu',
+        'warmup': args.benchmark_warmup,
+        'iterations': args.benchmark_iters,
+        'runs': [],
+    }
+
+    max_size = cfg.max_size
+
+    for resolution in resolutions:
+        for batch_size in batch_sizes:
+            cfg.max_size = resolution
+            batch_imgs = [images[i % len(images)] for i in range(batch_size)]
+
+            batch = stack_padded([img for img, _, _ in batch_imgs])
+            if resolution != max_size:
+                _, _, in_h, in_w = batch.size()
+                scale = resolution / max_size
+                batch = F.interpolate(batch, (int(in_h * scale), int(in_w * scale)), mode='bilinear', align_corners=False)
+            if args.cuda:
+                batch = batch.cuda()
+
+            print('Timing batch size %d at %dpx...' % (batch_size, resolution))
+            stage_times = defaultdict(list)
+            iter_times = []
+
+            for it in range(args.benchmark_warmup + args.benchmark_iters):
+                timer.reset()
+                start = time.perf_counter()
+
+                preds = net(batch)
+                for batch_idx, (_, h, w) in enumerate(batch_imgs):
+                    prep_benchmark(preds, h, w, batch_idx=batch_idx)
+
+                if args.cuda:
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - start
+
+                if it >= args.benchmark_warmup:
+                    iter_times.append(elapsed)
+                    for name, t in timer.get_times().items():
+                        stage_times[name].append(t)
+
+            run = {
+                'batch_size': batch_size,
+                'resolution': resolution,
+                'images_per_sec': batch_size * len(iter_times) / sum(iter_times),
+                'total': benchmark_stats(iter_times),
+                # Stages that didn't run every iteration (e.g., no detections) count as 0 for the others
+                'stages': OrderedDict((name, benchmark_stats(t + [0] * (len(iter_times) - len(t))))
+                                      for name, t in stage_times.items()),
+            }
+            results['runs'].append(run)
+            print_benchmark(run)
+
+    cfg.max_size = max_size
+    timer.set_sync(None)
+
+    if args.benchmark_json is not None:
+        with open(args.benchmark_json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved benchmark results to %s.' % args.benchmark_json)
+
+    if args.benchmark_baseline is not None:
+        with open(args.benchmark_baseline, 'r') as f:
+            baseline = json.load(f)
+        
+        results['regressed'] = not compare_benchmarks(results, baseline, args.benchmark_tolerance)
+
+    return results
+
+def stack_padded(imgs:list) -> torch.Tensor:
+    """
+    Stacks [C, H, W] images into a batch. With preserve_aspect_ratio they don't all come out the same
+    size, so the smaller ones get padded on the bottom and right with 0 (the mean after BaseTransform).
+    """
+    max_h = max(img.size(1) for img in imgs)
+    max_w = max(img.size(2) for img in imgs)
+    return torch.stack([F.pad(img, (0, max_w - img.size(2), 0, max_h - img.size(1))) for img in imgs], dim=0)
+
+def print_benchmark(run:dict):
+    make_row = lambda vals: (' %15s |' + ' %9s |' * (len(vals) - 1)) % tuple(vals)
+    
+    print()
+    print(make_row(['Stage (ms)', 'mean', 'p50', 'p90', 'p99']))
+    for name, stats in list(run['stages'].items()) + [('Total', run['total'])]:
+        print(make_row([name] + ['%.3f' % stats[k] for k in ('mean', 'p50', 'p90', 'p99')]))
+    print()
+    print('Batch size %d at %dpx: %.2f images / s' % (run['batch_size'], run['resolution'], run['images_per_sec']))
+    print()
+
+def compare_benchmarks(results:dict, baseline:dict, tolerance:float) -> bool:
+    """ Prints any stage whose p50 or p99 got more than tolerance slower than the baseline. Returns whether nothing regressed. """
+    baseline_runs = {(run['batch_size'], run['resolution']): run for run in baseline['runs']}
+    regressions = []
+
+    for run in results['runs']:
+        key = (run['batch_size'], run['resolution'])
+        if key not in baseline_runs:
+            print('Note: batch size %d at %dpx is not in the baseline.' % key)
+            continue
+
+        base_run = baseline_runs[key]
+        stages = list(run['stages'].items()) + [('Total', run['total'])]
+        base_stages = dict(base_run['stages'], Total=base_run['total'])
+
+        for name, stats in stages:
+            if name not in base_stages:
+                continue
+            
+            for pct in ('p50', 'p99'):
+                old, new = base_stages[name][pct], stats[pct]
+                if new > old * (1 + tolerance):
+                    regressions.append((key, name, pct, old, new))
+
+    if len(regressions) == 0:
+        print('No regressions against the baseline (tolerance %d%%).' % round(tolerance * 100))
+        return True
+    
+    print('Regressions against the baseline (tolerance %d%%):' % round(tolerance * 100))
+    for (batch_size, resolution), name, pct, old, new in regressions:
+        print('  batch %d @ %dpx  %-12s %s: %.3f ms -> %.3f ms (+%.1f%%)'
+            % (batch_size, resolution, name, pct, old, new, (new / max(old, 1e-9) - 1) * 100))
+    return False
+
+def make_ap_data():
+    """
+    For each class and iou, stores tuples (score, isPositive)
+    Index ap_data[type][iouIdx][classIdx], or ap_data['area'][areaName][type][iouIdx][classIdx] for one area range.
+    """
+    make_type = lambda: {
+        'box' : [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds],
+        'mask': [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds]
+    }
+
+    ap_data = make_type()
+    ap_data['area'] = {name: make_type() for name in area_ranges}
+    return ap_data
+
+def make_eval_batches(dataset, dataset_indices:list, batch_size:int) -> list:
+    """
+    Splits dataset_indices into batches of batch_size, keeping the order as much as possible.
+    
+    With preserve_aspect_ratio, images only stack if they get resized to the same size, so each
+    image goes in a bucket based on the size Resize will give it and a batch is made whenever a
+    bucket fills up. Whatever's left in each bucket at the end becomes a smaller batch.
+    """
+    if batch_size <= 1:
+        return [[idx] for idx in dataset_indices]
+    
+    if not cfg.preserve_aspect_ratio:
+        return [dataset_indices[i:i+batch_size] for i in range(0, len(dataset_indices), batch_size)]
+
+    batches = []
+    buckets = OrderedDict()
+
+    for idx in dataset_indices:
+        height, width = dataset.image_size(idx)
+        size = Resize.calc_size_preserve_ar(width, height, cfg.max_size)
+
+        bucket = buckets.setdefault(size, [])
+        bucket.append(idx)
+
+        if len(bucket) == batch_size:
+            batches.append(bucket)
+            del buckets[size]
+
+    return batches + list(buckets.values())
+
 def badhash(x):
     """
     Just a quick and dirty hash function for doing a deterministic shuffle based on image_id.
@@ -610,25 +1061,75 @@ def evalimage(net:Yolact, path:str, save_path:str=None):
         cv2.imwrite(save_path, img_numpy)
 
 def evalimages(net:Yolact, input_folder:str, output_folder:str, max_iter:int):
+    """
+    Runs every image in input_folder through the network and saves the result as a png in output_folder.
+
+    Decoding, the network and encoding all happen at the same time: a pool of --io_workers threads reads
+    images, the network takes whatever's been read (up to --batch_size images of the same size at once),
+    and another pool of --io_workers threads writes the results out.
+    """
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
 
-    print()
-    for i,p in enumerate(Path(input_folder).glob('*')):
-        path = str(p)
+    paths = sorted(str(p) for p in Path(input_folder).glob('*'))
+    if max_iter >= 0:
+        paths = paths[:max_iter]
+
+    transform = FastBaseTransform()
+
+    def load_image(path):
+        img = cv2.imread(path)
+        if img is None:
+            print('\nWarning: could not read %s, skipping it.' % path)
+            return None
+        return path, img
+
+    def eval_batch(items):
+        outs = []
+
+        # Only same-size images can go through the network together
+        groups = OrderedDict()
+        for path, img in items:
+            groups.setdefault(img.shape, []).append((path, img))
+
+        with torch.no_grad():
+            for group in groups.values():
+                frames = torch.from_numpy(np.stack([img for _, img in group], axis=0)).cuda().float()
+                preds = net(transform(frames))
+
+                for batch_idx, (path, _) in enumerate(group):
+                    img_numpy = prep_display(preds, frames[batch_idx], None, None, undo_transform=False, batch_idx=batch_idx)
+                    outs.append((path, img_numpy))
+
+        return outs
+
+    def save_image(item):
+        path, img_numpy = item
         name = os.path.basename(path)
         name = '.'.join(name.split('.')[:-1]) + '.png'
-        out_path = os.path.join(output_folder, name)
+        cv2.imwrite(os.path.join(output_folder, name), img_numpy)
+        return path
 
-        evalimage(net, path, out_path)
-        #print(path + ' -> ' + out_path)
+    pipeline = Pipeline(paths, queue_size=max(2 * args.batch_size, 8))
+    pipeline.add_stage(load_image, name='Decode', num_workers=args.io_workers)
+    pipeline.add_stage(eval_batch, name='Network', batch_size=args.batch_size)
+    pipeline.add_stage(save_image, name='Encode', num_workers=args.io_workers)
 
-        if i>max_iter:
-            break
-    print('Done.')
+    progress_bar = ProgressBar(30, max(len(paths), 1))
+    start_time = time.time()
+    num_done = 0
 
-from multiprocessing.pool import ThreadPool
-from queue import Queue
+    print()
+    for _ in pipeline:
+        num_done += 1
+        progress_bar.set_val(num_done)
+        print('\rProcessing Images  %s %6d / %6d (%5.2f%%)    %5.2f img/s        '
+            % (repr(progress_bar), num_done, len(paths), num_done / max(len(paths), 1) * 100,
+               num_done / (time.time() - start_time)), end='')
+    print()
+
+    pipeline.print_stats()
+    print('Done.')
 
 class CustomDataParallel(torch.nn.DataParallel):
     """ A Custom Data Parallel class that properly gathers lists of dictionaries. """
@@ -637,6 +1138,13 @@ class CustomDataParallel(torch.nn.DataParallel):
         return sum(outputs, [])
 
 def evalvideo(net:Yolact, path:str, out_path:str=None):
+    """
+    Decode, transform, network and render each run in their own thread, joined by bounded queues (see utils/pipeline.py).
+    The main thread just shows / writes whatever comes out the other end.
+
+    If the network can't keep up, --video_policy decides whether to drop stale frames in front of the network
+    (so a webcam stays real time) or to let the queues fill up and slow down decoding (so every frame gets processed).
+    """
     # If the path is a digit, parse it as a webcam index
     is_webcam = path.isdigit()
     
@@ -661,45 +1169,101 @@ def evalvideo(net:Yolact, path:str, out_path:str=None):
     else:
         num_frames = round(vid.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    drop_frames = args.video_policy == 'drop' or (args.video_policy == 'auto' and is_webcam)
+    use_keyframes = args.keyframe_interval > 1 or args.keyframe_diff_thresh is not None
+
+    if use_keyframes:
+        select_keyframe = KeyframeSelector(args.keyframe_interval, args.keyframe_diff_thresh)
+        quality = PropagationQuality() if args.keyframe_quality else None
+        last_key = {'dets': None, 'gray': None}
+
     net = CustomDataParallel(net).cuda()
     transform = torch.nn.DataParallel(FastBaseTransform()).cuda()
-    frame_times = MovingAverage(100)
-    fps = 0
-    frame_time_target = 1 / target_fps
-    running = True
+    frame_time_target = 1 / max(target_fps, 1)
     fps_str = ''
-    vid_done = False
-    frames_displayed = 0
 
     if out_path is not None:
         out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"mp4v"), target_fps, (frame_width, frame_height))
 
-    def cleanup_and_exit():
-        print()
-        pool.terminate()
-        vid.release()
-        if out_path is not None:
-            out.release()
-        cv2.destroyAllWindows()
-        exit()
-
-    def get_next_frame(vid):
+    # Every frame gets read into, copied to and drawn into one of these instead of a new array. Buffers go back
+    # to their pool once the next stage is done with them, so after the first few frames nothing gets allocated.
+    decode_pool = HostBufferPool('Decode', pin=True)
+    device_pool = DeviceBufferPool('Device', 'cuda')
+    render_pool = HostBufferPool('Render')
+
+    def get_next_frame():
         frames = []
         for idx in range(args.video_multiframe):
-            frame = vid.read()[1]
+            buf = decode_pool.acquire((frame_height, frame_width, 3), np.uint8)
+            frame = vid.read(buf)[1]
+
+            if frame is not buf:
+                # Either we're out of frames or the frame wasn't the size we expected, so OpenCV made its own
+                decode_pool.release(buf)
             if frame is None:
-                return frames
+                break
             frames.append(frame)
-        return frames
+        # Latency is measured from when the frames were read in
+        return frames, time.perf_counter()
+
+    def read_frames(first_batch):
+        yield first_batch
+        while True:
+            frames, read_time = get_next_frame()
+            if len(frames) == 0:
+                return
+            yield frames, read_time
+
+    def transform_frame(inp):
+        frames, read_time = inp
+        # Motion is estimated on a small gray copy of each frame, which is cheaper to make here on the cpu
+        small_grays = [make_small_gray(frame) for frame in frames] if use_keyframes else None
 
-    def transform_frame(frames):
         with torch.no_grad():
-            frames = [torch.from_numpy(frame).cuda().float() for frame in frames]
-            return frames, transform(torch.stack(frames, 0))
+            # Copy (and convert to float) straight into one batch buffer. The copy is blocking, so the
+            # decode buffers can go back to the pool right after.
+            batch_buf = device_pool.acquire((len(frames),) + frames[0].shape, torch.float32)
+            for idx, frame in enumerate(frames):
+                batch_buf[idx].copy_(torch.from_numpy(frame))
+                decode_pool.release(frame)
+
+            frames = [batch_buf[idx] for idx in range(len(frames))]
+            return frames, transform(batch_buf), read_time, small_grays, batch_buf
+
+    def eval_keyframes(frames, imgs, small_grays):
+        """ Runs the network on just the keyframes and moves the last keyframe's detections to the rest. """
+        h, w, _ = frames[0].shape
+        is_key = [select_keyframe(gray) for gray in small_grays]
+        # For --keyframe_quality, we need what the network would have said for every frame
+        run_idx = [i for i in range(len(frames)) if is_key[i] or quality is not None]
+
+        full = {}
+        if len(run_idx) > 0:
+            out = net(imgs[run_idx])
+            for batch_idx, i in enumerate(run_idx):
+                full[i] = display_postprocess(out, w, h, batch_idx=batch_idx)
+
+        dets = []
+        for i in range(len(frames)):
+            if is_key[i]:
+                last_key['dets'], last_key['gray'] = full[i], small_grays[i]
+                dets.append(full[i])
+            else:
+                # Always go from the keyframe instead of the frame before so errors don't pile up
+                flow = estimate_motion(last_key['gray'], small_grays[i])
+                dets.append(propagate(last_key['dets'], flow, w, h))
+
+                if quality is not None:
+                    quality.add(dets[-1], full[i])
+        return dets
 
     def eval_network(inp):
         with torch.no_grad():
-            frames, imgs = inp
+            frames, imgs, read_time, small_grays, batch_buf = inp
+
+            if use_keyframes:
+                return frames, eval_keyframes(frames, imgs, small_grays), read_time, batch_buf
+
             num_extra = 0
             while imgs.size(0) < args.video_multiframe:
                 imgs = torch.cat([imgs, imgs[0].unsqueeze(0)], dim=0)
@@ -707,174 +1271,147 @@ def evalvideo(net:Yolact, path:str, out_path:str=None):
             out = net(imgs)
             if num_extra > 0:
                 out = out[:-num_extra]
-            return frames, out
+            return frames, out, read_time, batch_buf
 
-    def prep_frame(inp, fps_str):
+    def prep_frame(inp):
         with torch.no_grad():
-            frame, preds = inp
-            return prep_display(preds, frame, None, None, undo_transform=False, class_color=True, fps_str=fps_str)
-
-    frame_buffer = Queue()
-    video_fps = 0
-
-    # All this timing code to make sure that 
-    def play_video():
-        try:
-            nonlocal frame_buffer, running, video_fps, is_webcam, num_frames, frames_displayed, vid_done
-
-            video_frame_times = MovingAverage(100)
-            frame_time_stabilizer = frame_time_target
-            last_time = None
-            stabilizer_step = 0.0005
-            progress_bar = ProgressBar(30, num_frames)
-
-            while running:
-                frame_time_start = time.time()
-
-                if not frame_buffer.empty():
-                    next_time = time.time()
-                    if last_time is not None:
-                        video_frame_times.add(next_time - last_time)
-                        video_fps = 1 / video_frame_times.get_avg()
-                    if out_path is None:
-                        cv2.imshow(path, frame_buffer.get())
-                    else:
-                        out.write(frame_buffer.get())
-                    frames_displayed += 1
-                    last_time = next_time
-
-                    if out_path is not None:
-                        if video_frame_times.get_avg() == 0:
-                            fps = 0
-                        else:
-                            fps = 1 / video_frame_times.get_avg()
-                        progress = frames_displayed / num_frames * 100
-                        progress_bar.set_val(frames_displayed)
-
-                        print('\rProcessing Frames  %s %6d / %6d (%5.2f%%)    %5.2f fps        '
-                            % (repr(progress_bar), frames_displayed, num_frames, progress, fps), end='')
-
-                
-                # This is split because you don't want savevideo to require cv2 display functionality (see #197)
-                if out_path is None and cv2.waitKey(1) == 27:
-                    # Press Escape to close
-                    running = False
-                if not (frames_displayed < num_frames):
-                    running = False
-
-                if not vid_done:
-                    buffer_size = frame_buffer.qsize()
-                    if buffer_size < args.video_multiframe:
-                        frame_time_stabilizer += stabilizer_step
-                    elif buffer_size > args.video_multiframe:
-                        frame_time_stabilizer -= stabilizer_step
-                        if frame_time_stabilizer < 0:
-                            frame_time_stabilizer = 0
-
-                    new_target = frame_time_stabilizer if is_webcam else max(frame_time_stabilizer, frame_time_target)
-                else:
-                    new_target = frame_time_target
-
-                next_frame_target = max(2 * new_target - video_frame_times.get_avg(), 0)
-                target_time = frame_time_start + next_frame_target - 0.001 # Let's just subtract a millisecond to be safe
-                
-                if out_path is None or args.emulate_playback:
-                    # This gives more accurate timing than if sleeping the whole amount at once
-                    while time.time() < target_time:
-                        time.sleep(0.001)
-                else:
-                    # Let's not starve the main thread, now
-                    time.sleep(0.001)
-        except:
-            # See issue #197 for why this is necessary
-            import traceback
-            traceback.print_exc()
-
-
-    extract_frame = lambda x, i: (x[0][i] if x[1][i]['detection'] is None else x[0][i].to(x[1][i]['detection']['box'].device), [x[1][i]])
+            frames, preds, read_time, batch_buf = inp
+            rendered = []
+
+            for frame, pred in zip(frames, preds):
+                if use_keyframes:
+                    # These already went through postprocess in eval_keyframes
+                    rendered.append(prep_display(None, frame, None, None, undo_transform=False, class_color=True, fps_str=fps_str,
+                                                 postprocessed=pred, out=render_pool.acquire(frame.shape, np.uint8)))
+                    continue
+
+                if pred['detection'] is not None:
+                    frame = frame.to(pred['detection']['box'].device)
+                rendered.append(prep_display([pred], frame, None, None, undo_transform=False, class_color=True, fps_str=fps_str,
+                                             out=render_pool.acquire(frame.shape, np.uint8)))
+            
+            device_pool.release(batch_buf)
+            return rendered, read_time
 
     # Prime the network on the first frame because I do some thread unsafe things otherwise
     print('Initializing model... ', end='')
-    first_batch = eval_network(transform_frame(get_next_frame(vid)))
+    first_batch = get_next_frame()
+    with torch.no_grad():
+        # Don't go through transform_frame here since that gives the decode buffers back to the pool
+        net(transform(torch.stack([torch.from_numpy(frame).cuda().float() for frame in first_batch[0]], 0)))
     print('Done.')
 
-    # For each frame the sequence of functions it needs to go through to be processed (in reversed order)
-    sequence = [prep_frame, eval_network, transform_frame]
-    pool = ThreadPool(processes=len(sequence) + args.video_multiframe + 2)
-    pool.apply_async(play_video)
-    active_frames = [{'value': extract_frame(first_batch, i), 'idx': 0} for i in range(len(first_batch[0]))]
+    pipeline = Pipeline(read_frames(first_batch), queue_size=args.video_queue_size)
+    pipeline.add_stage(transform_frame, name='Transform')
+    # Dropping frames right before the network (the slow part) means it always works on the newest frame
+    pipeline.add_stage(eval_network, name='Network', queue_size=1 if drop_frames else None, drop=drop_frames,
+                       on_drop=lambda inp: device_pool.release(inp[4]))
+    pipeline.add_stage(prep_frame, name='Render')
+
+    frame_times = MovingAverage(100)
+    latencies = []
+    progress_bar = ProgressBar(30, num_frames)
+    frames_displayed = 0
+    last_time = None
+    next_frame_time = None
+    warmup_allocs = None
+    
+    # When showing a file (or when asked to), play it back at the video's frame rate instead of as fast as possible
+    pace_playback = (out_path is None and not is_webcam) or args.emulate_playback
 
     print()
     if out_path is None: print('Press Escape to close.')
+    outputs = iter(pipeline)
     try:
-        while vid.isOpened() and running:
-            # Hard limit on frames in buffer so we don't run out of memory >.>
-            while frame_buffer.qsize() > 100:
-                time.sleep(0.001)
-
-            start_time = time.time()
-
-            # Start loading the next frames from the disk
-            if not vid_done:
-                next_frames = pool.apply_async(get_next_frame, args=(vid,))
-            else:
-                next_frames = None
-            
-            if not (vid_done and len(active_frames) == 0):
-                # For each frame in our active processing queue, dispatch a job
-                # for that frame using the current function in the sequence
-                for frame in active_frames:
-                    _args =  [frame['value']]
-                    if frame['idx'] == 0:
-                        _args.append(fps_str)
-                    frame['value'] = pool.apply_async(sequence[frame['idx']], args=_args)
-                
-                # For each frame whose job was the last in the sequence (i.e. for all final outputs)
-                for frame in active_frames:
-                    if frame['idx'] == 0:
-                        frame_buffer.put(frame['value'].get())
-
-                # Remove the finished frames from the processing queue
-                active_frames = [x for x in active_frames if x['idx'] > 0]
-
-                # Finish evaluating every frame in the processing queue and advanced their position in the sequence
-                for frame in list(reversed(active_frames)):
-                    frame['value'] = frame['value'].get()
-                    frame['idx'] -= 1
-
-                    if frame['idx'] == 0:
-                        # Split this up into individual threads for prep_frame since it doesn't support batch size
-                        active_frames += [{'value': extract_frame(frame['value'], i), 'idx': 0} for i in range(1, len(frame['value'][0]))]
-                        frame['value'] = extract_frame(frame['value'], 0)
-                
-                # Finish loading in the next frames and add them to the processing queue
-                if next_frames is not None:
-                    frames = next_frames.get()
-                    if len(frames) == 0:
-                        vid_done = True
-                    else:
-                        active_frames.append({'value': frames, 'idx': len(sequence)-1})
-
-                # Compute FPS
-                frame_times.add(time.time() - start_time)
-                fps = args.video_multiframe / frame_times.get_avg()
-            else:
-                fps = 0
-            
-            fps_str = 'Processing FPS: %.2f | Video Playback FPS: %.2f | Frames in Buffer: %d' % (fps, video_fps, frame_buffer.qsize())
-            if not args.display_fps:
+        for rendered, read_time in outputs:
+            for frame in rendered:
+                if pace_playback:
+                    now = time.perf_counter()
+                    if next_frame_time is None or next_frame_time < now - frame_time_target:
+                        # We fell behind (or just started), so don't try to catch up
+                        next_frame_time = now
+                    elif next_frame_time > now:
+                        time.sleep(next_frame_time - now)
+                    next_frame_time += frame_time_target
+
+                if out_path is None:
+                    cv2.imshow(path, frame)
+                else:
+                    out.write(frame)
+                render_pool.release(frame)
+
+                now = time.perf_counter()
+                latencies.append(now - read_time)
+                if last_time is not None:
+                    frame_times.add(now - last_time)
+                last_time = now
+                frames_displayed += 1
+
+                # Anything allocated after this is a per-frame allocation that shouldn't be there
+                if frames_displayed == 2 * args.video_queue_size * args.video_multiframe + 1:
+                    warmup_allocs = (decode_pool.num_allocs + device_pool.num_allocs + render_pool.num_allocs, cuda_alloc_count())
+
+            fps = 1 / frame_times.get_avg() if frame_times.get_avg() > 0 else 0
+            num_dropped = pipeline.stages[1].num_dropped * args.video_multiframe
+            fps_str = 'FPS: %.2f | Latency: %.1f ms | Dropped: %d' % (fps, latencies[-1] * 1000, num_dropped)
+
+            if out_path is not None:
+                progress = frames_displayed / num_frames * 100
+                progress_bar.set_val(frames_displayed)
+                print('\rProcessing Frames  %s %6d / %6d (%5.2f%%)    %5.2f fps        '
+                    % (repr(progress_bar), frames_displayed, num_frames, progress, fps), end='')
+            elif not args.display_fps:
                 print('\r' + fps_str + '    ', end='')
 
+            # This is split because you don't want savevideo to require cv2 display functionality (see #197)
+            if out_path is None and cv2.waitKey(1) == 27:
+                # Press Escape to close
+                break
     except KeyboardInterrupt:
         print('\nStopping...')
+    finally:
+        outputs.close()
     
-    cleanup_and_exit()
+    print()
+    pipeline.print_stats()
+
+    print('Frame buffers:')
+    for pool in (decode_pool, device_pool, render_pool):
+        print('  ' + pool.stats())
+    if warmup_allocs is not None:
+        print('  After warming up: %d new frame buffers, %d new cuda allocations'
+            % (decode_pool.num_allocs + device_pool.num_allocs + render_pool.num_allocs - warmup_allocs[0], cuda_alloc_count() - warmup_allocs[1]))
+    print()
+
+    if use_keyframes and select_keyframe.num_frames > 0:
+        print('Ran the network on %d / %d frames (%.1f%%), propagated the rest.'
+            % (select_keyframe.num_keyframes, select_keyframe.num_frames, select_keyframe.num_keyframes / select_keyframe.num_frames * 100))
+        if quality is not None:
+            print('Propagated detections: ' + quality.summary())
+        print()
+
+    if len(latencies) > 0:
+        latencies = np.array(latencies) * 1000
+        print('End-to-end latency per frame: mean %.1f ms | p50 %.1f ms | p90 %.1f ms | p99 %.1f ms'
+            % (latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99)))
+        print()
+
+    vid.release()
+    if out_path is not None:
+        out.release()
+    cv2.destroyAllWindows()
 
 def evaluate(net:Yolact, dataset, train_mode=False):
     net.detect.use_fast_nms = args.fast_nms
     net.detect.use_cross_class_nms = args.cross_class_nms
     cfg.mask_proto_debug = args.mask_proto_debug
 
+    pred_cache = None
+    if args.pred_cache_dir is not None and dataset is not None and not args.display and not args.benchmark:
+        min_conf = cfg.nms_conf_thresh if args.pred_cache_min_conf is None else args.pred_cache_min_conf
+        pred_cache = PredictionCacheWriter(args.pred_cache_dir, min_conf)
+        net.detect.prediction_hooks.append(pred_cache.record)
+
     # TODO Currently we do not support Fast Mask Re-scroing in evalimage, evalimages, and evalvideo
     if args.image is not None:
         if ':' in args.image:
@@ -895,6 +1432,8 @@ def evaluate(net:Yolact, dataset, train_mode=False):
         else:
             evalvideo(net, args.video)
         return
+    elif args.benchmark:
+        return benchmark(net, dataset)
 
     frame_times = MovingAverage()
     dataset_size = len(dataset) if args.max_images < 0 else min(args.max_images, len(dataset))
@@ -902,14 +1441,13 @@ def evaluate(net:Yolact, dataset, train_mode=False):
 
     print()
 
-    if not args.display and not args.benchmark:
-        # For each class and iou, stores tuples (score, isPositive)
-        # Index ap_data[type][iouIdx][classIdx]
-        ap_data = {
-            'box' : [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds],
-            'mask': [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds]
-        }
-        detections = Detections()
+    if not args.display:
+        ap_data = make_ap_data()
+        if args.output_coco_json and not args.output_web_json:
+            detections = StreamingDetections(args.bbox_det_file, args.mask_det_file,
+                                             line_delimited=args.coco_json_lines, resume=args.resume_coco_json)
+        else:
+            detections = Detections()
     else:
         timer.disable('Load Data')
 
@@ -932,57 +1470,90 @@ def evaluate(net:Yolact, dataset, train_mode=False):
 
     dataset_indices = dataset_indices[:dataset_size]
 
+    if args.output_coco_json and not args.display:
+        # Skip anything that an interrupted run already wrote out
+        num_done = len(dataset_indices)
+        dataset_indices = [idx for idx in dataset_indices if not detections.is_done(dataset.ids[idx])]
+        num_done -= len(dataset_indices)
+
+        if num_done > 0:
+            print('Resuming after %d images that were already written.' % num_done)
+            dataset_size = len(dataset_indices)
+            progress_bar = ProgressBar(30, max(dataset_size, 1))
+
+    batches = make_eval_batches(dataset, dataset_indices, args.batch_size)
+    num_processed = 0
+
     try:
         # Main eval loop
-        for it, image_idx in enumerate(dataset_indices):
+        for it, batch_indices in enumerate(batches):
             timer.reset()
 
             with timer.env('Load Data'):
-                img, gt, gt_masks, h, w, num_crowd = dataset.pull_item(image_idx)
+                items = [dataset.pull_item(image_idx) for image_idx in batch_indices]
 
                 # Test flag, do not upvote
                 if cfg.mask_proto_debug:
                     with open('scripts/info.txt', 'w') as f:
-                        f.write(str(dataset.ids[image_idx]))
-                    np.save('scripts/gt.npy', gt_masks)
+                        f.write(str(dataset.ids[batch_indices[0]]))
+                    np.save('scripts/gt.npy', items[0][2])
 
-                batch = Variable(img.unsqueeze(0))
-                if args.cuda:
-                    batch = batch.cuda()
+                # Stack the images that came out the same size (with preserve_aspect_ratio, that's not a given)
+                groups = OrderedDict()
+                for item_idx, item in enumerate(items):
+                    groups.setdefault(tuple(item[0].size()), []).append(item_idx)
+            
+            for group in groups.values():
+                with timer.env('Load Data'):
+                    batch = Variable(torch.stack([items[item_idx][0] for item_idx in group], dim=0))
+                    if args.cuda:
+                        batch = batch.cuda()
+
+                with timer.env('Network Extra'):
+                    preds = net(batch)
+
+                # Perform the meat of the operation here depending on our mode.
+                for batch_idx, item_idx in enumerate(group):
+                    img, gt, gt_masks, h, w, num_crowd = items[item_idx]
+                    image_id = dataset.ids[batch_indices[item_idx]]
+
+                    if args.display:
+                        img_numpy = prep_display(preds, img, h, w, batch_idx=batch_idx)
+                        
+                        # frame_times only gets this batch's time once the whole batch is done
+                        if frame_times.get_avg() > 0:
+                            print('Avg FPS: %.4f' % (1 / frame_times.get_avg()))
+                        plt.imshow(img_numpy)
+                        plt.title(str(image_id))
+                        plt.show()
+                    else:
+                        prep_metrics(ap_data, preds, img, gt, gt_masks, h, w, num_crowd, image_id, detections, batch_idx=batch_idx)
+                        detections.finish_image(image_id)
 
-            with timer.env('Network Extra'):
-                preds = net(batch)
-            # Perform the meat of the operation here depending on our mode.
-            if args.display:
-                img_numpy = prep_display(preds, img, h, w)
-            elif args.benchmark:
-                prep_benchmark(preds, h, w)
-            else:
-                prep_metrics(ap_data, preds, img, gt, gt_masks, h, w, num_crowd, dataset.ids[image_idx], detections)
+                        if pred_cache is not None:
+                            pred_cache.add(batch_idx, image_id, h, w, gt, gt_masks, num_crowd)
             
-            # First couple of images take longer because we're constructing the graph.
+            num_processed += len(batch_indices)
+
+            # First couple of batches take longer because we're constructing the graph.
             # Since that's technically initialization, don't include those in the FPS calculations.
             if it > 1:
-                frame_times.add(timer.total_time())
+                frame_times.add(timer.total_time() / len(batch_indices))
             
-            if args.display:
-                if it > 1:
-                    print('Avg FPS: %.4f' % (1 / frame_times.get_avg()))
-                plt.imshow(img_numpy)
-                plt.title(str(dataset.ids[image_idx]))
-                plt.show()
-            elif not args.no_bar:
+            if not args.display and not args.no_bar:
                 if it > 1: fps = 1 / frame_times.get_avg()
                 else: fps = 0
-                progress = (it+1) / dataset_size * 100
-                progress_bar.set_val(it+1)
-                print('\rProcessing Images  %s %6d / %6d (%5.2f%%)    %5.2f fps        '
-                    % (repr(progress_bar), it+1, dataset_size, progress, fps), end='')
+                progress = num_processed / dataset_size * 100
+                progress_bar.set_val(num_processed)
+                print('\rProcessing Images  %s %6d / %6d (%5.2f%%)    %5.2f img/s        '
+                    % (repr(progress_bar), num_processed, dataset_size, progress, fps), end='')
 
 
 
-        if not args.display and not args.benchmark:
+        if not args.display:
             print()
+            if frame_times.get_avg() > 0:
+                print('Average throughput: %.2f images / s (batch size %d)' % (1 / frame_times.get_avg(), args.batch_size))
             if args.output_coco_json:
                 print('Dumping detections...')
                 if args.output_web_json:
@@ -996,21 +1567,112 @@ def evaluate(net:Yolact, dataset, train_mode=False):
                         pickle.dump(ap_data, f)
 
                 return calc_map(ap_data)
-        elif args.benchmark:
-            print()
-            print()
-            print('Stats for the last frame:')
-            timer.print_stats()
-            avg_seconds = frame_times.get_avg()
-            print('Average: %5.2f fps, %5.2f ms' % (1 / frame_times.get_avg(), 1000*avg_seconds))
 
     except KeyboardInterrupt:
         print('Stopping...')
+    finally:
+        if pred_cache is not None:
+            # Whatever made it in before an interrupt is still usable
+            net.detect.prediction_hooks.remove(pred_cache.record)
+            pred_cache.close()
+
+
+def parse_sweep(sweep_str:str) -> list:
+    """ Turns a string like "nms_thresh=0.4,0.5;top_k=100" into a list of every combination of settings. """
+    defaults = OrderedDict([
+        ('nms_thresh',      cfg.nms_thresh),
+        ('nms_conf_thresh', cfg.nms_conf_thresh),
+        ('top_k',           cfg.nms_top_k),
+        ('score_threshold', args.score_threshold),
+        ('fast_nms',        args.fast_nms),
+        ('cross_class_nms', args.cross_class_nms),
+    ])
+    grid = OrderedDict((k, [v]) for k, v in defaults.items())
+
+    for item in sweep_str.split(';'):
+        if item.strip() == '':
+            continue
+        
+        name, vals = item.split('=')
+        name = name.strip()
+
+        if name not in sweep_settings:
+            raise ValueError('Can\'t sweep "%s". Choose from %s.' % (name, ', '.join(sweep_settings)))
+        
+        grid[name] = [sweep_settings[name](x.strip()) for x in vals.split(',')]
+
+    settings = [OrderedDict()]
+    for name, vals in grid.items():
+        settings = [OrderedDict(list(s.items()) + [(name, v)]) for s in settings for v in vals]
+
+    return settings
+
+def replay_predictions(net:Yolact, cache:PredictionCache, setting:dict):
+    """ Runs Detect, postprocess and prep_metrics on every image in the cache with the given settings. """
+    detect = Detect(cfg.num_classes, bkg_label=0, top_k=setting['top_k'],
+                    conf_thresh=setting['nms_conf_thresh'], nms_thresh=setting['nms_thresh'])
+    detect.use_fast_nms = setting['fast_nms']
+    detect.use_cross_class_nms = setting['cross_class_nms']
+
+    ap_data = make_ap_data()
+
+    with torch.no_grad():
+        for idx in range(len(cache)):
+            preds, (image_id, h, w, gt, gt_masks, num_crowd) = cache.get(idx, device='cuda' if args.cuda else 'cpu')
 
+            if gt is None or gt.shape[0] == 0:
+                continue
 
-def calc_map(ap_data):
-    print('Calculating mAP...')
+            dets = detect(preds, net)
+            prep_metrics(ap_data, dets, None, gt, gt_masks, h, w, num_crowd, image_id,
+                         score_threshold=setting['score_threshold'])
+
+    return calc_map(ap_data, verbose=False)
+
+def sweep(net:Yolact, cache:PredictionCache):
+    """ Replays the prediction cache with every setting in args.sweep and reports the mAP of each. """
+    settings = parse_sweep(args.sweep)
+
+    for setting in settings:
+        if setting['nms_conf_thresh'] < cache.min_conf:
+            print('Warning: nms_conf_thresh=%s is under the %s the prediction cache was saved with, so its results will be off.'
+                % (setting['nms_conf_thresh'], cache.min_conf))
+
+    # Nothing here needs timing, but put the timer back how it was for anything that runs after this
+    timer_was_enabled = timer.is_enabled()
+    timer.disable_all()
+
+    print('Replaying %d images with %d settings...' % (len(cache), len(settings)))
+    try:
+        # These run one after the other: Detect and prep_metrics are mostly python, so threads don't buy much
+        # and would share the one cuda context, which makes the results depend on scheduling.
+        results = []
+        for idx, setting in enumerate(settings):
+            results.append(replay_predictions(net, cache, setting))
+            print('\rReplayed %d / %d settings' % (idx + 1, len(settings)), end='')
+        print()
+    finally:
+        if timer_was_enabled:
+            timer.enable_all()
+
+    make_row = lambda vals: (' %15s |' * len(vals)) % tuple(vals)
+    
+    print()
+    print(make_row(list(settings[0].keys()) + ['box mAP', 'mask mAP']))
+    for setting, all_maps in sorted(zip(settings, results), key=lambda x: -x[1]['mask']['all']):
+        print(make_row([str(x) for x in setting.values()] + ['%.2f' % all_maps['box']['all'], '%.2f' % all_maps['mask']['all']]))
+    print()
+
+    with open(args.sweep_file, 'w') as f:
+        json.dump([{'setting': s, 'maps': m} for s, m in zip(settings, results)], f)
+    print('Saved sweep results to %s.' % args.sweep_file)
+
+
+def calc_map(ap_data, verbose:bool=True):
+    if verbose:
+        print('Calculating mAP...')
     aps = [{'box': [], 'mask': []} for _ in iou_thresholds]
+    class_aps = {'box': [[] for _ in cfg.dataset.class_names], 'mask': [[] for _ in cfg.dataset.class_names]}
 
     for _class in range(len(cfg.dataset.class_names)):
         for iou_idx in range(len(iou_thresholds)):
@@ -1018,7 +1680,9 @@ def calc_map(ap_data):
                 ap_obj = ap_data[iou_type][iou_idx][_class]
 
                 if not ap_obj.is_empty():
-                    aps[iou_idx][iou_type].append(ap_obj.get_ap())
+                    ap = ap_obj.get_ap()
+                    aps[iou_idx][iou_type].append(ap)
+                    class_aps[iou_type][_class].append(ap)
 
     all_maps = {'box': OrderedDict(), 'mask': OrderedDict()}
 
@@ -1029,26 +1693,73 @@ def calc_map(ap_data):
             mAP = sum(aps[i][iou_type]) / len(aps[i][iou_type]) * 100 if len(aps[i][iou_type]) > 0 else 0
             all_maps[iou_type][int(threshold*100)] = mAP
         all_maps[iou_type]['all'] = (sum(all_maps[iou_type].values()) / (len(all_maps[iou_type].values())-1))
+
+    # ap_data pickled before area ranges were a thing won't have these
+    if 'area' in ap_data:
+        for area_name in area_ranges:
+            for iou_type in ('box', 'mask'):
+                area_aps = []
+                for ap_by_class in ap_data['area'][area_name][iou_type]:
+                    # Unlike 'all', skip classes with no gt in this range like COCOEval does (otherwise most classes get a 0 for large)
+                    aps_for_iou = [ap_obj.get_ap() for ap_obj in ap_by_class if ap_obj.num_gt_positives > 0]
+                    area_aps.append(sum(aps_for_iou) / len(aps_for_iou) * 100 if len(aps_for_iou) > 0 else 0)
+                all_maps[iou_type][area_name] = sum(area_aps) / len(area_aps)
     
-    print_maps(all_maps)
+    if verbose:
+        print_maps(all_maps)
+
+    if args.class_ap:
+        per_class = {iou_type: OrderedDict((name, sum(x) / len(x) * 100)
+                        for name, x in zip(cfg.dataset.class_names, class_aps[iou_type]) if len(x) > 0)
+                     for iou_type in ('box', 'mask')}
+        
+        if verbose:
+            print_class_maps(per_class)
     
     # Put in a prettier format so we can serialize it to json during training
     all_maps = {k: {j: round(u, 2) for j, u in v.items()} for k, v in all_maps.items()}
+    if args.class_ap:
+        all_maps['class'] = {k: {j: round(u, 2) for j, u in v.items()} for k, v in per_class.items()}
     return all_maps
 
 def print_maps(all_maps):
     # Warning: hacky 
     make_row = lambda vals: (' %5s |' * len(vals)) % tuple(vals)
     make_sep = lambda n:  ('-------+' * n)
+    make_val = lambda x: '%.2f' % x if x < 100 else '%.1f' % x
+
+    thresholds = [k for k in all_maps['box'].keys() if k not in area_ranges]
+    areas = [k for k in all_maps['box'].keys() if k in area_ranges]
 
     print()
-    print(make_row([''] + [('.%d ' % x if isinstance(x, int) else x + ' ') for x in all_maps['box'].keys()]))
-    print(make_sep(len(all_maps['box']) + 1))
+    print(make_row([''] + [('.%d ' % x if isinstance(x, int) else x + ' ') for x in thresholds]))
+    print(make_sep(len(thresholds) + 1))
     for iou_type in ('box', 'mask'):
-        print(make_row([iou_type] + ['%.2f' % x if x < 100 else '%.1f' % x for x in all_maps[iou_type].values()]))
-    print(make_sep(len(all_maps['box']) + 1))
+        print(make_row([iou_type] + [make_val(all_maps[iou_type][x]) for x in thresholds]))
+    print(make_sep(len(thresholds) + 1))
     print()
 
+    if len(areas) > 0:
+        make_row = lambda vals: (' %6s |' * len(vals)) % tuple(vals)
+        make_sep = lambda n:  ('--------+' * n)
+
+        print(make_row([''] + areas))
+        print(make_sep(len(areas) + 1))
+        for iou_type in ('box', 'mask'):
+            print(make_row([iou_type] + [make_val(all_maps[iou_type][x]) for x in areas]))
+        print(make_sep(len(areas) + 1))
+        print()
+
+def print_class_maps(per_class):
+    names = list(per_class['box'].keys())
+    name_width = max([len(x) for x in names] + [5])
+    make_row = lambda vals: (' %' + str(name_width) + 's |' + ' %6s |' * (len(vals) - 1)) % tuple(vals)
+
+    print(make_row(['class', 'box', 'mask']))
+    print('-' * (name_width + 2) + '+' + '--------+' * 2)
+    for name in names:
+        print(make_row([name] + ['%.2f' % per_class[iou_type].get(name, 0) for iou_type in ('box', 'mask')]))
+    print()
 
 
 if __name__ == '__main__':
@@ -1091,9 +1802,31 @@ if __name__ == '__main__':
             calc_map(ap_data)
             exit()
 
+        if args.sweep is not None:
+            if args.pred_cache_dir is None:
+                print('Error: --sweep needs a --pred_cache_dir saved by a previous evaluation.')
+                exit(-1)
+            
+            print('Loading model...', end='')
+            net = Yolact()
+            net.load_weights(args.trained_model)
+            net.eval()
+            print(' Done.')
+
+            if args.cuda:
+                net = net.cuda()
+
+            # The network itself isn't run, but Detect and postprocess need it for the mask iou net
+            sweep(net, PredictionCache(args.pred_cache_dir))
+            exit()
+
         if args.image is None and args.video is None and args.images is None:
-            dataset = COCODetection(cfg.dataset.valid_images, cfg.dataset.valid_info,
-                                    transform=BaseTransform(), has_gt=cfg.dataset.has_gt)
+            if args.shards is not None:
+                dataset = COCOShardDataset(args.shards, transform=BaseTransform(), has_gt=cfg.dataset.has_gt, report_orig_size=True)
+            else:
+                dataset = COCODetection(cfg.dataset.valid_images, cfg.dataset.valid_info,
+                                        transform=BaseTransform(), has_gt=cfg.dataset.has_gt,
+                                        gt_cache_dir=args.gt_cache_dir)
             prep_coco_cats()
         else:
             dataset = None        
@@ -1107,6 +1840,10 @@ if __name__ == '__main__':
         if args.cuda:
             net = net.cuda()
 
-        evaluate(net, dataset)
+        results = evaluate(net, dataset)
+
+        # Leave the exit code for --benchmark_baseline out here so benchmark can be called from elsewhere
+        if args.benchmark and results is not None and results.get('regressed', False):
+            exit(1)
 
 
@@ -29,6 +29,9 @@ class Detect(object):
         self.use_cross_class_nms = False
         self.use_fast_nms = False
 
+        # Functions that get called with the raw predictions before NMS (e.g., PredictionCacheWriter.record)
+        self.prediction_hooks = []
+
     def __call__(self, predictions, net):
         """
         Args:
@@ -50,6 +53,9 @@ class Detect(object):
             Note that the outputs are sorted only if cross_class_nms is False
         """
 
+        for hook in self.prediction_hooks:
+            hook(predictions)
+
         loc_data   = predictions['loc']
         conf_data  = predictions['conf']
         mask_data  = predictions['mask']
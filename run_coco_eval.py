@@ -5,19 +5,41 @@ outputted by using the output_coco_json flag in evaluate.py.
 
 
 import argparse
+import json
+import os
 
+import numpy as np
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 
+from utils.cocoeval import FastCOCOeval
+
 
 parser = argparse.ArgumentParser(description='COCO Detections Evaluator')
 parser.add_argument('--bbox_det_file', default='results/bbox_detections.json', type=str)
 parser.add_argument('--mask_det_file', default='results/mask_detections.json', type=str)
 parser.add_argument('--gt_ann_file',   default='data/coco/annotations/instances_val2017.json', type=str)
 parser.add_argument('--eval_type',     default='both', choices=['bbox', 'mask', 'both'], type=str)
+parser.add_argument('--evaluator',     default='fast', choices=['fast', 'coco'], type=str,
+                    help='Use our vectorized evaluator (fast) or the stock pycocotools COCOeval (coco).')
+parser.add_argument('--num_workers',   default=os.cpu_count(), type=int,
+                    help='The number of processes the fast evaluator splits the images over.')
+parser.add_argument('--validate',      dest='validate', action='store_true',
+                    help='Run both evaluators and check that the fast one gives the same stats as COCOeval.')
 args = parser.parse_args()
 
 
+def load_dets(path):
+	""" Loads a detections file that's either one json list or one json detection per line (see --coco_json_lines). """
+	with open(path, 'r') as f:
+		if f.read(1) == '[':
+			f.seek(0)
+			return json.load(f)
+		
+		f.seek(0)
+		return [json.loads(line) for line in f if line.strip()]
+
+
 
 if __name__ == '__main__':
 
@@ -27,23 +49,40 @@ if __name__ == '__main__':
 	print('Loading annotations...')
 	gt_annotations = COCO(args.gt_ann_file)
 	if eval_bbox:
-		bbox_dets = gt_annotations.loadRes(args.bbox_det_file)
+		bbox_dets = gt_annotations.loadRes(load_dets(args.bbox_det_file))
 	if eval_mask:
-		mask_dets = gt_annotations.loadRes(args.mask_det_file)
+		mask_dets = gt_annotations.loadRes(load_dets(args.mask_det_file))
 
+	cocoDts = {}
 	if eval_bbox:
-		print('\nEvaluating BBoxes:')
-		bbox_eval = COCOeval(gt_annotations, bbox_dets, 'bbox')
-		bbox_eval.evaluate()
-		bbox_eval.accumulate()
-		bbox_eval.summarize()
-	
+		cocoDts['bbox'] = bbox_dets
 	if eval_mask:
-		print('\nEvaluating Masks:')
-		bbox_eval = COCOeval(gt_annotations, mask_dets, 'segm')
-		bbox_eval.evaluate()
-		bbox_eval.accumulate()
-		bbox_eval.summarize()
-
+		cocoDts['segm'] = mask_dets
 
+	if args.evaluator == 'fast' or args.validate:
+		print('\nEvaluating %s with %d workers:' % (' and '.join(cocoDts.keys()), args.num_workers))
+		fast_eval = FastCOCOeval(gt_annotations, cocoDts, num_workers=args.num_workers)
+		fast_eval.evaluate()
+		fast_eval.accumulate()
+		fast_eval.summarize()
+	
+	if args.evaluator == 'coco' or args.validate:
+		coco_stats = {}
+		for iou_type, dets in cocoDts.items():
+			print('\nEvaluating %s:' % ('BBoxes' if iou_type == 'bbox' else 'Masks'))
+			coco_eval = COCOeval(gt_annotations, dets, iou_type)
+			coco_eval.evaluate()
+			coco_eval.accumulate()
+			coco_eval.summarize()
+			coco_stats[iou_type] = coco_eval.stats
 
+	if args.validate:
+		print()
+		passed = True
+		for iou_type in cocoDts:
+			diff = np.abs(fast_eval.stats[iou_type] - coco_stats[iou_type]).max()
+			passed = passed and diff <= 1e-4
+			print('%s: max difference from COCOeval is %.2e' % (iou_type, diff))
+		
+		print('Validation %s.' % ('passed' if passed else 'FAILED'))
+		exit(0 if passed else 1)
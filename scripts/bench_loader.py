@@ -0,0 +1,222 @@
+"""
+Throughput benchmark for the training data loader, with no model involved.
+
+Runs COCODetection + SSDAugmentation + a collate function through a DataLoader for each of the given
+worker counts and prints:
+    - How many samples / second the loader gives the main process (this is the most training could get).
+    - How many samples / second each worker makes on its own (use this to size num_workers for a host).
+    - Where each sample's time goes: decoding the image, getting the GT (annToMask or its index / cache
+      equivalent), each augmentation in SSDAugmentation, and collating. "other" is everything else in
+      pull_item, like retrying augmentations that came out empty.
+
+If training is slower than the loader's samples / second, it's not loader bound. If it's about the same,
+more workers (or cheaper stages) will help, up to the number of cores.
+
+Run this script from the Yolact root directory:
+    python scripts/bench_loader.py --config=yolact_base_config --num_workers=0,2,4,8 --num_batches=50
+"""
+
+import os.path as osp
+import sys
+import time
+import math
+import argparse
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+
+import torch
+import torch.utils.data as data
+
+from data import cfg, set_cfg, set_dataset, MEANS, COCODetection, detection_collate, packed_collate
+from utils.augmentations import SSDAugmentation, do_nothing
+
+
+def str2bool(v):
+    return v.lower() in ('yes', 'true', 't', '1')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Data loader throughput benchmark')
+    parser.add_argument('--config', default=None, type=str,
+                        help='The config object to use (the dataset and augmentations come from this).')
+    parser.add_argument('--dataset', default=None, type=str,
+                        help='If specified, override the dataset specified in the config with this one (example: coco2017_dataset).')
+    parser.add_argument('--valid', default=False, type=str2bool,
+                        help='Load the validation set instead of the training set (still with the training augmentations).')
+    parser.add_argument('--num_workers', default='0,2,4', type=str,
+                        help='A comma separated list of worker counts to benchmark.')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--num_batches', default=50, type=int,
+                        help='How many batches to time for each worker count.')
+    parser.add_argument('--warmup_batches', default=5, type=int,
+                        help='How many batches to load before starting the clock (so worker startup doesn\'t count).')
+    parser.add_argument('--packed_collate', default=False, type=str2bool,
+                        help='Use packed_collate instead of detection_collate (see data/batching.py).')
+    parser.add_argument('--target_rate', default=None, type=float,
+                        help='If set, estimate how many workers it takes to load this many samples / second.')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+class StageTimes:
+    """
+    Time spent in each stage and the number of samples, per worker. Like LoaderStats, this lives in
+    shared memory with one row per worker (row 0 is the main process), so the workers can write to it.
+    """
+
+    def __init__(self, stages:list, max_workers:int):
+        self.stages = list(stages)
+        self.max_workers = max_workers
+        self.times   = torch.zeros(max_workers + 1, len(self.stages), dtype=torch.float64).share_memory_()
+        self.samples = torch.zeros(max_workers + 1, dtype=torch.float64).share_memory_()
+
+    def _row(self):
+        info = data.get_worker_info()
+        return 0 if info is None else info.id % self.max_workers + 1
+
+    def add(self, stage:str, elapsed:float):
+        self.times[self._row(), self.stages.index(stage)] += elapsed
+
+    def add_sample(self):
+        self.samples[self._row()] += 1
+
+    def reset(self):
+        self.times.zero_()
+        self.samples.zero_()
+
+
+class Timed:
+    """ Calls fn and adds how long it took to stage. """
+
+    def __init__(self, stage:str, fn, times:StageTimes):
+        self.stage = stage
+        self.fn = fn
+        self.times = times
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        out = self.fn(*args, **kwargs)
+        self.times.add(self.stage, time.perf_counter() - start)
+        return out
+
+
+class TimedCOCODetection(COCODetection):
+    """ COCODetection that records how long decoding, getting the GT and the whole sample take. """
+
+    def __init__(self, *args, times:StageTimes=None, **kwargs):
+        self.times = times
+        super().__init__(*args, **kwargs)
+
+    def load_image(self, index, reduce=1):
+        start = time.perf_counter()
+        img = super().load_image(index, reduce=reduce)
+        self.times.add('decode', time.perf_counter() - start)
+        return img
+
+    def pull_gt(self, img_id, height, width, lazy=False, orig_size=None):
+        start = time.perf_counter()
+        gt = super().pull_gt(img_id, height, width, lazy=lazy, orig_size=orig_size)
+        self.times.add('annToMask', time.perf_counter() - start)
+        return gt
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        out = super().__getitem__(index)
+        self.times.add('sample', time.perf_counter() - start)
+        self.times.add_sample()
+        return out
+
+
+def make_transform(times:StageTimes=None):
+    """ Returns SSDAugmentation with every enabled augmentation wrapped in Timed, and the names of those stages. """
+    transform = SSDAugmentation(MEANS)
+    stages = []
+
+    for idx, t in enumerate(transform.augment.transforms):
+        if t is do_nothing:
+            continue
+
+        name = type(t).__name__
+        if name in stages:
+            name = '%s_%d' % (name, idx)
+        stages.append(name)
+
+        if times is not None:
+            transform.augment.transforms[idx] = Timed(name, t, times)
+
+    return transform, stages
+
+
+def report(times:StageTimes, loader_stats, num_workers:int, consumed:int, wall_time:float, aug_stages:list, target_rate:float):
+    rows = slice(1, num_workers + 1) if num_workers > 0 else slice(0, 1)
+    stage_times = times.times[rows].sum(dim=0)
+    samples = max(float(times.samples[rows].sum()), 1)
+
+    def total(stage):
+        return float(stage_times[times.stages.index(stage)])
+
+    # Everything in __getitem__ that isn't one of the other stages
+    other = total('sample') - sum(total(stage) for stage in ['decode', 'annToMask'] + aug_stages)
+    breakdown = [(stage, total(stage)) for stage in ['decode', 'annToMask'] + aug_stages + ['collate']] + [('other', other)]
+    busy = total('sample') + total('collate')
+
+    per_worker = samples / max(busy, 1e-9)
+    print('num_workers = %d: %.1f samples/s from the loader | %.1f samples/s per worker | %.2f ms/sample in the workers'
+          % (num_workers, consumed / max(wall_time, 1e-9), per_worker, busy / samples * 1000))
+
+    for stage, stage_time in sorted(breakdown, key=lambda x: -x[1]):
+        print('    %-24s | %8.3f ms/sample | %5.1f%%' % (stage, stage_time / samples * 1000, stage_time / max(busy, 1e-9) * 100))
+
+    if target_rate is not None:
+        print('    Workers needed for %.1f samples/s: about %d' % (target_rate, math.ceil(target_rate / max(per_worker, 1e-9))))
+    print('    ' + loader_stats.summary())
+    print()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    torch.manual_seed(args.seed)
+
+    if args.config is not None:
+        set_cfg(args.config)
+    if args.dataset is not None:
+        set_dataset(args.dataset)
+
+    worker_counts = [int(x) for x in args.num_workers.split(',')]
+
+    _, aug_stages = make_transform()
+    times = StageTimes(['sample', 'decode', 'annToMask'] + aug_stages + ['collate'], max(worker_counts + [1]))
+    transform, _ = make_transform(times)
+
+    dataset = TimedCOCODetection(image_path=cfg.dataset.valid_images if args.valid else cfg.dataset.train_images,
+                                 info_file=cfg.dataset.valid_info if args.valid else cfg.dataset.train_info,
+                                 transform=transform, skip_unusable=True, times=times)
+    collate_fn = Timed('collate', packed_collate if args.packed_collate else detection_collate, times)
+
+    print('Loading %d batches of %d from %s for each worker count.' % (args.num_batches, args.batch_size, cfg.dataset.name))
+    print()
+
+    for num_workers in worker_counts:
+        data_loader = data.DataLoader(dataset, args.batch_size, num_workers=num_workers,
+                                      shuffle=True, collate_fn=collate_fn, drop_last=True)
+        loader_iter = iter(data_loader)
+
+        for _ in range(args.warmup_batches):
+            next(loader_iter)
+
+        times.reset()
+        dataset.stats.reset()
+        start = time.perf_counter()
+        consumed = 0
+
+        for _ in range(args.num_batches):
+            try:
+                next(loader_iter)
+            except StopIteration:
+                loader_iter = iter(data_loader)
+                next(loader_iter)
+            consumed += args.batch_size
+
+        wall_time = time.perf_counter() - start
+        del loader_iter
+
+        report(times, dataset.stats, num_workers, consumed, wall_time, aug_stages, args.target_rate)
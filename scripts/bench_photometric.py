@@ -0,0 +1,97 @@
+"""
+Microbenchmark for the photometric distortion in SSDAugmentation.
+
+Times PhotometricDistort (with the ConvertFromInts it needs) against LUTPhotometricDistort on the same
+images and prints the per sample time of each. It also prints the mean and standard deviation of the
+output pixels over all the samples, so you can check the two give about the same distribution.
+
+Run this script from the Yolact root directory:
+    python scripts/bench_photometric.py --images=data/coco/images --num_images=50
+or, with random images of a given size:
+    python scripts/bench_photometric.py --size=640x480
+"""
+
+import os
+import os.path as osp
+import sys
+import time
+import argparse
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+
+import cv2
+import numpy as np
+
+from utils.augmentations import ConvertFromInts, PhotometricDistort, LUTPhotometricDistort
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Photometric distortion microbenchmark')
+    parser.add_argument('--images', default=None, type=str,
+                        help='A folder of images to use. If not set, uses random images of --size.')
+    parser.add_argument('--num_images', default=20, type=int,
+                        help='How many images to load from --images (or how many random images to make).')
+    parser.add_argument('--size', default='640x480', type=str,
+                        help='The WxH of the random images if --images isn\'t set.')
+    parser.add_argument('--iters', default=500, type=int,
+                        help='How many samples to time for each implementation.')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def load_images(args):
+    if args.images is None:
+        width, height = [int(x) for x in args.size.split('x')]
+        # Smooth random images look a lot more like real ones than noise does
+        return [cv2.resize(np.random.randint(0, 256, (height // 16, width // 16, 3), dtype=np.uint8), (width, height))
+                for _ in range(args.num_images)]
+
+    names = sorted([x for x in os.listdir(args.images) if x.lower().endswith(('.jpg', '.jpeg', '.png'))])
+    return [cv2.imread(osp.join(args.images, name)) for name in names[:args.num_images]]
+
+
+def bench(name, fn, images, iters):
+    # Warm up so the first call's allocations don't count
+    for img in images[:2]:
+        fn(img)
+
+    total = 0
+    pixel_sum, pixel_sq_sum, num_pixels = 0, 0, 0
+
+    for i in range(iters):
+        img = images[i % len(images)]
+
+        start = time.perf_counter()
+        out = fn(img)
+        total += time.perf_counter() - start
+
+        pixel_sum += float(out.sum(dtype=np.float64))
+        pixel_sq_sum += float(np.square(out, dtype=np.float64).sum())
+        num_pixels += out.size
+
+    mean = pixel_sum / num_pixels
+    std = np.sqrt(max(pixel_sq_sum / num_pixels - mean ** 2, 0))
+    ms = total / iters * 1000
+
+    print(' %-24s | %8.3f ms/sample | output mean %7.2f | output std %7.2f' % (name, ms, mean, std))
+    return ms
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(args.seed)
+
+    images = load_images(args)
+    height, width = images[0].shape[:2]
+    print('Timing %d samples on %d images (the first is %dx%d).' % (args.iters, len(images), width, height))
+    print()
+
+    float_distort = PhotometricDistort()
+    lut_distort = LUTPhotometricDistort()
+    to_float = ConvertFromInts()
+
+    float_ms = bench('PhotometricDistort', lambda img: float_distort(to_float(img)[0], None, None, None)[0], images, args.iters)
+    lut_ms   = bench('LUTPhotometricDistort', lambda img: lut_distort(img)[0], images, args.iters)
+
+    print()
+    print('Speedup: %.2fx' % (float_ms / max(lut_ms, 1e-9)))
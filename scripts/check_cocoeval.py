@@ -0,0 +1,205 @@
+"""
+Checks that FastCOCOeval (utils/cocoeval.py) gives the same results as pycocotools' COCOeval.
+
+This makes a synthetic ground truth set and detections for it that hit all the annoying cases:
+    - gt in every area range (small, medium and large), including some close to the range boundaries,
+    - crowd regions as uncompressed RLE (so detections on them get ignored instead of counted as false positives),
+    - gt with an 'ignore' flag (which COCOeval overrides with iscrowd, so it should do nothing),
+    - images with more detections than the biggest maxDets, images with detections but no gt, and
+      categories with gt but no detections,
+    - duplicate detections and tied scores.
+
+Then it runs both evaluators for bbox and segm and checks that the summary stats and the full
+precision / recall tables match to within 1e-4. It exits with an error if they don't.
+
+Run this script from the Yolact root directory:
+    python scripts/check_cocoeval.py
+"""
+
+import os.path as osp
+import sys
+import argparse
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+
+import numpy as np
+from pycocotools import mask as maskUtils
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+
+from utils.cocoeval import FastCOCOeval
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check FastCOCOeval against COCOeval')
+    parser.add_argument('--num_images', default=40, type=int)
+    parser.add_argument('--num_workers', default=2, type=int,
+                        help='The number of processes for FastCOCOeval (use 1 to check the single process path).')
+    parser.add_argument('--tolerance', default=1e-4, type=float)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+# Radii that put a polygon in each of COCO's area ranges (small < 32^2 < medium < 96^2 < large)
+radius_ranges = [(3, 14), (15, 20), (20, 50), (53, 58), (60, 150)]
+num_categories = 4
+
+
+def random_polygon(rng, cx, cy, radius, h, w):
+    """ A random star-ish polygon around (cx, cy) as a COCO polygon list, clipped to the image. """
+    num_points = rng.randint(3, 12)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, num_points))
+    radii  = radius * rng.uniform(0.6, 1.0, num_points)
+
+    xs = np.clip(cx + radii * np.cos(angles), 0, w - 1)
+    ys = np.clip(cy + radii * np.sin(angles), 0, h - 1)
+    return [np.stack([xs, ys], axis=1).flatten().tolist()]
+
+
+def poly_rle(poly, h, w):
+    return maskUtils.merge(maskUtils.frPyObjects(poly, h, w))
+
+
+def uncompressed_rle(mask):
+    """ Encodes a binary mask as an uncompressed (list of counts) RLE like COCO's crowd annotations. """
+    flat = mask.flatten(order='F')
+    changes = np.nonzero(flat[1:] != flat[:-1])[0] + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]])).tolist()
+
+    # The counts always start with a run of zeros, even if it's empty
+    if flat[0] == 1:
+        counts = [0] + counts
+    return {'size': list(mask.shape), 'counts': [int(x) for x in counts]}
+
+
+def make_fixture(rng, num_images):
+    images, gt_anns, bbox_dets, segm_dets = [], [], [], []
+
+    def add_det(img_id, cat, rle, score):
+        bbox = maskUtils.toBbox(rle).tolist()
+        if bbox[2] <= 0 or bbox[3] <= 0:
+            return
+        bbox_dets.append({'image_id': img_id, 'category_id': cat, 'bbox': bbox, 'score': score})
+        segm_dets.append({'image_id': img_id, 'category_id': cat, 'segmentation': rle, 'score': score})
+
+    def random_score():
+        # Round some scores so there are ties
+        score = rng.uniform(0.05, 1)
+        return round(score, 1) if rng.rand() < 0.3 else score
+
+    for img_id in range(1, num_images + 1):
+        h, w = rng.randint(200, 480), rng.randint(200, 640)
+        images.append({'id': img_id, 'height': h, 'width': w, 'file_name': '%06d.jpg' % img_id})
+
+        # Every 7th image has no gt at all, just false positives
+        num_gt = 0 if img_id % 7 == 0 else rng.randint(1, 12)
+
+        for _ in range(num_gt):
+            # The last category never gets any detections
+            cat = rng.randint(1, num_categories + 1)
+            radius = rng.uniform(*radius_ranges[rng.randint(len(radius_ranges))])
+            cx, cy = rng.uniform(0, w), rng.uniform(0, h)
+
+            poly = random_polygon(rng, cx, cy, radius, h, w)
+            rle = poly_rle(poly, h, w)
+            area = float(maskUtils.area(rle))
+            if area == 0:
+                continue
+
+            ann = {'id': len(gt_anns) + 1, 'image_id': img_id, 'category_id': cat, 'segmentation': poly,
+                   'area': area, 'bbox': maskUtils.toBbox(rle).tolist(), 'iscrowd': 0}
+            if rng.rand() < 0.1:
+                ann['ignore'] = 1
+            gt_anns.append(ann)
+
+            if cat == num_categories or rng.rand() < 0.15:
+                continue # Missed
+
+            # A noisy detection of this gt, and sometimes a duplicate of it
+            for _ in range(2 if rng.rand() < 0.2 else 1):
+                noisy = random_polygon(rng, cx + rng.normal(0, radius * 0.15), cy + rng.normal(0, radius * 0.15),
+                                       radius * rng.uniform(0.7, 1.3), h, w)
+                add_det(img_id, cat, poly_rle(noisy, h, w), random_score())
+
+        # Crowd regions, and sometimes a detection right on top of one
+        if rng.rand() < 0.4:
+            cat = rng.randint(1, num_categories)
+            x0, y0 = rng.randint(0, w // 2), rng.randint(0, h // 2)
+            x1, y1 = x0 + rng.randint(20, w // 2), y0 + rng.randint(20, h // 2)
+
+            mask = np.zeros((h, w), dtype=np.uint8)
+            mask[y0:y1, x0:x1] = 1
+            crowd = uncompressed_rle(mask)
+            crowd_rle = maskUtils.frPyObjects(crowd, h, w)
+
+            gt_anns.append({'id': len(gt_anns) + 1, 'image_id': img_id, 'category_id': cat, 'segmentation': crowd,
+                            'area': float(maskUtils.area(crowd_rle)), 'bbox': maskUtils.toBbox(crowd_rle).tolist(), 'iscrowd': 1})
+
+            if rng.rand() < 0.7:
+                inner = mask.copy()
+                inner[y0:y0 + (y1 - y0) // 3] = 0
+                add_det(img_id, cat, maskUtils.encode(np.asfortranarray(inner)), random_score())
+
+        # False positives, and on every 5th image more than the 100 detections COCOeval keeps
+        num_fp = 110 if img_id % 5 == 0 else rng.randint(0, 5)
+        for _ in range(num_fp):
+            cat = rng.randint(1, num_categories)
+            radius = rng.uniform(*radius_ranges[rng.randint(len(radius_ranges))])
+            poly = random_polygon(rng, rng.uniform(0, w), rng.uniform(0, h), radius, h, w)
+            add_det(img_id, cat, poly_rle(poly, h, w), random_score())
+
+    dataset = {
+        'images': images,
+        'annotations': gt_anns,
+        'categories': [{'id': cat, 'name': 'class_%d' % cat} for cat in range(1, num_categories + 1)],
+    }
+
+    return dataset, bbox_dets, segm_dets
+
+
+def max_diff(a, b):
+    return float(np.abs(np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)).max())
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+
+    dataset, bbox_dets, segm_dets = make_fixture(rng, args.num_images)
+    print('Made %d images with %d gt (%d crowds), and %d detections.' % (len(dataset['images']), len(dataset['annotations']),
+          sum([ann['iscrowd'] for ann in dataset['annotations']]), len(bbox_dets)))
+
+    coco_gt = COCO()
+    coco_gt.dataset = dataset
+    coco_gt.createIndex()
+
+    coco_dts = {'bbox': coco_gt.loadRes(bbox_dets), 'segm': coco_gt.loadRes(segm_dets)}
+
+    fast_eval = FastCOCOeval(coco_gt, coco_dts, num_workers=args.num_workers)
+    fast_eval.evaluate()
+    fast_eval.accumulate()
+    fast_eval.summarize(verbose=False)
+
+    passed = True
+    print()
+
+    for iou_type, coco_dt in coco_dts.items():
+        coco_eval = COCOeval(coco_gt, coco_dt, iou_type)
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+
+        diffs = {
+            'stats':     max_diff(fast_eval.stats[iou_type], coco_eval.stats),
+            'precision': max_diff(fast_eval.eval[iou_type]['precision'], coco_eval.eval['precision']),
+            'recall':    max_diff(fast_eval.eval[iou_type]['recall'], coco_eval.eval['recall']),
+        }
+
+        for name, diff in diffs.items():
+            ok = diff <= args.tolerance
+            passed = passed and ok
+            print('%-4s %-9s: max difference from COCOeval is %.2e %s' % (iou_type, name, diff, '' if ok else '<- FAILED'))
+        print()
+
+    print('Check %s.' % ('passed' if passed else 'FAILED'))
+    exit(0 if passed else 1)
@@ -1,5 +1,6 @@
 from data import *
 from utils.augmentations import SSDAugmentation, BaseTransform
+from utils.gpu_augmentations import BatchSSDAugmentation, decoded_collate
 from utils.functions import MovingAverage, SavePath
 from utils.logger import Log
 from utils import timer
@@ -38,6 +39,15 @@ parser.add_argument('--resume', default=None, type=str,
 parser.add_argument('--start_iter', default=-1, type=int,
                     help='Resume training at this iter. If this is -1, the iteration will be'\
                          'determined from the file name.')
+parser.add_argument('--ar_buckets', default=0, type=int,
+                    help='With preserve_aspect_ratio, batch together images from this many aspect ratio buckets and pad each batch '
+                         'to its biggest image instead of resizing everything to one random image\'s size. 0 (the default) turns this off.')
+parser.add_argument('--gpu_augment', default=False, type=str2bool,
+                    help='If true, the dataloader workers only decode and all the augmentation happens on the gpu for the whole batch at once '
+                         '(see utils/gpu_augmentations.py). Doesn\'t work with preserve_aspect_ratio.')
+parser.add_argument('--packed_collate', default=False, type=str2bool,
+                    help='If true, the workers pack each batch into a few big shared memory tensors that get sent to the gpu '
+                         'in one go, instead of a list of tensors per sample (see PackedBatch in data/batching.py).')
 parser.add_argument('--num_workers', default=4, type=int,
                     help='Number of workers used in dataloading')
 parser.add_argument('--cuda', default=True, type=str2bool,
@@ -60,6 +70,8 @@ parser.add_argument('--save_interval', default=10000, type=int,
                     help='The number of iterations between saving the model.')
 parser.add_argument('--validation_size', default=5000, type=int,
                     help='The number of images to use for validation.')
+parser.add_argument('--validation_batch_size', default=None, type=int,
+                    help='The batch size to use when computing validation mAP. Defaults to --batch_size.')
 parser.add_argument('--validation_epoch', default=2, type=int,
                     help='Output validation information every n iterations. If -1, do no validation.')
 parser.add_argument('--keep_latest', dest='keep_latest', action='store_true',
@@ -80,6 +92,15 @@ parser.add_argument('--no_autoscale', dest='autoscale', action='store_false',
                     help='YOLACT will automatically scale the lr and the number of iterations depending on the batch size. Set this if you want to disable that.')
 parser.add_argument('--max_iter', default=None,type=int,
                     help='Max iteration')
+parser.add_argument('--gt_cache_dir', default=None, type=str,
+                    help='If set, cache the validation ground truth in this folder so computing validation mAP doesn\'t rebuild it every time.')
+parser.add_argument('--train_shards', default=None, type=str,
+                    help='If set, read the training set from shards made by data/scripts/make_shards.py in this folder instead of the images and annotation file.')
+parser.add_argument('--valid_shards', default=None, type=str,
+                    help='Same as --train_shards, but for the validation set.')
+parser.add_argument('--ram_cache_mb', default=0, type=int,
+                    help='If > 0, keep up to this many MB of decoded training images and their masks in memory (shared between workers), '
+                         'so only the first epoch has to decode anything. Use this for small datasets like crack_segmentation.')
 
 
 parser.set_defaults(keep_latest=False, log=True, log_gpu=False, interrupt=True, autoscale=True)
@@ -115,6 +136,14 @@ replace('momentum')
 # This is managed by set_lr
 cur_lr = args.lr
 
+# Check this now instead of finding out when train makes the BatchSSDAugmentation
+if args.gpu_augment:
+    try:
+        BatchSSDAugmentation.check_cfg()
+    except ValueError as e:
+        print('Error: --gpu_augment can\'t be used with %s. %s' % (cfg.name, e))
+        exit(-1)
+
 if torch.cuda.device_count() == 0:
     print('No GPUs detected. Exiting...')
     exit(-1)
@@ -180,15 +209,28 @@ def train():
     if not os.path.exists(args.save_folder):
         os.mkdir(args.save_folder)
 
-    dataset = COCODetection(image_path=cfg.dataset.train_images,
-                            info_file=cfg.dataset.train_info,
-                            transform=SSDAugmentation(MEANS))
+    # With gpu_augment, the workers just decode and the augmentation happens in the training loop
+    train_transform = None if args.gpu_augment else SSDAugmentation(MEANS)
+    gpu_augment = BatchSSDAugmentation(MEANS, device='cuda' if args.cuda else 'cpu') if args.gpu_augment else None
+
+    if args.train_shards is not None:
+        dataset = COCOShardDataset(args.train_shards, transform=train_transform, skip_unusable=True)
+    else:
+        dataset = COCODetection(image_path=cfg.dataset.train_images,
+                                info_file=cfg.dataset.train_info,
+                                transform=train_transform,
+                                skip_unusable=True,
+                                ram_cache_size=args.ram_cache_mb * (1 << 20))
     
     if args.validation_epoch > 0:
         setup_eval()
-        val_dataset = COCODetection(image_path=cfg.dataset.valid_images,
-                                    info_file=cfg.dataset.valid_info,
-                                    transform=BaseTransform(MEANS))
+        if args.valid_shards is not None:
+            val_dataset = COCOShardDataset(args.valid_shards, transform=BaseTransform(MEANS), report_orig_size=True)
+        else:
+            val_dataset = COCODetection(image_path=cfg.dataset.valid_images,
+                                        info_file=cfg.dataset.valid_info,
+                                        transform=BaseTransform(MEANS),
+                                        gt_cache_dir=args.gt_cache_dir)
 
     # Parallel wraps the underlying module, but when saving and loading we don't want that
     yolact_net = Yolact()
@@ -253,11 +295,23 @@ def train():
     # Which learning rate adjustment step are we on? lr' = lr * gamma ^ step_index
     step_index = 0
 
-    data_loader = data.DataLoader(dataset, args.batch_size,
-                                  num_workers=args.num_workers,
-                                  shuffle=True, collate_fn=detection_collate,
-                                  generator=torch.Generator(device='cuda'),
-                                  pin_memory=True)
+    if cfg.preserve_aspect_ratio and args.ar_buckets > 0:
+        data_loader = data.DataLoader(dataset, num_workers=args.num_workers,
+                                      batch_sampler=AspectRatioBatchSampler(dataset, args.batch_size, args.ar_buckets),
+                                      collate_fn=PaddedCollate(dataset.stats, packed_collate if args.packed_collate else detection_collate),
+                                      pin_memory=True)
+    else:
+        # The decoded images gpu_augment gets are all different sizes, so those can't be packed
+        if args.gpu_augment:
+            collate_fn = decoded_collate
+        else:
+            collate_fn = packed_collate if args.packed_collate else detection_collate
+
+        data_loader = data.DataLoader(dataset, args.batch_size,
+                                      num_workers=args.num_workers,
+                                      shuffle=True, collate_fn=collate_fn,
+                                      generator=torch.Generator(device='cuda'),
+                                      pin_memory=True)
     
     
     save_path = lambda epoch, iteration: SavePath(cfg.name, epoch, iteration).get_path(root=args.save_folder)
@@ -311,6 +365,9 @@ def train():
                 # Zero the grad to get ready to compute gradients
                 optimizer.zero_grad()
 
+                if gpu_augment is not None:
+                    datum = gpu_augment(datum)
+
                 # Forward Pass + Compute loss at the same time (see CustomDataParallel and NetLoss)
                 losses = net(datum)
                 
@@ -373,6 +430,11 @@ def train():
                             print('Deleting old save...')
                             os.remove(latest)
             
+            # See how much time the workers spent on samples augmentation threw out
+            print(dataset.stats.summary())
+            if args.log:
+                log.log('loader', data=dataset.stats.totals(), epoch=epoch, iter=iteration)
+
             # This is done per epoch
             if args.validation_epoch > 0:
                 if epoch % args.validation_epoch == 0 and epoch > 0:
@@ -412,6 +474,10 @@ def prepare_data(datum, devices:list=None, allocation:list=None):
             allocation = [args.batch_size // len(devices)] * (len(devices) - 1)
             allocation.append(args.batch_size - sum(allocation)) # The rest might need more/less
         
+        if isinstance(datum, PackedBatch):
+            # One non blocking copy per buffer per device, and then everything below is already on its device
+            datum = datum.to_devices(devices, allocation)
+        
         images, (targets, masks, num_crowds) = datum
 
         cur_idx = 0
@@ -419,10 +485,12 @@ def prepare_data(datum, devices:list=None, allocation:list=None):
             for _ in range(alloc):
                 images[cur_idx]  = gradinator(images[cur_idx].to(device))
                 targets[cur_idx] = gradinator(targets[cur_idx].to(device))
-                masks[cur_idx]   = gradinator(masks[cur_idx].to(device))
+                # The masks come in as uint8 to keep them small, so only make them float once they're on the device
+                masks[cur_idx]   = gradinator(masks[cur_idx].to(device, non_blocking=True).float())
                 cur_idx += 1
 
-        if cfg.preserve_aspect_ratio:
+        # Batches from PaddedCollate (--ar_buckets) are already all one size, so they don't need this
+        if cfg.preserve_aspect_ratio and len(set(image.size() for image in images)) > 1:
             # Choose a random size from the batch
             _, h, w = images[random.randint(0, len(images)-1)].size()
 
@@ -506,7 +574,8 @@ def compute_validation_map(epoch, iteration, yolact_net, dataset, log:Log=None):
         yolact_net.train()
 
 def setup_eval():
-    eval_script.parse_args(['--no_bar', '--max_images='+str(args.validation_size)])
+    validation_batch_size = args.batch_size if args.validation_batch_size is None else args.validation_batch_size
+    eval_script.parse_args(['--no_bar', '--max_images='+str(args.validation_size), '--batch_size='+str(validation_batch_size)])
 
 if __name__ == '__main__':
     train()
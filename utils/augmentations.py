@@ -7,6 +7,7 @@ from numpy import random
 from math import sqrt
 
 from data import cfg, MEANS, STD
+from data.lazy_masks import LazyMasks
 
 
 def intersect(box_a, box_b):
@@ -69,7 +70,8 @@ class Lambda(object):
 
 class ConvertFromInts(object):
     def __call__(self, image, masks=None, boxes=None, labels=None):
-        return image.astype(np.float32), masks, boxes, labels
+        # No need to copy if something before this (e.g., LUTPhotometricDistort) already did the conversion
+        return image.astype(np.float32, copy=False), masks, boxes, labels
 
 
 
@@ -117,7 +119,9 @@ class Pad(object):
         expand_image[:, :, :] = self.mean
         expand_image[:im_h, :im_w] = image
 
-        if self.pad_gt:
+        if self.pad_gt and isinstance(masks, LazyMasks):
+            masks = masks.pad(self.width, self.height)
+        elif self.pad_gt:
             expand_masks = np.zeros(
                 (masks.shape[0], self.height, self.width),
                 dtype=masks.dtype)
@@ -153,15 +157,18 @@ class Resize(object):
         image = cv2.resize(image, (width, height))
 
         if self.resize_gt:
-            # Act like each object is a color channel
-            masks = masks.transpose((1, 2, 0))
-            masks = cv2.resize(masks, (width, height))
-            
-            # OpenCV resizes a (w,h,1) array to (s,s), so fix that
-            if len(masks.shape) == 2:
-                masks = np.expand_dims(masks, 0)
+            if isinstance(masks, LazyMasks):
+                masks = masks.resize(width, height)
             else:
-                masks = masks.transpose((2, 0, 1))
+                # Act like each object is a color channel
+                masks = masks.transpose((1, 2, 0))
+                masks = cv2.resize(masks, (width, height))
+                
+                # OpenCV resizes a (w,h,1) array to (s,s), so fix that
+                if len(masks.shape) == 2:
+                    masks = np.expand_dims(masks, 0)
+                else:
+                    masks = masks.transpose((2, 0, 1))
 
             # Scale bounding boxes (which are currently absolute coordinates)
             boxes[:, [0, 2]] *= (width  / img_w)
@@ -375,7 +382,10 @@ class RandomSampleCrop(object):
                     continue
 
                 # take only the matching gt masks
-                current_masks = masks[mask, :, :].copy()
+                if isinstance(masks, LazyMasks):
+                    current_masks = masks[mask]
+                else:
+                    current_masks = masks[mask, :, :].copy()
 
                 # take only matching gt boxes
                 current_boxes = boxes[mask, :].copy()
@@ -400,7 +410,10 @@ class RandomSampleCrop(object):
                 current_boxes[:, 2:] -= rect[:2]
 
                 # crop the current masks to the same dimensions as the image
-                current_masks = current_masks[:, rect[1]:rect[3], rect[0]:rect[2]]
+                if isinstance(current_masks, LazyMasks):
+                    current_masks = current_masks.crop(*rect)
+                else:
+                    current_masks = current_masks[:, rect[1]:rect[3], rect[0]:rect[2]]
 
                 return current_image, current_masks, current_boxes, current_labels
 
@@ -426,12 +439,15 @@ class Expand(object):
                      int(left):int(left + width)] = image
         image = expand_image
 
-        expand_masks = np.zeros(
-            (masks.shape[0], int(height*ratio), int(width*ratio)),
-            dtype=masks.dtype)
-        expand_masks[:,int(top):int(top + height),
-                       int(left):int(left + width)] = masks
-        masks = expand_masks
+        if isinstance(masks, LazyMasks):
+            masks = masks.expand(int(left), int(top), int(width*ratio), int(height*ratio))
+        else:
+            expand_masks = np.zeros(
+                (masks.shape[0], int(height*ratio), int(width*ratio)),
+                dtype=masks.dtype)
+            expand_masks[:,int(top):int(top + height),
+                           int(left):int(left + width)] = masks
+            masks = expand_masks
 
         boxes = boxes.copy()
         boxes[:, :2] += (int(left), int(top))
@@ -445,7 +461,7 @@ class RandomMirror(object):
         _, width, _ = image.shape
         if random.randint(2):
             image = image[:, ::-1]
-            masks = masks[:, :, ::-1]
+            masks = masks.mirror() if isinstance(masks, LazyMasks) else masks[:, :, ::-1]
             boxes = boxes.copy()
             boxes[:, 0::2] = width - boxes[:, 2::-2]
         return image, masks, boxes, labels
@@ -456,7 +472,7 @@ class RandomFlip(object):
         height , _ , _ = image.shape
         if random.randint(2):
             image = image[::-1, :]
-            masks = masks[:, ::-1, :]
+            masks = masks.flip() if isinstance(masks, LazyMasks) else masks[:, ::-1, :]
             boxes = boxes.copy()
             boxes[:, 1::2] = height - boxes[:, 3::-2]
         return image, masks, boxes, labels
@@ -467,7 +483,10 @@ class RandomRot90(object):
         old_height , old_width , _ = image.shape
         k = random.randint(4)
         image = np.rot90(image,k)
-        masks = np.array([np.rot90(mask,k) for mask in masks])
+        if isinstance(masks, LazyMasks):
+            masks = masks.rot90(k)
+        else:
+            masks = np.array([np.rot90(mask,k) for mask in masks])
         boxes = boxes.copy()
         for _ in range(k):
             boxes = np.array([[box[1], old_width - 1 - box[2], box[3], old_width - 1 - box[0]] for box in boxes])
@@ -524,6 +543,68 @@ class PhotometricDistort(object):
         im, masks, boxes, labels = distort(im, masks, boxes, labels)
         return self.rand_light_noise(im, masks, boxes, labels)
 
+class RasterizeMasks(object):
+    """ Turns LazyMasks into a [num_objs, height, width] uint8 array. Put this after the last transform that moves masks around. """
+
+    def __call__(self, image, masks, boxes=None, labels=None):
+        if isinstance(masks, LazyMasks):
+            masks = masks.rasterize()
+        return image, masks, boxes, labels
+
+class LUTPhotometricDistort(object):
+    """
+    PhotometricDistort for uint8 images, with lookup tables instead of a bunch of full image float passes.
+    This takes the uint8 image and gives back a float32 one, so put it before ConvertFromInts.
+
+    The random parameters are drawn the same way as PhotometricDistort. Brightness and contrast are folded
+    into one 256 entry table, hue and saturation are one table per channel on the uint8 HSV image, and the
+    last table does the conversion to float too. If neither hue nor saturation does anything (1/4 of the time),
+    the whole thing is just one table and we skip going to HSV and back.
+
+    The difference from PhotometricDistort is that going through HSV clips to [0, 255] (the float version
+    lets values go out of range) and cv2's uint8 hue is in 2 degree steps.
+    """
+
+    def __init__(self, brightness_delta=32, contrast=(0.5, 1.5), saturation=(0.5, 1.5), hue_delta=18.0):
+        self.brightness_delta = brightness_delta
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue_delta = hue_delta
+
+        self.values = np.arange(256, dtype=np.float32)
+        self.fallback = PhotometricDistort()
+
+    def __call__(self, image, masks=None, boxes=None, labels=None):
+        if image.dtype != np.uint8:
+            return self.fallback(image.astype(np.float32), masks, boxes, labels)
+
+        delta = random.uniform(-self.brightness_delta, self.brightness_delta) if random.randint(2) else 0
+        contrast_first = random.randint(2)
+        alpha = random.uniform(*self.contrast) if random.randint(2) else 1
+        sat = random.uniform(*self.saturation) if random.randint(2) else 1
+        hue = random.uniform(-self.hue_delta, self.hue_delta) if random.randint(2) else 0
+
+        # Brightness, then contrast if it goes first
+        pre = (self.values + delta) * (alpha if contrast_first else 1)
+        post_alpha = 1 if contrast_first else alpha
+
+        if sat == 1 and hue == 0:
+            # Everything's linear, so this is exactly what PhotometricDistort would give
+            return np.take(pre * post_alpha, image), masks, boxes, labels
+
+        image = cv2.LUT(image, np.clip(np.round(pre), 0, 255).astype(np.uint8))
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+        # cv2's uint8 hue goes from 0 to 180
+        hsv_lut = np.stack([
+            np.round(self.values + hue / 2) % 180,
+            np.clip(np.round(self.values * sat), 0, 255),
+            self.values,
+        ], axis=-1).astype(np.uint8).reshape(1, 256, 3)
+
+        image = cv2.cvtColor(cv2.LUT(hsv, hsv_lut), cv2.COLOR_HSV2BGR)
+        return np.take(self.values * post_alpha, image), masks, boxes, labels
+
 class PrepareMasks(object):
     """
     Prepares the gt masks for use_gt_bboxes by cropping with the gt box
@@ -667,11 +748,17 @@ def enable_if(condition, obj):
 class SSDAugmentation(object):
     """ Transform to be used when training. """
 
+    # Every transform up to RasterizeMasks knows what to do with LazyMasks
+    lazy_masks = True
+
     def __init__(self, mean=MEANS, std=STD):
+        # The smallest fraction of the image's width / height that RandomSampleCrop can keep
+        self.min_crop = 0.3 if cfg.augment_random_sample_crop else 1
         self.augment = Compose([
+            enable_if(cfg.augment_photometric_distort and cfg.augment_photometric_lut, LUTPhotometricDistort()),
             ConvertFromInts(),
             ToAbsoluteCoords(),
-            enable_if(cfg.augment_photometric_distort, PhotometricDistort()),
+            enable_if(cfg.augment_photometric_distort and not cfg.augment_photometric_lut, PhotometricDistort()),
             enable_if(cfg.augment_expand, Expand(mean)),
             enable_if(cfg.augment_random_sample_crop, RandomSampleCrop()),
             enable_if(cfg.augment_random_mirror, RandomMirror()),
@@ -679,10 +766,24 @@ class SSDAugmentation(object):
             enable_if(cfg.augment_random_flip, RandomRot90()),
             Resize(),
             enable_if(not cfg.preserve_aspect_ratio, Pad(cfg.max_size, cfg.max_size, mean)),
+            RasterizeMasks(),
             ToPercentCoords(),
             PrepareMasks(cfg.mask_size, cfg.use_gt_bboxes),
             BackboneTransform(cfg.backbone.transform, mean, std, 'BGR')
         ])
 
+    def min_decode_side(self, width, height):
+        """
+        Returns how small the shorter side of a width x height image can be decoded without losing anything:
+        anything above this gets thrown away by Resize anyway, even for the smallest crop.
+        Expand only ever makes the image smaller, so it doesn't matter here.
+        """
+        if cfg.preserve_aspect_ratio:
+            out_size = min(Resize.calc_size_preserve_ar(width, height, cfg.max_size))
+        else:
+            out_size = cfg.max_size
+
+        return out_size / self.min_crop
+
     def __call__(self, img, masks, boxes, labels):
         return self.augment(img, masks, boxes, labels)
@@ -0,0 +1,107 @@
+"""
+Pools of preallocated buffers so that processing a video doesn't allocate new frames every frame.
+
+Buffers are keyed by shape and dtype. acquire hands out a free buffer with that key if there is one
+and only allocates a new one if there isn't. Once whoever's using the buffer is done with it, they
+give it back with release. After the first few frames, every acquire should be a reuse.
+"""
+
+import threading
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+
+class BufferPool:
+    """
+    A pool of buffers made by alloc(shape, dtype). See HostBufferPool and DeviceBufferPool for the usual ones.
+    This is thread safe since buffers usually get acquired and released in different pipeline stages.
+    """
+
+    def __init__(self, name:str, alloc):
+        self.name = name
+        self.alloc = alloc
+
+        self.free = defaultdict(list)
+        self.lock = threading.Lock()
+        # id -> buffer of everything handed out by acquire and not released yet
+        self.in_use = {}
+
+        self.num_allocs = 0
+        self.num_reuses = 0
+        self.num_in_use = 0
+        self.max_in_use = 0
+        self.bytes_allocated = 0
+
+    @staticmethod
+    def _key(shape, dtype):
+        # So that np.uint8 and np.dtype('uint8') (what buf.dtype gives back) end up as the same key
+        return tuple(shape), str(dtype) if isinstance(dtype, torch.dtype) else np.dtype(dtype).name
+
+    def acquire(self, shape, dtype):
+        """ Returns a buffer of this shape and dtype. Its contents are whatever was in there last time. """
+        key = self._key(shape, dtype)
+
+        with self.lock:
+            self.num_in_use += 1
+            self.max_in_use = max(self.max_in_use, self.num_in_use)
+
+            if len(self.free[key]) > 0:
+                self.num_reuses += 1
+                buf = self.free[key].pop()
+                self.in_use[id(buf)] = buf
+                return buf
+
+            self.num_allocs += 1
+
+        buf = self.alloc(shape, dtype)
+
+        with self.lock:
+            self.bytes_allocated += buf.nbytes if isinstance(buf, np.ndarray) else buf.numel() * buf.element_size()
+            self.in_use[id(buf)] = buf
+        return buf
+
+    def release(self, buf):
+        """
+        Gives a buffer from acquire back to the pool. Don't use it after this.
+        Anything the pool didn't hand out (e.g., a frame OpenCV allocated itself) is ignored, so it's safe to release those too.
+        """
+        with self.lock:
+            if self.in_use.pop(id(buf), None) is None:
+                return
+
+            self.num_in_use -= 1
+            self.free[self._key(buf.shape, buf.dtype)].append(buf)
+
+    def stats(self) -> str:
+        total = max(self.num_allocs + self.num_reuses, 1)
+        return '%-8s %6d allocs | %8d reuses (%5.1f%%) | %3d max in use | %8.2f MB' % (
+            self.name, self.num_allocs, self.num_reuses, self.num_reuses / total * 100,
+            self.max_in_use, self.bytes_allocated / (1 << 20))
+
+
+class HostBufferPool(BufferPool):
+    """ numpy buffers on the cpu. If pin is set, they're in pinned memory so copying them to the gpu is faster. """
+
+    def __init__(self, name:str, pin:bool=False):
+        def alloc(shape, dtype):
+            if pin:
+                return torch.empty(tuple(shape), dtype=torch.from_numpy(np.zeros(0, dtype=dtype)).dtype, pin_memory=True).numpy()
+            return np.empty(shape, dtype=dtype)
+
+        super().__init__(name, alloc)
+
+
+class DeviceBufferPool(BufferPool):
+    """ torch buffers on the given device. """
+
+    def __init__(self, name:str, device):
+        super().__init__(name, lambda shape, dtype: torch.empty(tuple(shape), dtype=dtype, device=device))
+
+
+def cuda_alloc_count() -> int:
+    """ The number of times the torch caching allocator has had to actually cudaMalloc so far. """
+    if not torch.cuda.is_available() or not hasattr(torch.cuda, 'memory_stats'):
+        return 0
+    return torch.cuda.memory_stats().get('segment.all.allocated', 0)
@@ -0,0 +1,330 @@
+"""
+A faster version of pycocotools' COCOeval that gives the same summary metrics.
+
+COCOeval loops over every image, category, area range, iou threshold, detection and ground
+truth in Python. Here, each image and category is matched for every area range and iou
+threshold at once with numpy, both iou types are evaluated in the same pass over the images,
+and the images are split over a process pool. Accumulating is vectorized over thresholds.
+
+The matching follows COCOeval.evaluateImg exactly (including how ties and ignored / crowd
+ground truth are handled), so stats should match COCOeval's to floating point error.
+scripts/check_cocoeval.py checks that on a synthetic set made to cover the edge cases, and
+run_coco_eval.py --validate checks it on your own detections.
+"""
+
+import numpy as np
+from multiprocessing import Pool
+from pycocotools import mask as maskUtils
+from pycocotools.cocoeval import Params
+
+# Set in every worker by _init_worker
+_worker_data = None
+
+
+def _ann_to_rle(segm, h:int, w:int):
+    """ Same as COCO.annToRLE, but without needing the COCO object. """
+    if isinstance(segm, list):
+        # Polygons, which might be made of multiple parts
+        return maskUtils.merge(maskUtils.frPyObjects(segm, h, w))
+    elif isinstance(segm['counts'], list):
+        # Uncompressed RLE
+        return maskUtils.frPyObjects(segm, h, w)
+    else:
+        return segm
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _match(gt:list, dt:list, iou_type:str, params:Params, img_size:tuple):
+    """
+    Matches the detections to the ground truth for one image and category for every area range
+    and iou threshold at once. This is COCOeval.computeIoU + COCOeval.evaluateImg.
+
+    Returns (scores [D], dt_matched [A,T,D], dt_ignore [A,T,D], num_gt_not_ignored [A]).
+    """
+    area_rngs = np.array(params.areaRng)
+    iou_thrs  = np.minimum(params.iouThrs, 1 - 1e-10)
+    A, T = area_rngs.shape[0], iou_thrs.shape[0]
+
+    dt = sorted(dt, key=lambda d: -d['score'])[:params.maxDets[-1]]
+    G, D = len(gt), len(dt)
+
+    scores   = np.array([d['score'] for d in dt], dtype=np.float64)
+    g_area   = np.array([g['area'] for g in gt], dtype=np.float64)
+    d_area   = np.array([d['area'] for d in dt], dtype=np.float64)
+    g_crowd  = np.array([bool(g['iscrowd']) for g in gt], dtype=bool)
+
+    # [A, G] and [A, D]: whether each gt / det is outside each area range
+    g_out = (g_area[None, :] < area_rngs[:, :1]) | (g_area[None, :] > area_rngs[:, 1:])
+    d_out = (d_area[None, :] < area_rngs[:, :1]) | (d_area[None, :] > area_rngs[:, 1:])
+    gt_ignore = g_crowd[None, :] | g_out
+
+    dt_matched = np.zeros((A, T, D), dtype=bool)
+    dt_ignore  = np.zeros((A, T, D), dtype=bool)
+
+    if G > 0 and D > 0:
+        if iou_type == 'segm':
+            h, w = img_size
+            g_objs = [_ann_to_rle(g['segmentation'], h, w) for g in gt]
+            d_objs = [_ann_to_rle(d['segmentation'], h, w) for d in dt]
+        else:
+            g_objs = [g['bbox'] for g in gt]
+            d_objs = [d['bbox'] for d in dt]
+
+        ious = np.asarray(maskUtils.iou(d_objs, g_objs, [int(x) for x in g_crowd])).reshape(D, G)
+        gt_matched = np.zeros((A, T, G), dtype=bool)
+
+        for d in range(D):
+            # A gt can take this det if it hasn't been taken already (crowds can be taken many times)
+            # and the iou is over the threshold
+            valid = (~gt_matched | g_crowd) & (ious[d][None, None, :] >= iou_thrs[None, :, None])
+
+            # COCOeval sorts the ignored gt last and stops once it found a non-ignored match,
+            # so only fall back to ignored gt if nothing else matched.
+            not_ignored = valid & ~gt_ignore[:, None, :]
+            cand = np.where(not_ignored.any(-1, keepdims=True), not_ignored, valid)
+
+            matched = cand.any(-1)
+            cand_iou = np.where(cand, ious[d][None, None, :], -1)
+            best = cand_iou.max(-1, keepdims=True)
+
+            # Ties go to the last gt with the best iou, just like COCOeval
+            m = G - 1 - np.argmax((cand_iou == best)[..., ::-1], axis=-1)
+
+            a_idx, t_idx = np.nonzero(matched)
+            m_idx = m[a_idx, t_idx]
+
+            gt_matched[a_idx, t_idx, m_idx] = True
+            dt_matched[a_idx, t_idx, d] = True
+            dt_ignore [a_idx, t_idx, d] = gt_ignore[a_idx, m_idx]
+
+    # Unmatched detections outside of the area range are ignored
+    dt_ignore |= ~dt_matched & d_out[:, None, :]
+    num_gt = (~gt_ignore).sum(-1)
+
+    return scores, dt_matched, dt_ignore, num_gt
+
+
+def _evaluate_img(img_id):
+    """ Evaluates every iou type and category for this image. """
+    data = _worker_data
+    params = data['params']
+    gts = data['gts'].get(img_id, {})
+    img_size = data['img_sizes'][img_id]
+
+    out = {}
+
+    for iou_type, dts in data['dts'].items():
+        dts = dts.get(img_id, {})
+
+        for cat_idx, cat_id in enumerate(params.catIds):
+            gt = gts.get(cat_id, [])
+            dt = dts.get(cat_id, [])
+
+            # COCOeval returns None for these, which accumulate then skips
+            if len(gt) == 0 and len(dt) == 0:
+                continue
+
+            out[(iou_type, cat_idx)] = _match(gt, dt, iou_type, params, img_size)
+
+    return out
+
+
+class FastCOCOeval:
+    """
+    Evaluates one set of ground truth against the detections for any number of iou types at once.
+
+    Usage:
+        E = FastCOCOeval(cocoGt, {'bbox': cocoDtBbox, 'segm': cocoDtSegm})
+        E.evaluate()    # Match everything
+        E.accumulate()  # Compute the precision / recall tables
+        E.summarize()   # Print out the summary and fill in E.stats[iou_type]
+
+    The params, eval and stats of each iou type are in the same format as COCOeval's.
+    """
+
+    def __init__(self, cocoGt, cocoDts:dict, num_workers:int=1):
+        self.cocoGt = cocoGt
+        self.cocoDts = cocoDts
+        self.iou_types = list(cocoDts.keys())
+        self.num_workers = num_workers
+
+        self.params = Params(iouType='bbox')
+        self.params.imgIds = sorted(cocoGt.getImgIds())
+        self.params.catIds = sorted(cocoGt.getCatIds())
+
+        self.eval  = {}
+        self.stats = {}
+        self._results = None
+
+    def _prepare(self) -> dict:
+        """ Groups the ground truth and each set of detections by image and category. """
+        def group(coco, keys):
+            out = {}
+            for ann in coco.dataset['annotations']:
+                if ann['image_id'] not in img_set:
+                    continue
+                entry = {k: ann[k] for k in keys if k in ann}
+                out.setdefault(ann['image_id'], {}).setdefault(ann['category_id'], []).append(entry)
+            return out
+
+        img_set = set(self.params.imgIds)
+        gt_keys = ['id', 'area', 'iscrowd', 'bbox'] + (['segmentation'] if 'segm' in self.iou_types else [])
+        gts = group(self.cocoGt, gt_keys)
+
+        # COCOeval treats a missing iscrowd as 0
+        for cats in gts.values():
+            for anns in cats.values():
+                for ann in anns:
+                    ann.setdefault('iscrowd', 0)
+
+        dts = {iou_type: group(coco, ['id', 'area', 'score', 'segmentation' if iou_type == 'segm' else 'bbox'])
+               for iou_type, coco in self.cocoDts.items()}
+
+        img_sizes = {img_id: (self.cocoGt.imgs[img_id]['height'], self.cocoGt.imgs[img_id]['width'])
+                     for img_id in self.params.imgIds}
+
+        return {'params': self.params, 'gts': gts, 'dts': dts, 'img_sizes': img_sizes}
+
+    def evaluate(self):
+        """ Matches detections to ground truth for every image. """
+        data = self._prepare()
+        img_ids = self.params.imgIds
+
+        if self.num_workers > 1:
+            chunksize = max(len(img_ids) // (self.num_workers * 8), 1)
+            with Pool(self.num_workers, initializer=_init_worker, initargs=(data,)) as pool:
+                results = pool.map(_evaluate_img, img_ids, chunksize=chunksize)
+        else:
+            _init_worker(data)
+            results = [_evaluate_img(img_id) for img_id in img_ids]
+            _init_worker(None)
+
+        # Keep everything in image id order since that's the order COCOeval concatenates in
+        self._results = {}
+        for img_result in results:
+            for key, val in img_result.items():
+                self._results.setdefault(key, []).append(val)
+
+    def accumulate(self):
+        """ Computes the precision and recall tables for each iou type just like COCOeval.accumulate. """
+        p = self.params
+        T, R, K, A, M = len(p.iouThrs), len(p.recThrs), len(p.catIds), len(p.areaRng), len(p.maxDets)
+
+        for iou_type in self.iou_types:
+            precision = -np.ones((T, R, K, A, M))
+            recall    = -np.ones((T, K, A, M))
+            scores    = -np.ones((T, R, K, A, M))
+
+            for k in range(K):
+                E = self._results.get((iou_type, k), [])
+                if len(E) == 0:
+                    continue
+
+                for a in range(A):
+                    num_gt = sum([int(e[3][a]) for e in E])
+                    if num_gt == 0:
+                        continue
+
+                    for m, max_det in enumerate(p.maxDets):
+                        dt_scores = np.concatenate([e[0][:max_det] for e in E])
+                        order = np.argsort(-dt_scores, kind='mergesort')
+                        dt_scores_sorted = dt_scores[order]
+
+                        dtm  = np.concatenate([e[1][a][:, :max_det] for e in E], axis=1)[:, order]
+                        dtIg = np.concatenate([e[2][a][:, :max_det] for e in E], axis=1)[:, order]
+
+                        tps = np.logical_and(dtm, np.logical_not(dtIg))
+                        fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg))
+
+                        tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                        fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                        nd = tp_sum.shape[1]
+
+                        rc = tp_sum / num_gt
+                        pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+
+                        recall[:, k, a, m] = rc[:, -1] if nd else 0
+
+                        if nd == 0:
+                            precision[:, :, k, a, m] = 0
+                            scores[:, :, k, a, m] = 0
+                            continue
+
+                        # Make precision monotonically decreasing
+                        pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+                        for t in range(T):
+                            inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                            valid = inds < nd
+
+                            q  = np.zeros(R)
+                            ss = np.zeros(R)
+                            q [valid] = pr[t, inds[valid]]
+                            ss[valid] = dt_scores_sorted[inds[valid]]
+
+                            precision[t, :, k, a, m] = q
+                            scores[t, :, k, a, m] = ss
+
+            self.eval[iou_type] = {
+                'params': p,
+                'counts': [T, R, K, A, M],
+                'precision': precision,
+                'recall': recall,
+                'scores': scores,
+            }
+
+    def _summarize(self, iou_type, ap=1, iouThr=None, areaRng='all', maxDets=100, verbose=True):
+        p = self.params
+        iStr = ' {:<18} {} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}'
+        titleStr = 'Average Precision' if ap == 1 else 'Average Recall'
+        typeStr = '(AP)' if ap == 1 else '(AR)'
+        iouStr = '{:0.2f}:{:0.2f}'.format(p.iouThrs[0], p.iouThrs[-1]) if iouThr is None else '{:0.2f}'.format(iouThr)
+
+        aind = [i for i, aRng in enumerate(p.areaRngLbl) if aRng == areaRng]
+        mind = [i for i, mDet in enumerate(p.maxDets) if mDet == maxDets]
+
+        if ap == 1:
+            s = self.eval[iou_type]['precision']
+            if iouThr is not None:
+                s = s[np.where(iouThr == p.iouThrs)[0]]
+            s = s[:, :, :, aind, mind]
+        else:
+            s = self.eval[iou_type]['recall']
+            if iouThr is not None:
+                s = s[np.where(iouThr == p.iouThrs)[0]]
+            s = s[:, :, aind, mind]
+
+        mean_s = -1 if len(s[s > -1]) == 0 else np.mean(s[s > -1])
+
+        if verbose:
+            print(iStr.format(titleStr, typeStr, iouStr, areaRng, maxDets, mean_s))
+        return mean_s
+
+    def summarize(self, verbose:bool=True):
+        """ Prints COCOeval's summary for each iou type and fills in self.stats. """
+        maxDets = self.params.maxDets
+
+        for iou_type in self.iou_types:
+            if verbose and len(self.iou_types) > 1:
+                print('\n%s:' % iou_type)
+
+            summ = lambda *args, **kwdargs: self._summarize(iou_type, *args, verbose=verbose, **kwdargs)
+
+            stats = np.zeros((12,))
+            stats[0]  = summ(1)
+            stats[1]  = summ(1, iouThr=.5, maxDets=maxDets[2])
+            stats[2]  = summ(1, iouThr=.75, maxDets=maxDets[2])
+            stats[3]  = summ(1, areaRng='small', maxDets=maxDets[2])
+            stats[4]  = summ(1, areaRng='medium', maxDets=maxDets[2])
+            stats[5]  = summ(1, areaRng='large', maxDets=maxDets[2])
+            stats[6]  = summ(0, maxDets=maxDets[0])
+            stats[7]  = summ(0, maxDets=maxDets[1])
+            stats[8]  = summ(0, maxDets=maxDets[2])
+            stats[9]  = summ(0, areaRng='small', maxDets=maxDets[2])
+            stats[10] = summ(0, areaRng='medium', maxDets=maxDets[2])
+            stats[11] = summ(0, areaRng='large', maxDets=maxDets[2])
+            self.stats[iou_type] = stats
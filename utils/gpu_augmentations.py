@@ -0,0 +1,350 @@
+"""
+A batched, on device version of SSDAugmentation.
+
+SSDAugmentation runs in the dataloader workers one sample at a time with numpy and OpenCV, and every
+step (expand, crop, mirror, resize, pad) makes a new full size float copy of the image and every mask.
+With this, the workers only decode (use transform=None and decoded_collate), and the whole batch gets
+augmented on the training device in one go:
+
+    - The random parameters for each sample are drawn on the cpu the same way the SSDAugmentation
+      transforms draw them, but only the boxes get moved around there. Expand, crop, mirror, flip,
+      rot90 and resize for each sample are folded into one affine transform.
+    - Every image (and every mask) in the batch is then warped straight from the decoded image to
+      max_size x max_size with a single grid_sample, so the expanded canvas is never made.
+    - Photometric distortion and the backbone transform run on the whole batch at once, with
+      per-sample random parameters.
+
+The one difference from SSDAugmentation is that photometric distortion happens after the resize
+instead of before it. It's all per pixel, so this just means it sees bilinearly interpolated pixels.
+The parts of the output outside the image are still filled with the mean, undistorted, like Expand does.
+"""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from data import cfg, MEANS, STD
+from utils.augmentations import jaccard_numpy
+
+
+def _translate(dx:float, dy:float) -> np.ndarray:
+    return np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]], dtype=np.float64)
+
+def _scale(sx:float, sy:float) -> np.ndarray:
+    return np.array([[sx, 0, 0], [0, sy, 0], [0, 0, 1]], dtype=np.float64)
+
+def _normalize(width:int, height:int) -> np.ndarray:
+    """ Maps pixel edge coordinates in a width x height image to the [-1, 1] coordinates grid_sample uses. """
+    return np.array([[2 / width, 0, -1], [0, 2 / height, -1], [0, 0, 1]], dtype=np.float64)
+
+def _move_boxes(matrix:np.ndarray, boxes:np.ndarray) -> np.ndarray:
+    """ Applies matrix to [num_boxes, 4] absolute boxes and returns the box around each moved box. """
+    x1, y1, x2, y2 = boxes.T
+    corners = np.stack([np.stack([x, y, np.ones_like(x)]) for x, y in ((x1, y1), (x2, y1), (x1, y2), (x2, y2))])
+    moved = np.einsum('ij,kjn->kin', matrix, corners)
+
+    return np.stack([moved[:, 0].min(0), moved[:, 1].min(0), moved[:, 0].max(0), moved[:, 1].max(0)], axis=1)
+
+
+def bgr_to_hsv(img:torch.Tensor) -> torch.Tensor:
+    """ Same as cv2.cvtColor(img, cv2.COLOR_BGR2HSV) for float images, but for a [n, 3, h, w] batch. """
+    b, g, r = img[:, 0], img[:, 1], img[:, 2]
+    v, _ = img.max(dim=1)
+    delta = v - img.min(dim=1)[0]
+    safe_delta = torch.where(delta == 0, torch.ones_like(delta), delta)
+
+    s = torch.where(v == 0, torch.zeros_like(v), delta / torch.where(v == 0, torch.ones_like(v), v))
+
+    h = torch.where(v == r, 60 * (g - b) / safe_delta,
+        torch.where(v == g, 120 + 60 * (b - r) / safe_delta,
+                            240 + 60 * (r - g) / safe_delta))
+    h = torch.where(delta == 0, torch.zeros_like(h), h)
+    h = torch.where(h < 0, h + 360, h)
+
+    return torch.stack([h, s, v], dim=1)
+
+
+def hsv_to_bgr(img:torch.Tensor) -> torch.Tensor:
+    """ Same as cv2.cvtColor(img, cv2.COLOR_HSV2BGR) for float images, but for a [n, 3, h, w] batch. """
+    h, s, v = img[:, 0] / 60, img[:, 1], img[:, 2]
+    sector = torch.floor(h)
+    f = h - sector
+    sector = (sector.long() % 6).unsqueeze(1)
+
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+
+    pick = lambda *vals: torch.stack(vals, dim=1).gather(1, sector).squeeze(1)
+    r = pick(v, q, p, p, t, v)
+    g = pick(t, v, v, q, p, p)
+    b = pick(p, p, t, v, v, q)
+
+    return torch.stack([b, g, r], dim=1)
+
+
+def decoded_collate(batch):
+    """
+    Collate for when the dataset has no transform (i.e., for BatchSSDAugmentation). Same output as
+    detection_collate, except images are the decoded [3, h, w] uint8 images and masks stay uint8.
+    """
+    imgs = []
+    targets = []
+    masks = []
+    num_crowds = []
+
+    for sample in batch:
+        imgs.append(sample[0])
+        targets.append(torch.FloatTensor(np.asarray(sample[1][0])))
+        masks.append(torch.from_numpy(np.ascontiguousarray(sample[1][1])))
+        num_crowds.append(sample[1][2])
+
+    return imgs, (targets, masks, num_crowds)
+
+
+class BatchSSDAugmentation:
+    """
+    Does what SSDAugmentation would for a whole batch at once on the given device. Takes and returns a
+    datum in the format detection_collate makes (but see decoded_collate for what it should take).
+
+    Like SSDAugmentation, each step is turned on and off with the augment_* settings in the config.
+    This doesn't support preserve_aspect_ratio (the outputs all need to be the same size to batch them)
+    or use_gt_bboxes.
+    """
+
+    # Same as RandomSampleCrop
+    sample_options = (
+        None,
+        (0.1, None),
+        (0.3, None),
+        (0.7, None),
+        (0.9, None),
+        (None, None),
+    )
+
+    # If a sample's boxes all get discarded, draw new parameters for it this many times before not augmenting it
+    max_retries = 10
+
+    @staticmethod
+    def check_cfg():
+        """ Raises a ValueError if the current config uses something this doesn't support. """
+        if cfg.preserve_aspect_ratio:
+            raise ValueError('BatchSSDAugmentation needs every image to come out the same size, so it can\'t preserve aspect ratio.')
+        if cfg.use_gt_bboxes:
+            raise ValueError('BatchSSDAugmentation doesn\'t support use_gt_bboxes.')
+
+    def __init__(self, mean=MEANS, std=STD, device='cuda'):
+        self.check_cfg()
+
+        self.device = device
+        self.size = cfg.max_size
+        self.transform = cfg.backbone.transform
+
+        self.mean = torch.tensor(mean, dtype=torch.float32, device=device)[None, :, None, None]
+        self.std  = torch.tensor(std,  dtype=torch.float32, device=device)[None, :, None, None]
+
+        # The input is BGR
+        channel_map = {c: idx for idx, c in enumerate('BGR')}
+        self.channel_permutation = [channel_map[c] for c in self.transform.channel_order]
+
+    def _sample_crop(self, boxes:np.ndarray, labels:np.ndarray, width:int, height:int):
+        """ Draws a crop the same way RandomSampleCrop does. Returns (rect or None for no crop, which boxes to keep). """
+        crowd = labels < 0
+
+        while True:
+            mode = self.sample_options[np.random.randint(len(self.sample_options))]
+            if mode is None:
+                return None, np.ones(boxes.shape[0], dtype=bool)
+
+            min_iou, max_iou = mode
+            min_iou = float('-inf') if min_iou is None else min_iou
+            max_iou = float('inf')  if max_iou is None else max_iou
+
+            for _ in range(50):
+                w = np.random.uniform(0.3 * width, width)
+                h = np.random.uniform(0.3 * height, height)
+
+                # aspect ratio constraint b/t .5 & 2
+                if h / w < 0.5 or h / w > 2:
+                    continue
+
+                left = np.random.uniform(width - w)
+                top = np.random.uniform(height - h)
+                rect = np.array([int(left), int(top), int(left+w), int(top+h)])
+
+                # This is the same (bugged) check as RandomSampleCrop, see the comment there
+                overlap = jaccard_numpy(boxes, rect)
+                if overlap.min() < min_iou and max_iou < overlap.max():
+                    continue
+
+                # keep gt boxes whose centers are in the crop, as long as there's at least one that's not a crowd
+                centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+                keep = (rect[0] < centers[:, 0]) * (rect[1] < centers[:, 1]) * (rect[2] > centers[:, 0]) * (rect[3] > centers[:, 1])
+
+                if not keep.any() or (~crowd[keep]).sum() == 0:
+                    continue
+
+                return rect, keep
+
+    def _sample_geometry(self, boxes:np.ndarray, labels:np.ndarray, width:int, height:int, augment:bool=True):
+        """
+        Draws expand, crop, mirror, flip, rot90 and resize for one sample, in that order (like SSDAugmentation).
+        Boxes are absolute. Returns (the 3x3 matrix taking the image to the output, the moved boxes, which boxes are kept).
+        """
+        matrix = np.eye(3)
+        keep = np.ones(boxes.shape[0], dtype=bool)
+        cur_w, cur_h = width, height
+
+        def move(step, new_w, new_h):
+            nonlocal matrix, boxes, cur_w, cur_h
+            matrix = step @ matrix
+            boxes = _move_boxes(step, boxes)
+            cur_w, cur_h = new_w, new_h
+
+        if augment and cfg.augment_expand and np.random.randint(2):
+            ratio = np.random.uniform(1, 4)
+            left = np.random.uniform(0, cur_w*ratio - cur_w)
+            top = np.random.uniform(0, cur_h*ratio - cur_h)
+            move(_translate(int(left), int(top)), int(cur_w*ratio), int(cur_h*ratio))
+
+        if augment and cfg.augment_random_sample_crop:
+            rect, keep = self._sample_crop(boxes, labels, cur_w, cur_h)
+
+            if rect is not None:
+                boxes = boxes.copy()
+                boxes[:, :2] = np.maximum(boxes[:, :2], rect[:2])
+                boxes[:, 2:] = np.minimum(boxes[:, 2:], rect[2:])
+                move(_translate(-rect[0], -rect[1]), rect[2] - rect[0], rect[3] - rect[1])
+
+        if augment and cfg.augment_random_mirror and np.random.randint(2):
+            move(np.array([[-1, 0, cur_w], [0, 1, 0], [0, 0, 1]], dtype=np.float64), cur_w, cur_h)
+
+        if augment and cfg.augment_random_flip and np.random.randint(2):
+            move(np.array([[1, 0, 0], [0, -1, cur_h], [0, 0, 1]], dtype=np.float64), cur_w, cur_h)
+
+        # SSDAugmentation turns RandomRot90 on with augment_random_flip too
+        if augment and cfg.augment_random_flip:
+            for _ in range(np.random.randint(4)):
+                move(np.array([[0, 1, 0], [-1, 0, cur_w], [0, 0, 1]], dtype=np.float64), cur_h, cur_w)
+
+        move(_scale(self.size / cur_w, self.size / cur_h), self.size, self.size)
+
+        # Discard boxes that are smaller than we'd like
+        w = boxes[:, 2] - boxes[:, 0]
+        h = boxes[:, 3] - boxes[:, 1]
+        keep = keep * (w > cfg.discard_box_width) * (h > cfg.discard_box_height)
+
+        return matrix, boxes, keep
+
+    def _photometric(self, img:torch.Tensor) -> torch.Tensor:
+        """ PhotometricDistort for a [n, 3, h, w] BGR float batch, with different random parameters for each image. """
+        num = img.size(0)
+        coin    = lambda: (torch.rand(num, device=img.device) < 0.5).float()[:, None, None]
+        uniform = lambda lo, hi: torch.empty(num, device=img.device).uniform_(lo, hi)[:, None, None]
+
+        # RandomBrightness
+        img = img + (coin() * uniform(-32, 32))[:, None]
+
+        # RandomContrast goes either before or after the HSV part, each with half a chance of doing anything
+        contrast_first = coin()[:, None]
+        alpha = (1 + coin() * (uniform(0.5, 1.5) - 1))[:, None]
+        img = img * (1 + contrast_first * (alpha - 1))
+
+        hsv = bgr_to_hsv(img)
+        # RandomSaturation and RandomHue
+        sat = 1 + coin() * (uniform(0.5, 1.5) - 1)
+        hue = coin() * uniform(-18, 18)
+        hsv = torch.stack([(hsv[:, 0] + hue) % 360, hsv[:, 1] * sat, hsv[:, 2]], dim=1)
+        img = hsv_to_bgr(hsv)
+
+        return img * (1 + (1 - contrast_first) * (alpha - 1))
+
+    def _backbone_transform(self, img:torch.Tensor) -> torch.Tensor:
+        """ BackboneTransform for a [n, 3, h, w] BGR float batch. """
+        if self.transform.normalize:
+            img = (img - self.mean) / self.std
+        elif self.transform.subtract_means:
+            img = img - self.mean
+        elif self.transform.to_float:
+            img = img / 255
+
+        return img[:, self.channel_permutation].contiguous()
+
+    def __call__(self, datum):
+        images, (targets, masks, num_crowds) = datum
+        num = len(images)
+
+        max_h = max([img.size(1) for img in images])
+        max_w = max([img.size(2) for img in images])
+        to_grid = _normalize(max_w, max_h)
+        from_out = np.linalg.inv(_normalize(self.size, self.size))
+
+        thetas = []
+        out_targets = []
+        keeps = []
+
+        with torch.no_grad():
+            for idx in range(num):
+                _, height, width = images[idx].size()
+                target = targets[idx].cpu().numpy().astype(np.float64)
+                boxes  = target[:, :4] * np.array([width, height, width, height])
+                labels = target[:, 4]
+
+                for attempt in range(self.max_retries + 1):
+                    matrix, out_boxes, keep = self._sample_geometry(boxes, labels, width, height, augment=attempt < self.max_retries)
+                    if keep.any():
+                        break
+
+                if not keep.any():
+                    # Even the unaugmented attempt only has boxes under discard_box_width / height. The CPU path would
+                    # resample this image, but we can't here, so keep them anyway rather than give the loss no gt.
+                    keep = (out_boxes[:, 2] > out_boxes[:, 0]) & (out_boxes[:, 3] > out_boxes[:, 1])
+                    if not keep.any():
+                        keep = np.ones(boxes.shape[0], dtype=bool)
+
+                # grid_sample wants to know where in the input each output pixel comes from
+                thetas.append((to_grid @ np.linalg.inv(matrix) @ from_out)[:2])
+
+                out_boxes = out_boxes[keep] / self.size
+                out_targets.append(torch.from_numpy(np.hstack((out_boxes, labels[keep, None]))).float().to(self.device))
+                num_crowds[idx] = int((labels[keep] < 0).sum())
+                keeps.append(torch.from_numpy(keep).to(self.device))
+
+            theta = torch.from_numpy(np.stack(thetas)).float().to(self.device)
+
+            # Pad everything to the same size so we can warp the whole batch at once. The 4th channel says where the image is.
+            batch = torch.zeros((num, 4, max_h, max_w), dtype=torch.float32, device=self.device)
+            for idx, img in enumerate(images):
+                _, height, width = img.size()
+                batch[idx, :3, :height, :width] = img.to(self.device, non_blocking=True).float()
+                batch[idx, 3, :height, :width] = 1
+
+            grid = F.affine_grid(theta, (num, 4, self.size, self.size), align_corners=False)
+            out = F.grid_sample(batch, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+            del batch
+
+            img, valid = out[:, :3], out[:, 3:]
+            if cfg.augment_photometric_distort:
+                # Undo the blending with the zero padding so the distortion sees the real colors
+                img = self._photometric(img / valid.clamp(min=1e-6)) * valid
+
+            # Expand fills with the mean (after photometric distortion), so do the same
+            img = img + self.mean * (1 - valid)
+            img = self._backbone_transform(img)
+
+            # Same thing for the masks, where each object gets its image's transform
+            obj_masks = [mask.to(self.device, non_blocking=True)[keep] for mask, keep in zip(masks, keeps)]
+            counts = torch.tensor([m.size(0) for m in obj_masks], device=self.device)
+
+            padded = torch.zeros((int(counts.sum()), 1, max_h, max_w), dtype=torch.float32, device=self.device)
+            start = 0
+            for mask in obj_masks:
+                padded[start:start+mask.size(0), 0, :mask.size(1), :mask.size(2)] = mask.float()
+                start += mask.size(0)
+
+            grid = F.affine_grid(theta.repeat_interleave(counts, dim=0), (padded.size(0), 1, self.size, self.size), align_corners=False)
+            out_masks = F.grid_sample(padded, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+            # Resize on uint8 masks rounds, so this matches. prepare_data makes these float.
+            out_masks = out_masks[:, 0].ge(0.5).byte().split(counts.tolist())
+
+        return list(img), (out_targets, list(out_masks), num_crowds)
@@ -0,0 +1,176 @@
+"""
+Keyframe inference for video: run the network only every so often and move the last set of
+detections along with the motion in the frames in between.
+
+This works best for fixed cameras, where the background doesn't move and objects don't change
+much from one frame to the next. Motion is estimated with dense optical flow on a small grayscale
+copy of each frame, and each detection gets shifted by the median flow inside its mask.
+"""
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from layers.box_utils import jaccard, mask_iou
+
+
+class KeyframeSelector:
+    """
+    Decides which frames go through the network.
+
+    A frame is a keyframe if it's been interval frames since the last keyframe, or, if diff_thresh
+    is set, if the mean absolute difference (in 0-255 gray levels) between it and the last keyframe
+    is over diff_thresh. That way, things that move run the network sooner.
+    """
+
+    def __init__(self, interval:int, diff_thresh:float=None):
+        self.interval = max(interval, 1)
+        self.diff_thresh = diff_thresh
+
+        self.last_key = None
+        self.since_key = 0
+        self.num_frames = 0
+        self.num_keyframes = 0
+
+    def __call__(self, small_gray:np.ndarray) -> bool:
+        """ Takes the small grayscale version of the next frame and returns whether it's a keyframe. """
+        self.num_frames += 1
+        self.since_key += 1
+
+        is_key = self.last_key is None or self.since_key >= self.interval
+        if not is_key and self.diff_thresh is not None:
+            diff = cv2.absdiff(small_gray, self.last_key).mean()
+            is_key = diff > self.diff_thresh
+
+        if is_key:
+            self.last_key = small_gray
+            self.since_key = 0
+            self.num_keyframes += 1
+
+        return is_key
+
+
+def make_small_gray(frame:np.ndarray, width:int=160) -> np.ndarray:
+    """ Shrinks a BGR frame down to width pixels across (keeping the aspect ratio) and converts it to gray. """
+    h, w = frame.shape[:2]
+    size = (width, max(int(round(h * width / w)), 1))
+    return cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+
+def estimate_motion(prev_gray:np.ndarray, cur_gray:np.ndarray) -> np.ndarray:
+    """ Returns the [h, w, 2] dense optical flow (in small image pixels) from prev_gray to cur_gray. """
+    return cv2.calcOpticalFlowFarneback(prev_gray, cur_gray, None, pyr_scale=0.5, levels=3, winsize=15,
+                                        iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
+
+
+def _shift(mask:torch.Tensor, dx:int, dy:int) -> torch.Tensor:
+    """ Moves a [h, w] mask by (dx, dy) pixels, filling in with zeros. """
+    h, w = mask.shape
+    out = torch.zeros_like(mask)
+
+    if abs(dx) >= w or abs(dy) >= h:
+        return out
+
+    out[max(dy, 0):h+min(dy, 0), max(dx, 0):w+min(dx, 0)] = mask[max(-dy, 0):h-max(dy, 0), max(-dx, 0):w-max(dx, 0)]
+    return out
+
+
+def propagate(dets:tuple, flow:np.ndarray, w:int, h:int) -> tuple:
+    """
+    Moves the (classes, scores, boxes, masks) that postprocess gave us for the keyframe along with flow.
+    Boxes are [num_dets, 4] in absolute coordinates and masks are [num_dets, h, w] (or None).
+    """
+    classes, scores, boxes, masks = dets
+    if classes.size(0) == 0:
+        return dets
+
+    flow_h, flow_w = flow.shape[:2]
+    scale_x, scale_y = w / flow_w, h / flow_h
+
+    if masks is not None and masks.dim() == 3:
+        small_masks = F.interpolate(masks[:, None].float(), (flow_h, flow_w), mode='nearest')[:, 0].gt(0.5).cpu().numpy()
+    else:
+        small_masks = None
+
+    new_boxes = boxes.clone()
+    new_masks = masks.clone() if small_masks is not None else masks
+    boxes_np = boxes.cpu().numpy()
+
+    for j in range(classes.size(0)):
+        region = small_masks[j] if small_masks is not None else None
+
+        if region is None or not region.any():
+            # Fall back to the box if there's no mask (or it's empty)
+            x1, y1, x2, y2 = boxes_np[j]
+            region = np.zeros((flow_h, flow_w), dtype=bool)
+            region[int(y1 / scale_y):max(int(np.ceil(y2 / scale_y)), int(y1 / scale_y) + 1),
+                   int(x1 / scale_x):max(int(np.ceil(x2 / scale_x)), int(x1 / scale_x) + 1)] = True
+
+        if not region.any():
+            continue
+
+        # The median is a lot less sensitive to the background bleeding into the region than the mean
+        dx = int(round(np.median(flow[..., 0][region]) * scale_x))
+        dy = int(round(np.median(flow[..., 1][region]) * scale_y))
+
+        if dx == 0 and dy == 0:
+            continue
+
+        new_boxes[j, 0::2] = (new_boxes[j, 0::2] + dx).clamp(0, w - 1)
+        new_boxes[j, 1::2] = (new_boxes[j, 1::2] + dy).clamp(0, h - 1)
+
+        if small_masks is not None:
+            new_masks[j] = _shift(masks[j], dx, dy)
+
+    return classes, scores, new_boxes, new_masks
+
+
+class PropagationQuality:
+    """
+    Keeps track of how close propagated detections are to what the network would have said for the same frame.
+    Each network detection is matched to the propagated detection of the same class with the highest box IoU.
+    """
+
+    def __init__(self, iou_thresh:float=0.5):
+        self.iou_thresh = iou_thresh
+        self.iou_type = 'box'
+        self.ious = []
+        self.num_dets = 0
+        self.num_matched = 0
+
+    def add(self, propagated:tuple, full:tuple):
+        p_classes, _, p_boxes, p_masks = propagated
+        f_classes, _, f_boxes, f_masks = full
+
+        self.num_dets += f_classes.size(0)
+        if f_classes.size(0) == 0 or p_classes.size(0) == 0:
+            return
+
+        box_ious = jaccard(f_boxes.float(), p_boxes.float().to(f_boxes.device))
+        same_class = f_classes[:, None] == p_classes[None, :].to(f_classes.device)
+        box_ious = box_ious * same_class.float()
+
+        use_masks = f_masks is not None and f_masks.dim() == 3 and p_masks is not None and p_masks.dim() == 3
+        if use_masks:
+            self.iou_type = 'mask'
+            ious = mask_iou(f_masks.float(), p_masks.float().to(f_masks.device))
+        else:
+            ious = box_ious
+
+        used = set()
+        for i in box_ious.max(dim=1)[0].argsort(descending=True).tolist():
+            best, best_iou = -1, self.iou_thresh
+            for j in range(p_classes.size(0)):
+                if j not in used and box_ious[i, j].item() > best_iou:
+                    best, best_iou = j, box_ious[i, j].item()
+
+            if best >= 0:
+                used.add(best)
+                self.num_matched += 1
+                self.ious.append(ious[i, best].item())
+
+    def summary(self) -> str:
+        mean_iou = np.mean(self.ious) if len(self.ious) > 0 else 0
+        recall = self.num_matched / max(self.num_dets, 1) * 100
+        return 'mean %s IoU with the network %.3f | %.1f%% of network detections matched' % (self.iou_type, mean_iou, recall)
@@ -0,0 +1,241 @@
+"""
+A small producer / consumer pipeline for running things like decode -> network -> encode at the
+same time instead of one after the other.
+
+Every stage runs in its own thread(s) and stages are joined by bounded queues, so a slow stage
+makes the ones before it wait (backpressure) instead of piling up frames in memory. Most of the
+heavy lifting in here (cv2 decode / encode, cuda kernels) lets go of the GIL, so threads are enough.
+
+Usage:
+    pipeline = Pipeline(paths, queue_size=8)
+    pipeline.add_stage(load, name='Decode', num_workers=4)
+    pipeline.add_stage(run_net, name='Network', batch_size=8)
+    pipeline.add_stage(save, name='Encode', num_workers=4)
+
+    for out in pipeline:
+        pass
+"""
+
+import threading
+import time
+import queue
+
+
+_END = object()
+
+
+class _Stage:
+    """ One step in a Pipeline. See Pipeline.add_stage. """
+
+    def __init__(self, fn, name:str, num_workers:int, batch_size:int, queue_size:int, drop:bool, on_drop):
+        self.fn = fn
+        self.name = name
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.drop = drop
+        self.on_drop = on_drop
+        self.input = queue.Queue(maxsize=queue_size)
+
+        self.num_items = 0
+        self.num_dropped = 0
+        self.busy_time = 0
+        self.lock = threading.Lock()
+        self.workers_left = num_workers
+
+
+class Pipeline:
+    """
+    Runs every item from source through each stage in order. Iterating over the pipeline starts it
+    and gives back whatever comes out of the last stage.
+
+    With one worker per stage, items come out in the same order they went in. With more than one,
+    they come out in whatever order they finish.
+    """
+
+    def __init__(self, source, queue_size:int=8):
+        self.source = source
+        self.queue_size = queue_size
+        self.stages = []
+        self.output = None
+
+        self.error = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add_stage(self, fn, name:str=None, num_workers:int=1, batch_size:int=1, queue_size:int=None, drop:bool=False, on_drop=None):
+        """
+        Adds a stage that calls fn on every item and passes the result on to the next stage.
+
+        Args:
+            - fn:          Takes one item and returns the item for the next stage (or None to throw it out).
+                           If batch_size > 1, fn takes a list of up to batch_size items and returns a list.
+            - num_workers: The number of threads calling fn.
+            - batch_size:  The most items to give fn at once. A batch is whatever's waiting in the queue
+                           when a worker is free, so this never waits around for a batch to fill up.
+            - queue_size:  How many items can wait for this stage (defaults to the pipeline's queue_size).
+            - drop:        If True and the queue is full, the oldest waiting item gets dropped to make room
+                           for the new one instead of blocking the stage before. Use this for real time input.
+            - on_drop:     Called with each item that gets dropped (e.g., to give its buffers back).
+        """
+        name = name if name is not None else getattr(fn, '__name__', 'stage%d' % len(self.stages))
+        queue_size = queue_size if queue_size is not None else self.queue_size
+        self.stages.append(_Stage(fn, name, num_workers, batch_size, queue_size, drop, on_drop))
+        return self
+
+    def _put(self, q:queue.Queue, item, stage:_Stage=None) -> bool:
+        """ Puts item in q, blocking (or dropping) as necessary. Returns False if the pipeline stopped first. """
+        if stage is not None and stage.drop and item is not _END:
+            while True:
+                try:
+                    q.put_nowait(item)
+                    return True
+                except queue.Full:
+                    try:
+                        dropped = q.get_nowait()
+                        with stage.lock:
+                            stage.num_dropped += 1
+                        if stage.on_drop is not None:
+                            stage.on_drop(dropped)
+                    except queue.Empty:
+                        pass
+
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q:queue.Queue):
+        """ Gets the next item from q, or _END if the pipeline stopped. """
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _run_source(self):
+        try:
+            for item in self.source:
+                if not self._put(self.stages[0].input, item, self.stages[0]):
+                    return
+            self._put(self.stages[0].input, _END)
+        except BaseException as e:
+            self._fail(e)
+
+    def _run_stage(self, idx:int):
+        stage = self.stages[idx]
+        next_stage = self.stages[idx+1] if idx+1 < len(self.stages) else None
+        out_queue = next_stage.input if next_stage is not None else self.output
+
+        try:
+            done = False
+
+            while not done:
+                item = self._get(stage.input)
+                if item is _END:
+                    break
+
+                if stage.batch_size > 1:
+                    items = [item]
+                    while len(items) < stage.batch_size:
+                        try:
+                            item = stage.input.get_nowait()
+                        except queue.Empty:
+                            break
+
+                        if item is _END:
+                            done = True
+                            break
+                        items.append(item)
+                else:
+                    items = item
+
+                start = time.perf_counter()
+                outs = stage.fn(items)
+                elapsed = time.perf_counter() - start
+
+                with stage.lock:
+                    stage.busy_time += elapsed
+                    stage.num_items += len(items) if stage.batch_size > 1 else 1
+
+                if stage.batch_size <= 1:
+                    outs = [outs]
+
+                for out in outs:
+                    if out is not None and not self._put(out_queue, out, next_stage):
+                        return
+
+            # Let the other workers of this stage know we're done too. Nothing else comes after _END, so
+            # the only way this is full is if it's full of _ENDs already.
+            try:
+                stage.input.put_nowait(_END)
+            except queue.Full:
+                pass
+
+            with stage.lock:
+                stage.workers_left -= 1
+                last = stage.workers_left == 0
+
+            if last:
+                self._put(out_queue, _END)
+        except BaseException as e:
+            self._fail(e)
+
+    def _fail(self, e:BaseException):
+        if self.error is None:
+            self.error = e
+        self._stop.set()
+
+    def start(self):
+        """ Starts every stage. You don't need to call this if you're iterating over the pipeline. """
+        self.output = queue.Queue(maxsize=self.queue_size)
+        self.start_time = time.perf_counter()
+
+        self._threads = [threading.Thread(target=self._run_source, daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            self._threads += [threading.Thread(target=self._run_stage, args=(idx,), daemon=True)
+                              for _ in range(stage.num_workers)]
+
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """ Stops every stage (after whatever they're doing right now). """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self.end_time = time.perf_counter()
+
+    def __iter__(self):
+        self.start()
+
+        try:
+            while True:
+                item = self._get(self.output)
+                if item is _END:
+                    break
+                yield item
+        finally:
+            self.stop()
+
+        if self.error is not None:
+            raise self.error
+
+    def print_stats(self):
+        """ Prints how busy each stage was, which tells you which one is the bottleneck. """
+        total_time = max(self.end_time - self.start_time, 1e-9)
+        name_width = max([len(stage.name) for stage in self.stages] + [5])
+        make_row = lambda vals: (' %' + str(name_width) + 's |' + ' %8s |' * (len(vals) - 1)) % tuple(vals)
+
+        print()
+        print(make_row(['Stage', 'Items', 'Dropped', 'ms/item', 'Busy']))
+        print('-' * (name_width + 2) + '+' + '----------+' * 4)
+        for stage in self.stages:
+            # Busy is the fraction of the time the stage's workers were running fn. Close to 100% is the bottleneck.
+            busy = stage.busy_time / (total_time * stage.num_workers)
+            ms_per_item = stage.busy_time / max(stage.num_items, 1) * 1000
+            print(make_row([stage.name, stage.num_items, stage.num_dropped, '%.2f' % ms_per_item, '%.1f%%' % (busy * 100)]))
+        print()
@@ -0,0 +1,191 @@
+"""
+Saves the raw (pre-NMS) output of Yolact for every image so that NMS and threshold settings
+can be swept later without running the network again (see --pred_cache_dir and --sweep in
+evaluate.py).
+
+To keep the store small, only priors whose best foreground confidence is over min_conf are
+kept. Detect throws out everything under its conf_thresh anyway, so replaying the store is
+exact for any conf_thresh >= min_conf. Everything but the confidences is stored as float16.
+
+Each array gets its own flat binary file that's appended to as images come in and memory
+mapped when reading it back. The priors are the same for every image of the same size, so
+they're only stored once and each image just refers to its set of priors.
+"""
+
+import os
+import os.path as osp
+import json
+import itertools
+
+import numpy as np
+import torch
+from pycocotools import mask as maskUtils
+
+# The dtype each prediction is stored as. Anything not in here (e.g., 'inst') is stored as float16.
+PRED_DTYPES = {'conf': np.float32}
+PROTO_DTYPE = np.float16
+
+
+class PredictionCacheWriter:
+    """
+    Stashes the predictions the network's Detect gets so that add can save them. Add record to
+    net.detect.prediction_hooks and then call add for each image in the batch after the forward pass.
+    """
+
+    def __init__(self, cache_dir:str, min_conf:float=0.05):
+        self.cache_dir = cache_dir
+        self.min_conf = min_conf
+        self.last_preds = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.files = {}
+        self.pred_dims = {}
+        self.priors = []
+        self.index = {k: [] for k in ('image_ids', 'heights', 'widths', 'num_crowds', 'num_kept',
+                                      'prior_sets', 'proto_shapes', 'num_gt', 'rle_lengths')}
+
+    def record(self, predictions):
+        """ Goes in Detect.prediction_hooks. """
+        self.last_preds = predictions
+
+    def _write(self, name:str, arr:np.ndarray):
+        if name not in self.files:
+            self.files[name] = open(osp.join(self.cache_dir, name + '.bin'), 'wb')
+        self.files[name].write(np.ascontiguousarray(arr).tobytes())
+
+    def _prior_set(self, priors:torch.Tensor) -> int:
+        """ Returns the index of this set of priors, saving it if we haven't seen it before. """
+        for idx, saved in enumerate(self.priors):
+            if saved.shape == priors.shape and torch.equal(saved, priors):
+                return idx
+
+        self.priors.append(priors)
+        np.save(osp.join(self.cache_dir, 'priors_%d.npy' % (len(self.priors) - 1)), priors.cpu().numpy())
+        return len(self.priors) - 1
+
+    def add(self, batch_idx:int, image_id:int, h:int, w:int, gt:np.ndarray, gt_masks:np.ndarray, num_crowd:int):
+        """ Saves the predictions for image batch_idx of the last forward pass along with its ground truth. """
+        preds = self.last_preds
+
+        with torch.no_grad():
+            conf = preds['conf'][batch_idx]
+            keep = (conf[:, 1:].max(dim=1)[0] > self.min_conf).nonzero().squeeze(1)
+
+            for k, v in preds.items():
+                if k in ('priors', 'proto'):
+                    continue
+
+                kept = v[batch_idx, keep].cpu().numpy()
+                self.pred_dims[k] = kept.shape[1]
+                self._write(k, kept.astype(PRED_DTYPES.get(k, np.float16)))
+
+            self._write('prior_idx', keep.cpu().numpy().astype(np.int32))
+            prior_set = self._prior_set(preds['priors'])
+
+            proto_shape = []
+            if 'proto' in preds:
+                proto = preds['proto'][batch_idx].cpu().numpy()
+                proto_shape = list(proto.shape)
+                self._write('proto', proto.astype(PROTO_DTYPE))
+
+        num_gt = 0 if gt is None else gt.shape[0]
+        rle_lengths = []
+
+        if num_gt > 0:
+            self._write('gt', gt.astype(np.float64))
+
+            rles = maskUtils.encode(np.asfortranarray(gt_masks.transpose(1, 2, 0).astype(np.uint8)))
+            for rle in rles:
+                rle_lengths.append(len(rle['counts']))
+                self._write('gt_rle', np.frombuffer(rle['counts'], dtype=np.uint8))
+
+        for k, v in zip(self.index, (image_id, h, w, num_crowd, keep.size(0), prior_set, proto_shape, num_gt, rle_lengths)):
+            self.index[k].append(int(v) if isinstance(v, (int, np.integer)) else v)
+
+    def close(self):
+        """ Finishes writing the store. Nothing can be read back until this is called. """
+        for f in self.files.values():
+            f.close()
+
+        meta = {
+            'min_conf': self.min_conf,
+            'pred_dims': self.pred_dims,
+            'pred_dtypes': {k: np.dtype(PRED_DTYPES.get(k, np.float16)).name for k in self.pred_dims},
+            'proto_dtype': np.dtype(PROTO_DTYPE).name,
+            'num_prior_sets': len(self.priors),
+            'index': self.index,
+        }
+
+        with open(osp.join(self.cache_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+class PredictionCache:
+    """ Reads back a store written by PredictionCacheWriter. """
+
+    def __init__(self, cache_dir:str):
+        self.cache_dir = cache_dir
+
+        with open(osp.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        self.min_conf = meta['min_conf']
+        self.index = meta['index']
+        self.priors = [torch.from_numpy(np.load(osp.join(cache_dir, 'priors_%d.npy' % i)))
+                       for i in range(meta['num_prior_sets'])]
+
+        self.preds = {k: self._map(k, meta['pred_dtypes'][k], dim) for k, dim in meta['pred_dims'].items()}
+        self.prior_idx = self._map('prior_idx', 'int32')
+        self.proto     = self._map('proto', meta['proto_dtype'])
+        self.gt        = self._map('gt', 'float64', 5)
+        self.gt_rle    = self._map('gt_rle', 'uint8')
+
+        offsets = lambda x: np.concatenate([[0], np.cumsum(x)]).astype(np.int64)
+        self.kept_offsets  = offsets(self.index['num_kept'])
+        self.proto_offsets = offsets([int(np.prod(x)) if len(x) > 0 else 0 for x in self.index['proto_shapes']])
+        self.gt_offsets    = offsets(self.index['num_gt'])
+        self.rle_offsets   = offsets(list(itertools.chain.from_iterable(self.index['rle_lengths'])))
+
+    def _map(self, name:str, dtype:str, dim:int=None) -> np.ndarray:
+        path = osp.join(self.cache_dir, name + '.bin')
+
+        if not osp.exists(path) or osp.getsize(path) == 0:
+            arr = np.zeros(0, dtype=dtype)
+        else:
+            arr = np.memmap(path, dtype=dtype, mode='r')
+
+        return arr if dim is None else arr.reshape(-1, dim)
+
+    def __len__(self):
+        return len(self.index['image_ids'])
+
+    def get(self, idx:int, device=None):
+        """
+        Returns (preds, (image_id, h, w, gt, gt_masks, num_crowd)) for the idx-th image in the store.
+        preds is a dict like the one Yolact passes to Detect with a batch size of 1, but only
+        including the priors that were kept.
+        """
+        start, end = self.kept_offsets[idx], self.kept_offsets[idx+1]
+        prior_idx = torch.from_numpy(np.array(self.prior_idx[start:end], dtype=np.int64))
+
+        to_tensor = lambda x: torch.from_numpy(np.array(x, dtype=np.float32)).to(device)
+
+        preds = {k: to_tensor(v[start:end]).unsqueeze(0) for k, v in self.preds.items()}
+        preds['priors'] = self.priors[self.index['prior_sets'][idx]][prior_idx].to(device)
+
+        proto_shape = self.index['proto_shapes'][idx]
+        if len(proto_shape) > 0:
+            proto = self.proto[self.proto_offsets[idx]:self.proto_offsets[idx+1]]
+            preds['proto'] = to_tensor(proto).view(1, *proto_shape)
+
+        h, w = self.index['heights'][idx], self.index['widths'][idx]
+        gt = np.array(self.gt[self.gt_offsets[idx]:self.gt_offsets[idx+1]])
+        gt_masks = None
+
+        if gt.shape[0] > 0:
+            rle_start = self.gt_offsets[idx]
+            rles = [{'size': [h, w], 'counts': self.gt_rle[self.rle_offsets[j]:self.rle_offsets[j+1]].tobytes()}
+                    for j in range(rle_start, rle_start + gt.shape[0])]
+            gt_masks = np.ascontiguousarray(maskUtils.decode(rles).transpose(2, 0, 1))
+
+        return preds, (self.index['image_ids'][idx], h, w, gt, gt_masks, self.index['num_crowds'][idx])
@@ -7,6 +7,7 @@ _disabled_names = set()
 _timer_stack = []
 _running_timer = None
 _disable_all = False
+_sync_fn = None
 
 def disable_all():
 	global _disable_all
@@ -16,6 +17,10 @@ def enable_all():
 	global _disable_all
 	_disable_all = False
 
+def is_enabled():
+	""" Returns False if disable_all was called (and enable_all hasn't been since). """
+	return not _disable_all
+
 def disable(fn_name):
 	""" Disables the given function name fom being considered for the average or outputted in print_stats. """
 	_disabled_names.add(fn_name)
@@ -24,6 +29,14 @@ def enable(fn_name):
 	""" Enables function names disabled by disable. """
 	_disabled_names.remove(fn_name)
 
+def set_sync(fn=None):
+	"""
+	Calls fn (e.g., torch.cuda.synchronize) every time a timer starts or stops so that
+	asynchronous work gets attributed to the right function. Pass None to turn this off.
+	"""
+	global _sync_fn
+	_sync_fn = fn
+
 def reset():
 	""" Resets the current timer. Call this at the start of an iteration. """
 	global _running_timer
@@ -50,6 +63,8 @@ def start(fn_name, use_stack=True):
 		start(fn_name, use_stack=False)
 		_running_timer = fn_name
 	else:
+		if _sync_fn is not None:
+			_sync_fn()
 		_start_times[fn_name] = time.perf_counter()
 
 def stop(fn_name=None, use_stack=True):
@@ -76,6 +91,8 @@ def stop(fn_name=None, use_stack=True):
 		else:
 			print('Warning: timer stopped with no timer running!')
 	else:
+		if _sync_fn is not None:
+			_sync_fn()
 		if _start_times[fn_name] > -1:
 			_total_times[fn_name] += time.perf_counter() - _start_times[fn_name]
 		else:
@@ -106,6 +123,10 @@ def print_stats():
 	print(format_str.format('Total', total_time()*1000))
 	print()
 
+def get_times():
+	""" Returns a dict of the time accumulated by each function (in seconds) since the last reset. """
+	return {name: elapsed_time for name, elapsed_time in _total_times.items() if name not in _disabled_names}
+
 def total_time():
 	""" Returns the total amount accumulated across all functions in seconds. """ 
 	return sum([elapsed_time for name, elapsed_time in _total_times.items() if name not in _disabled_names])